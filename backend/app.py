@@ -133,10 +133,34 @@ def handle_message(data):
     app.logger.info(f'Received message: {data}')
     socketio.emit('response', {'data': 'Message received'})
 
+# 初始化WebSocket服务（聊天房间、流式生成推送）
+def init_socketio_events():
+    from app.services.websocket import init_websocket
+    init_websocket(socketio)
+
+# 重新入队上次退出时未处理完的知识库文档
+def init_document_ingestion():
+    try:
+        from app.services.document_ingestion import document_ingestion
+        document_ingestion.resume_pending()
+    except Exception as e:
+        app.logger.error(f"恢复文档入库任务失败: {e}")
+
+# 预加载知识检索使用的嵌入和重排模型
+def init_retrieval():
+    try:
+        from app.services.retrieval import warm_up
+        warm_up()
+    except Exception as e:
+        app.logger.error(f"预加载检索模型失败: {e}")
+
 # 应用初始化
 def create_app():
     register_blueprints()
+    init_socketio_events()
     init_database()
+    init_document_ingestion()
+    init_retrieval()
     return app
 
 # 主程序入口
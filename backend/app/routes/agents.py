@@ -1,6 +1,8 @@
 from flask import Blueprint, request, jsonify
 from app.models.agent import Agent
 from app.services.database import get_db
+from app.services.semantic_cache import semantic_cache
+from app.services.name_cache import name_cache
 from app.utils.auth import token_required
 from app.utils.response import ApiResponse, handle_exception, validate_required_fields, serialize_mongo_data
 from bson import ObjectId
@@ -276,6 +278,10 @@ def update_agent(current_user, agent_id):
             {'$set': update_data}
         )
         
+        # 智能体配置变更后，已缓存的回答可能不再适用
+        semantic_cache.invalidate_agent(agent_id)
+        name_cache.invalidate('agents', agent_id)
+        
         print(f"✅ 智能体更新成功: {agent_id}")
         
         return jsonify(ApiResponse.success(None, "智能体更新成功"))
@@ -305,6 +311,8 @@ def delete_agent(current_user, agent_id):
         
         # 删除智能体
         result = db.agents.delete_one({'_id': ObjectId(agent_id)})
+        semantic_cache.invalidate_agent(agent_id)
+        name_cache.invalidate('agents', agent_id)
         
         print(f"✅ 智能体删除成功: {agent_id}")
         
@@ -331,21 +339,22 @@ def get_agent_stats(current_user, agent_id):
         if not agent:
             return jsonify(ApiResponse.error('智能体不存在')), 404
         
-        # 获取智能体相关的对话统计
-        conversations_count = db.conversations.count_documents({
-            'agent_id': ObjectId(agent_id)
-        })
-        
-        # 获取消息统计
-        messages_count = db.messages.count_documents({
-            'conversation_id': {'$in': list(db.conversations.find({'agent_id': ObjectId(agent_id)}, {'_id': 1}))}
-        })
+        # 对话和消息统计：直接汇总对话上维护的计数，不扫描消息集合
+        totals = next(db.conversations.aggregate([
+            {'$match': {'agent_id': {'$in': [agent_id, ObjectId(agent_id)]}}},
+            {'$group': {
+                '_id': None,
+                'conversations': {'$sum': 1},
+                'messages': {'$sum': {'$ifNull': ['$message_count', 0]}},
+                'tokens': {'$sum': {'$ifNull': ['$token_count', 0]}}
+            }}
+        ]), {})
+        conversations_count = totals.get('conversations', 0)
         
-        # 模拟统计数据
         stats = {
             'total_conversations': conversations_count,
-            'total_messages': messages_count,
-            'total_tokens': messages_count * 100,  # 模拟令牌数
+            'total_messages': totals.get('messages', 0),
+            'total_tokens': totals.get('tokens', 0),
             'total_time': conversations_count * 60  # 模拟用时（秒）
         }
         
@@ -372,9 +381,9 @@ def get_agent_conversations(current_user, agent_id):
         if not agent:
             return jsonify(ApiResponse.error('智能体不存在')), 404
         
-        # 获取智能体相关的对话
+        # 获取智能体相关的对话（历史数据中 agent_id 有字符串和ObjectId两种存储方式）
         conversations = list(db.conversations.find({
-            'agent_id': ObjectId(agent_id)
+            'agent_id': {'$in': [agent_id, ObjectId(agent_id)]}
         }).sort('updated_at', -1).limit(10))
         
         # 格式化对话数据
@@ -383,14 +392,13 @@ def get_agent_conversations(current_user, agent_id):
             conv['created_at'] = conv['created_at'].isoformat() if conv.get('created_at') else None
             conv['updated_at'] = conv['updated_at'].isoformat() if conv.get('updated_at') else None
             
-            # 获取消息数量
-            conv['message_count'] = db.messages.count_documents({
-                'conversation_id': conv['_id']
-            })
+            # 消息数量和最后一条消息时间由消息写入时维护
+            conv['message_count'] = conv.get('message_count', 0)
+            conv['last_message_at'] = conv['last_message_at'].isoformat() if conv.get('last_message_at') else None
             
             del conv['_id']
         
-        return jsonify(ApiResponse.success(conversations, "获取智能体对话历史成功"))
+        return jsonify(ApiResponse.success(serialize_mongo_data(conversations), "获取智能体对话历史成功"))
         
     except Exception as e:
         print(f"❌ 获取智能体对话历史失败: {str(e)}")
@@ -3,22 +3,42 @@
 
 from flask import Blueprint, request, jsonify, Response, stream_template
 from app.services.database import get_db
-from app.services.ollama import OllamaService
+from app.services.ollama import get_ollama_service
 from app.services.chat_service import ChatService
 from app.services.activity_service import activity_service
+from app.services.generation_scheduler import generation_scheduler, GenerationRejected
+from app.services.stream_registry import stream_registry, parse_event_id
+from app.services.websocket import get_websocket_service
+from app.services.write_behind import write_behind
+from app.services.name_cache import name_cache
+from app.services.conversation_stats import record_message, EMPTY_STATS
+from app.services.model_compare import compare_stream, COMPARE_MAX_MODELS
 from app.utils.auth import token_required
-from app.utils.response import ApiResponse, handle_exception, validate_pagination, validate_required_fields, sanitize_data, serialize_mongo_data
+from app.utils.sse import ChunkCoalescer, sse_frame
+from app.utils.latency import TurnTimer
+from app.utils.response import ApiResponse, handle_exception, too_many_requests, validate_pagination, validate_required_fields, sanitize_data, serialize_mongo_data
 from bson import ObjectId
-from datetime import datetime
+from datetime import datetime, timedelta
 import json
+import base64
 import time
 import os
+import queue
+import threading
+from typing import Optional
 from werkzeug.utils import secure_filename
 
 # 创建聊天蓝图
 chat_bp = Blueprint('chat', __name__)
-# 初始化Ollama服务和聊天服务
-ollama_service = OllamaService()
+
+# 消息分页配置
+MESSAGE_PAGE_SIZE = int(os.environ.get('MESSAGE_PAGE_SIZE', 50))  # 每页默认消息数
+MESSAGE_PAGE_MAX = int(os.environ.get('MESSAGE_PAGE_MAX', 200))  # 每页最大消息数
+MESSAGE_FLUSH_TIMEOUT = float(os.environ.get('MESSAGE_FLUSH_TIMEOUT', 2.0))  # 读取或删除消息前等待本对话写后队列落库的最长时间（秒）
+# 消息列表只返回前端展示需要的字段
+MESSAGE_PROJECTION = {'content': 1, 'type': 1, 'attachments': 1, 'metadata': 1, 'created_at': 1}
+_EPOCH = datetime(1970, 1, 1)
+# 初始化聊天服务，Ollama客户端每次通过 get_ollama_service 获取，不在模块级持有
 chat_service = ChatService()
 
 @chat_bp.route('/conversations', methods=['GET'])
@@ -70,19 +90,25 @@ def get_conversations(current_user):
                            .sort('updated_at', -1))
         print(f"📊 获取到 {len(conversations)} 个对话")
         
-        # 格式化数据并获取智能体信息
+        # 批量解析本页的智能体和模型名称：缓存未命中的ID合并为一次 $in 查询
+        agent_names = name_cache.resolve(db, 'agents', [
+            c['agent_id'] for c in conversations if c.get('type') == 'agent' and c.get('agent_id')
+        ])
+        model_names = name_cache.resolve(db, 'models', [
+            c['model_id'] for c in conversations if c.get('type') == 'model' and c.get('model_id')
+        ])
+        
+        # 格式化数据并填充智能体或模型名称
         for conv in conversations:
             conv['id'] = str(conv['_id'])
             conv['created_at'] = conv['created_at'].isoformat() if conv.get('created_at') else None
             conv['updated_at'] = conv['updated_at'].isoformat() if conv.get('updated_at') else None
             
-            # 获取智能体或模型信息
+            # 填充智能体或模型名称
             if conv.get('type') == 'agent' and conv.get('agent_id'):
-                agent = db.agents.find_one({'_id': ObjectId(conv['agent_id'])})
-                conv['agent_name'] = agent['name'] if agent else '未知智能体'
+                conv['agent_name'] = agent_names.get(str(conv['agent_id'])) or '未知智能体'
             elif conv.get('type') == 'model' and conv.get('model_id'):
-                model = db.models.find_one({'_id': ObjectId(conv['model_id'])})
-                conv['model_name'] = model['name'] if model else '未知模型'
+                conv['model_name'] = model_names.get(str(conv['model_id'])) or '未知模型'
             
             # 确保所有ObjectId都转换为字符串
             if 'agent_id' in conv and isinstance(conv['agent_id'], ObjectId):
@@ -163,7 +189,8 @@ def create_conversation(current_user):
             'title': data.get('title', '新对话'),
             'status': 'active',
             'created_at': datetime.now(),
-            'updated_at': datetime.now()
+            'updated_at': datetime.now(),
+            **EMPTY_STATS
         }
         
         # 根据类型添加相应的ID
@@ -242,13 +269,54 @@ def get_conversation(current_user, conversation_id):
     except Exception as e:
         return jsonify(ApiResponse.error(str(e))), 400
 
+def encode_message_cursor(message: dict) -> str:
+    """把消息的 (created_at, _id) 编码为分页游标"""
+    created_at = message.get('created_at') or _EPOCH
+    millis = int((created_at - _EPOCH).total_seconds() * 1000)
+    return base64.urlsafe_b64encode(f"{millis}:{message['_id']}".encode()).decode().rstrip('=')
+
+def decode_message_cursor(cursor: str) -> tuple:
+    """解析分页游标，返回 (created_at, _id)，格式错误时抛出 ValueError"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode()
+        millis, message_id = raw.split(':', 1)
+        return _EPOCH + timedelta(milliseconds=int(millis)), ObjectId(message_id)
+    except Exception:
+        raise ValueError(f"无效的分页游标: {cursor}")
+
+def _find_message_page(db, conversation_key, cursor_key, newer: bool, limit: int) -> tuple:
+    """
+    按 (conversation_id, created_at, _id) 复合索引读取一页消息，只投影前端需要的字段
+    
+    Returns:
+        tuple: (按时间正序的消息列表, 该方向是否还有更多消息)
+    """
+    query = {'conversation_id': conversation_key}
+    if cursor_key:
+        created_at, message_id = cursor_key
+        op = '$gt' if newer else '$lt'
+        query['$or'] = [
+            {'created_at': {op: created_at}},
+            {'created_at': created_at, '_id': {op: message_id}}
+        ]
+    direction = 1 if newer else -1
+    messages = list(db.messages.find(query, MESSAGE_PROJECTION)
+                    .sort([('created_at', direction), ('_id', direction)])
+                    .limit(limit + 1))
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    if not newer:
+        messages.reverse()
+    return messages, has_more
+
 @chat_bp.route('/conversations/<conversation_id>/messages', methods=['GET'])
 @token_required
 @handle_exception
 def get_messages(current_user, conversation_id):
     """
     获取对话消息
-    支持分页获取消息历史
+    按 (created_at, _id) 游标分页，默认返回最新的 limit 条（按时间正序）；
+    pagination.before 作为 before 参数获取更早的消息，pagination.after 作为 after 参数获取更新的消息。
     """
     print(f"🔍 开始获取消息 - 对话ID: {conversation_id}, 用户: {current_user['username']}")
     
@@ -278,21 +346,30 @@ def get_messages(current_user, conversation_id):
         
         print(f"✅ 找到对话: {conversation.get('title', '未知')}")
         
+        # 分页参数：before 获取更早的一页，after 获取更新的一页，都不传时返回最新的一页
+        limit = min(max(int(request.args.get('limit', MESSAGE_PAGE_SIZE)), 1), MESSAGE_PAGE_MAX)
+        before = request.args.get('before')
+        after = request.args.get('after')
+        try:
+            cursor_key = decode_message_cursor(after or before) if (after or before) else None
+        except ValueError:
+            return jsonify(ApiResponse.error('无效的分页游标')), 400
+        
+        # 本对话尚在写后队列中的消息先落库，刚发送的消息不会漏掉
+        write_behind.flush_key(conversation_id, MESSAGE_FLUSH_TIMEOUT)
+        
         # 获取消息 - 使用ObjectId查询
         messages = []
+        has_more = False
         try:
             print(f"🔍 开始查询消息，conversation_id: {conversation_id}")
-            messages = list(db.messages.find({
-                'conversation_id': ObjectId(conversation_id)
-            }).sort('created_at', 1))
+            messages, has_more = _find_message_page(db, ObjectId(conversation_id), cursor_key, bool(after), limit)
             print(f"🔍 使用ObjectId查询成功，找到 {len(messages)} 条消息")
         except Exception as e:
             print(f"❌ 查询消息失败: {str(e)}")
             print(f"🔍 尝试使用字符串查询...")
             try:
-                messages = list(db.messages.find({
-                    'conversation_id': conversation_id
-                }).sort('created_at', 1))
+                messages, has_more = _find_message_page(db, conversation_id, cursor_key, bool(after), limit)
                 print(f"🔍 字符串查询成功，找到 {len(messages)} 条消息")
             except Exception as e2:
                 print(f"❌ 字符串查询也失败: {str(e2)}")
@@ -301,6 +378,10 @@ def get_messages(current_user, conversation_id):
         
         print(f"🔍 最终获取消息 - 对话ID: {conversation_id}, 找到 {len(messages)} 条消息")
         
+        # 本页首尾消息的游标
+        before_cursor = encode_message_cursor(messages[0]) if messages else before
+        after_cursor = encode_message_cursor(messages[-1]) if messages else after
+        
         # 格式化消息数据
         try:
             for msg in messages:
@@ -320,7 +401,9 @@ def get_messages(current_user, conversation_id):
             print(f"❌ 消息序列化失败: {str(e)}")
             return jsonify(ApiResponse.error(f'消息序列化失败: {str(e)}')), 500
         
-        return jsonify(ApiResponse.success(serialized_messages, "获取消息列表成功"))
+        return jsonify(ApiResponse.cursor_paginated(
+            serialized_messages, limit, before_cursor, after_cursor, has_more, "获取消息列表成功"
+        ))
         
     except Exception as e:
         print(f"❌ 获取消息异常: {str(e)}")
@@ -337,6 +420,7 @@ def send_message(current_user):
     支持同步回复模式
     """
     try:
+        timer = TurnTimer()
         data = request.get_json()
         
         # 验证必需字段
@@ -350,6 +434,7 @@ def send_message(current_user):
         if not ObjectId.is_valid(conversation_id):
             return jsonify(ApiResponse.error('无效的对话ID')), 400
         
+        lookup_started = time.perf_counter()
         db = get_db()
         
         # 验证对话归属
@@ -374,6 +459,7 @@ def send_message(current_user):
             target_name = model['name']
         else:
             return jsonify(ApiResponse.error('无效的对话类型')), 400
+        timer.add('db_lookup', time.perf_counter() - lookup_started)
         
         # 保存用户消息
         user_message = {
@@ -386,14 +472,11 @@ def send_message(current_user):
             'created_at': datetime.now()
         }
         
-        message_result = db.messages.insert_one(user_message)
-        user_message_id = str(message_result.inserted_id)
+        # 消息和对话时间经写后队列批量写入，不阻塞生成
+        user_message_id = str(write_behind.insert('messages', user_message, key=conversation_id))
         
-        # 更新对话时间
-        db.conversations.update_one(
-            {'_id': ObjectId(conversation_id)},
-            {'$set': {'updated_at': datetime.now()}}
-        )
+        # 更新对话时间、计数和最后一条消息预览
+        record_message(conversation_id, user_message)
         
         # 生成AI回复
         try:
@@ -401,19 +484,22 @@ def send_message(current_user):
             
             if conversation.get('type') == 'agent':
                 print(f"🔧 使用智能体: {agent.get('name', '未知')}")
-                ai_response = chat_service.generate_response_sync(
+                result = chat_service.generate_response_sync(
                     conversation_id=conversation_id,
                     agent=agent,
-                    user_message=content
+                    user_message=content,
+                    user_id=current_user['id']
                 )
             else:  # model type
                 print(f"🔧 使用模型: {model.get('name', '未知')}")
-                ai_response = chat_service.generate_model_response_sync(
+                result = chat_service.generate_model_response_sync(
                     conversation_id=conversation_id,
                     model=model,
-                    user_message=content
+                    user_message=content,
+                    user_id=current_user['id']
                 )
             
+            ai_response = result['content']
             print(f"✅ AI回复生成成功，长度: {len(ai_response)}")
             
             # 保存AI回复
@@ -422,13 +508,17 @@ def send_message(current_user):
                 'content': ai_response,
                 'type': 'assistant',
                 'attachments': [],
-                'metadata': {},
+                'metadata': {
+                    'cached': result.get('cached', False),
+                    'semantic_score': result.get('semantic_score'),
+                    'latency': timer.summary(result.get('stats'), ai_response, cached=result.get('cached', False))
+                },
                 'user_id': current_user['id'],
                 'created_at': datetime.now()
             }
             
-            ai_message_result = db.messages.insert_one(ai_message)
-            ai_message_id = str(ai_message_result.inserted_id)
+            ai_message_id = str(write_behind.insert('messages', ai_message, key=conversation_id))
+            record_message(conversation_id, ai_message)
             
             # 记录活动
             try:
@@ -444,12 +534,16 @@ def send_message(current_user):
             response_data = {
                 'user_message_id': user_message_id,
                 'ai_message_id': ai_message_id,
-                'response': ai_response
+                'response': ai_response,
+                'metadata': ai_message['metadata']
             }
             serialized_data = serialize_mongo_data(response_data)
             
             return jsonify(ApiResponse.success(serialized_data, "消息发送成功"))
             
+        except GenerationRejected as e:
+            print(f"⚠️ 生成请求被拒绝: {str(e)}")
+            return too_many_requests(e)
         except Exception as e:
             print(f"❌ 生成AI回复失败: {str(e)}")
             import traceback
@@ -460,17 +554,47 @@ def send_message(current_user):
         print(f"❌ 发送消息失败: {str(e)}")
         return jsonify(ApiResponse.error(str(e))), 400
 
+def _sse_response(body, generation_id: Optional[str] = None) -> Response:
+    """创建SSE响应，响应头 X-Generation-Id 为本次生成的ID（可续传的生成才有）"""
+    response = Response(body, mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['Connection'] = 'keep-alive'
+    response.headers['Access-Control-Allow-Origin'] = '*'
+    response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With, Last-Event-ID'
+    response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
+    response.headers['Access-Control-Allow-Credentials'] = 'true'
+    response.headers['Access-Control-Expose-Headers'] = 'X-Generation-Id'
+    response.headers['X-Accel-Buffering'] = 'no'  # 禁用Nginx缓冲
+    if generation_id:
+        response.headers['X-Generation-Id'] = generation_id
+    return response
+
 @chat_bp.route('/stream', methods=['POST'])
 @token_required
 @handle_exception
 def stream_chat(current_user):
     """
     流式聊天
-    支持实时流式回复，提供更好的用户体验
+    支持实时流式回复，提供更好的用户体验。
+    每一帧带有 id（<生成ID>:<帧序号>），断线后携带 Last-Event-ID 请求头（或请求体 last_event_id）
+    重新请求即可接着上次收到的帧继续输出，不会重新调用模型。
+    请求体 transport 为 socketio 时立即返回生成ID，合并后的分片推送到 Socket.IO 房间 chat_<对话ID>，
+    同一对话的所有标签页/设备共享这一次生成（事件 chat_stream_start/chat_stream_chunk/chat_stream_done）。
     """
     try:
+        timer = TurnTimer()
         data = request.get_json()
         
+        # 断线重连：接入仍在进行的生成或重放已结束的生成
+        last_event_id = request.headers.get('Last-Event-ID') or (data or {}).get('last_event_id')
+        if last_event_id:
+            generation_id, after_seq = parse_event_id(last_event_id)
+            stream = stream_registry.get(generation_id)
+            if not stream or stream.user_id != current_user['id']:
+                return jsonify(ApiResponse.error('生成不存在或已过期，请重新发送')), 404
+            print(f"🔁 续传流式生成: {generation_id}, 从第 {after_seq} 帧之后开始")
+            return _sse_response(stream.subscribe(after_seq), stream.id)
+        
         # 验证必需字段
         required_fields = ['conversation_id', 'content']
         validate_required_fields(data, required_fields)
@@ -480,6 +604,14 @@ def stream_chat(current_user):
         show_thinking = data.get('show_thinking', False)
         model_id = data.get('model_id')
         attachments = data.get('attachments', [])
+        transport = data.get('transport', 'sse')
+        
+        # 房间推送模式
+        websocket = None
+        if transport == 'socketio':
+            websocket = get_websocket_service()
+            if websocket is None:
+                return jsonify(ApiResponse.error('WebSocket服务未启用')), 400
         
         # 处理文件上传
         files = []
@@ -510,6 +642,7 @@ def stream_chat(current_user):
             print(f"❌ 无效的对话ID: {conversation_id}")
             return jsonify(ApiResponse.error('无效的对话ID')), 400
         
+        lookup_started = time.perf_counter()
         db = get_db()
         
         # 验证对话归属
@@ -528,6 +661,16 @@ def stream_chat(current_user):
             print(f"❌ 查询对话失败: {str(e)}")
             return jsonify(ApiResponse.error(f'查询对话失败: {str(e)}')), 500
         
+        # 房间推送模式：确认对话归属后，对话已有进行中的生成时直接返回该生成，不再重复调用模型
+        if websocket is not None:
+            running_id = websocket.get_chat_stream(conversation_id)
+            if running_id:
+                return jsonify(ApiResponse.success({
+                    'generation_id': running_id,
+                    'room': f"chat_{conversation_id}",
+                    'shared': True
+                }, "对话正在生成中，已加入当前生成"))
+        
         # 根据对话类型获取智能体或模型信息
         try:
             if conversation.get('type') == 'agent':
@@ -571,10 +714,22 @@ def stream_chat(current_user):
                 return jsonify(ApiResponse.error('无效的对话类型')), 400
                 
             print(f"✅ 找到目标: {target_name}")
+            timer.add('db_lookup', time.perf_counter() - lookup_started)
         except Exception as e:
             print(f"❌ 查询目标失败: {str(e)}")
             return jsonify(ApiResponse.error(f'查询目标失败: {str(e)}')), 500
         
+        # 准入检查：模型队列已满时在开始输出前直接返回429
+        try:
+            target = agent or model
+            model_name = agent.get('model_name', 'llama2') if agent else model.get('name', 'llama2')
+            server_url = target.get('server_url', 'http://localhost:11434')
+            model_config = get_ollama_service(server_url).get_model_config(model_name)
+            generation_scheduler.check_admission(model_name, model_config.get('max_concurrency'))
+        except GenerationRejected as e:
+            print(f"⚠️ 生成请求被拒绝: {str(e)}")
+            return too_many_requests(e)
+        
         # 注意：前端已经添加了用户消息到聊天框，后端不需要再次保存
         # 直接开始流式生成AI回复
         print(f"✅ 用户消息已在前端显示，开始生成AI回复")
@@ -595,89 +750,160 @@ def stream_chat(current_user):
                 'created_at': datetime.now()
             }
             
-            user_message_result = db.messages.insert_one(user_message)
-            print(f"✅ 用户消息保存成功: {str(user_message_result.inserted_id)}")
+            user_message_id = write_behind.insert('messages', user_message, key=conversation_id)
+            # 更新对话时间、计数和最后一条消息预览
+            record_message(conversation_id, user_message)
+            print(f"✅ 用户消息已提交保存: {str(user_message_id)}")
         except Exception as e:
             print(f"❌ 保存用户消息失败: {str(e)}")
             # 继续执行，不因为保存失败而中断
         
-        # 更新对话时间
-        db.conversations.update_one(
-            {'_id': ObjectId(conversation_id)},
-            {'$set': {'updated_at': datetime.now()}}
-        )
+        def save_ai_message(full_response, truncated=False, latency=None):
+            """保存AI回复，客户端中途断开时标记为截断，latency 为本轮各阶段耗时"""
+            try:
+                ai_message = {
+                    'conversation_id': ObjectId(conversation_id),  # 确保保存为ObjectId类型
+                    'content': full_response,
+                    'type': 'assistant',
+                    'attachments': [],
+                    'metadata': {
+                        'show_thinking': show_thinking,
+                        'model_id': model_id,
+                        'target_name': target_name,
+                        'truncated': truncated,
+                        'latency': latency
+                    },
+                    'user_id': current_user['id'],
+                    'created_at': datetime.now()
+                }
+                
+                ai_message_id = str(write_behind.insert('messages', ai_message, key=conversation_id))
+                record_message(conversation_id, ai_message)
+                print(f"✅ AI消息已提交保存: {ai_message_id}")
+                return ai_message_id
+            except Exception as e:
+                print(f"❌ 保存AI消息失败: {str(e)}")
+                return None
+        
+        def relay(stream, parts, stats):
+            """
+            转发上游分片，按时间窗口和字节数合并为帧，原始分片追加到 parts
+            上游在读取线程中迭代，这里按合并缓冲的到期时间等待，上游停顿时已缓冲的文本也会按时发出；
+            本生成器提前关闭时调用上游登记在 stats['abort'] 的中断函数关闭连接，阻塞在读取上的线程立即返回，
+            上游生成器再由读取线程关闭（生成器只能在迭代它的线程中关闭）
+            """
+            coalescer = ChunkCoalescer()
+            chunks = queue.Queue()
+            stopped = threading.Event()
+            
+            def read():
+                try:
+                    for chunk in stream:
+                        if stopped.is_set():
+                            break
+                        chunks.put(('chunk', chunk))
+                    chunks.put(('end', None))
+                except Exception as e:
+                    chunks.put(('error', e))
+                finally:
+                    if stopped.is_set():
+                        stream.close()
+            
+            reader = threading.Thread(target=read, daemon=True)
+            reader.start()
+            completed = False
+            try:
+                while True:
+                    try:
+                        kind, chunk = chunks.get(timeout=coalescer.timeout())
+                    except queue.Empty:
+                        text = coalescer.flush()
+                        if text:
+                            yield {'chunk': text}
+                        continue
+                    if kind == 'end':
+                        break
+                    if kind == 'error':
+                        raise chunk
+                    timer.first_token()
+                    parts.append(chunk)
+                    text = coalescer.add(chunk)
+                    if text:
+                        yield {'chunk': text}
+                text = coalescer.flush()
+                if text:
+                    yield {'chunk': text}
+                completed = True
+            finally:
+                stopped.set()
+                abort = stats.get('abort')
+                if not completed and abort is not None and reader.is_alive():
+                    abort()
         
         def generate():
             """
             生成流式响应的生成器函数
+            所有客户端断开且未在等待时间内重连时会关闭本生成器，此时关闭上游Ollama流并保存已生成的部分回复
             """
+            parts = []
+            stream = None
+            # 生成统计：读取历史、构建提示词、排队等待耗时和Ollama返回的token数
+            stats = {}
             try:
                 # 流式生成AI回复
-                full_response = ""
                 print(f"🤖 开始流式生成AI回复 - 对话类型: {conversation.get('type')}")
                 
                 if conversation.get('type') == 'agent' and agent:
                     # 智能体对话
                     print(f"🔧 使用智能体: {agent.get('name', '未知')}")
                     try:
-                        for chunk in chat_service.stream_response(
+                        stream = chat_service.stream_response(
                             conversation_id=conversation_id,
                             agent=agent,
-                            user_message=content
-                        ):
-                            full_response += chunk
-                            yield f"data: {json.dumps({'chunk': chunk})}\n\n"
+                            user_message=content,
+                            user_id=current_user['id'],
+                            stats=stats
+                        )
+                        yield from relay(stream, parts, stats)
                     except Exception as e:
                         print(f"❌ 智能体流式生成失败: {str(e)}")
                         error_msg = f"抱歉，智能体 {agent.get('name', '未知')} 暂时无法响应：{str(e)}"
-                        yield f"data: {json.dumps({'chunk': error_msg})}\n\n"
-                        full_response = error_msg
+                        # 已输出的部分回复保留，错误信息追加在后面，保存的内容与客户端看到的一致
+                        if parts:
+                            error_msg = f"\n\n{error_msg}"
+                        yield {'chunk': error_msg}
+                        parts.append(error_msg)
                 elif conversation.get('type') == 'model' and model:
                     # 模型对话
                     print(f"🔧 使用模型: {model.get('name', '未知')}")
                     try:
-                        for chunk in chat_service.stream_model_response(
+                        stream = chat_service.stream_model_response(
                             conversation_id=conversation_id,
                             model=model,
                             user_message=content,
-                            show_thinking=show_thinking
-                        ):
-                            full_response += chunk
-                            yield f"data: {json.dumps({'chunk': chunk})}\n\n"
+                            show_thinking=show_thinking,
+                            user_id=current_user['id'],
+                            stats=stats
+                        )
+                        yield from relay(stream, parts, stats)
                     except Exception as e:
                         print(f"❌ 模型流式生成失败: {str(e)}")
                         error_msg = f"抱歉，模型 {model.get('name', '未知')} 暂时无法响应：{str(e)}"
-                        yield f"data: {json.dumps({'chunk': error_msg})}\n\n"
-                        full_response = error_msg
+                        # 已输出的部分回复保留，错误信息追加在后面，保存的内容与客户端看到的一致
+                        if parts:
+                            error_msg = f"\n\n{error_msg}"
+                        yield {'chunk': error_msg}
+                        parts.append(error_msg)
                 else:
                     error_msg = "抱歉，无法找到有效的智能体或模型"
-                    yield f"data: {json.dumps({'chunk': error_msg})}\n\n"
-                    full_response = error_msg
+                    yield {'chunk': error_msg}
+                    parts[:] = [error_msg]
                 
+                full_response = ''.join(parts)
                 print(f"✅ 流式AI回复生成成功，长度: {len(full_response)}")
                 
                 # 保存完整的AI回复
-                try:
-                    ai_message = {
-                        'conversation_id': ObjectId(conversation_id),  # 确保保存为ObjectId类型
-                        'content': full_response,
-                        'type': 'assistant',
-                        'attachments': [],
-                        'metadata': {
-                            'show_thinking': show_thinking,
-                            'model_id': model_id,
-                            'target_name': target_name
-                        },
-                        'user_id': current_user['id'],
-                        'created_at': datetime.now()
-                    }
-                    
-                    ai_message_result = db.messages.insert_one(ai_message)
-                    ai_message_id = str(ai_message_result.inserted_id)
-                    print(f"✅ AI消息保存成功: {ai_message_id}")
-                except Exception as e:
-                    print(f"❌ 保存AI消息失败: {str(e)}")
-                    ai_message_id = None
+                ai_message_id = save_ai_message(full_response, latency=timer.summary(stats, full_response))
                 
                 # 记录活动
                 try:
@@ -690,26 +916,50 @@ def stream_chat(current_user):
                     print(f"⚠️ 记录活动失败: {str(e)}")
                 
                 # 发送完成信号
-                yield f"data: {json.dumps({'done': True, 'message_id': ai_message_id})}\n\n"
+                yield {'done': True, 'message_id': ai_message_id}
                 
+            except GeneratorExit:
+                # 客户端已断开且未重连，立即停止上游生成，避免继续占用推理资源
+                full_response = ''.join(parts)
+                print(f"⚠️ 客户端断开连接，停止生成 - 对话ID: {conversation_id}, 已生成长度: {len(full_response)}")
+                # 上游流由 relay 的读取线程关闭
+                if full_response:
+                    save_ai_message(full_response, truncated=True, latency=timer.summary(stats, full_response))
+                raise
             except Exception as e:
                 print(f"❌ 流式生成失败: {str(e)}")
                 import traceback
                 traceback.print_exc()
                 error_msg = f"抱歉，生成回复时遇到错误：{str(e)}"
-                yield f"data: {json.dumps({'chunk': error_msg})}\n\n"
-                yield f"data: {json.dumps({'done': True, 'message_id': None, 'error': str(e)})}\n\n"
-        
-        # 创建SSE响应
-        response = Response(generate(), mimetype='text/event-stream')
-        response.headers['Cache-Control'] = 'no-cache'
-        response.headers['Connection'] = 'keep-alive'
-        response.headers['Access-Control-Allow-Origin'] = '*'
-        response.headers['Access-Control-Allow-Headers'] = 'Content-Type, Authorization, X-Requested-With'
-        response.headers['Access-Control-Allow-Methods'] = 'GET, POST, PUT, DELETE, OPTIONS'
-        response.headers['Access-Control-Allow-Credentials'] = 'true'
-        response.headers['X-Accel-Buffering'] = 'no'  # 禁用Nginx缓冲
-        return response
+                yield {'chunk': error_msg}
+                yield {'done': True, 'message_id': None, 'error': str(e)}
+        
+        # 生成在后台执行并写入可续传的缓冲区，当前连接作为第一个订阅者
+        stream = stream_registry.create(current_user['id'], conversation_id)
+        
+        if websocket is not None:
+            # 房间推送模式：没有SSE订阅者，生成一直执行到结束，每帧推送到对话房间
+            if not websocket.start_chat_stream(conversation_id, stream.id):
+                stream.finish()
+                running_id = websocket.get_chat_stream(conversation_id)
+                return jsonify(ApiResponse.success({
+                    'generation_id': running_id,
+                    'room': f"chat_{conversation_id}",
+                    'shared': True
+                }, "对话正在生成中，已加入当前生成"))
+            stream.add_listener(
+                lambda seq, frame: websocket.emit_chat_stream(conversation_id, stream.id, seq, frame)
+            )
+            stream.add_finish_callback(lambda: websocket.end_chat_stream(conversation_id, stream.id))
+            stream_registry.start(stream, generate())
+            return jsonify(ApiResponse.success({
+                'generation_id': stream.id,
+                'room': f"chat_{conversation_id}",
+                'shared': False
+            }, "已开始生成，回复将推送到对话房间"))
+        
+        stream_registry.start(stream, generate())
+        return _sse_response(stream.subscribe(), stream.id)
         
     except Exception as e:
         print(f"❌ 流式聊天异常: {str(e)}")
@@ -717,6 +967,57 @@ def stream_chat(current_user):
         traceback.print_exc()
         return jsonify(ApiResponse.error(f"流式聊天失败: {str(e)}")), 500
 
+@chat_bp.route('/compare', methods=['POST'])
+@token_required
+@handle_exception
+def compare_models(current_user):
+    """
+    多模型对比
+    同一条消息并发发给多个模型，所有模型的输出合并在一个SSE响应中，每帧带 model_id；
+    每个模型结束时发送 metrics（首token延迟、总耗时、tokens/秒），最后一帧汇总所有模型。
+    对比结果不保存到对话，传入 conversation_id 时只用于带上该对话的历史。
+    """
+    data = request.get_json() or {}
+    validate_required_fields(data, ['model_ids', 'content'])
+    
+    if not isinstance(data['model_ids'], list):
+        return jsonify(ApiResponse.error('model_ids 必须是列表')), 400
+    model_ids = list(dict.fromkeys(data['model_ids']))
+    if len(model_ids) > COMPARE_MAX_MODELS:
+        return jsonify(ApiResponse.error(f'最多同时对比 {COMPARE_MAX_MODELS} 个模型')), 400
+    if not all(ObjectId.is_valid(mid) for mid in model_ids):
+        return jsonify(ApiResponse.error('无效的模型ID')), 400
+    
+    db = get_db()
+    
+    conversation_id = data.get('conversation_id')
+    if conversation_id:
+        if not ObjectId.is_valid(conversation_id) or not db.conversations.find_one(
+                {'_id': ObjectId(conversation_id), 'user_id': current_user['id']}, {'_id': 1}):
+            return jsonify(ApiResponse.error('对话不存在')), 404
+    
+    found = {str(m['_id']): m for m in db.models.find({'_id': {'$in': [ObjectId(mid) for mid in model_ids]}})}
+    missing = [mid for mid in model_ids if mid not in found]
+    if missing:
+        return jsonify(ApiResponse.error(f"模型不存在: {', '.join(missing)}")), 404
+    models = [found[mid] for mid in model_ids]
+    
+    # 准入检查：任一模型队列已满时直接返回429
+    for model in models:
+        model_name = model.get('name', 'llama2')
+        config = get_ollama_service(model.get('server_url', 'http://localhost:11434')).get_model_config(model_name)
+        generation_scheduler.check_admission(model_name, config.get('max_concurrency'))
+    
+    print(f"🔀 多模型对比 - 模型: {[m.get('name') for m in models]}, 内容: {data['content'][:50]}...")
+    
+    def generate():
+        for event in compare_stream(models, data['content'], conversation_id,
+                                    show_thinking=data.get('show_thinking', False),
+                                    user_id=current_user['id']):
+            yield sse_frame(event)
+    
+    return _sse_response(generate())
+
 @chat_bp.route('/conversations/<conversation_id>', methods=['PUT'])
 @token_required
 @handle_exception
@@ -849,6 +1150,10 @@ def delete_conversation(current_user, conversation_id):
         
         print(f"✅ 找到对话: {conversation.get('title', '未知')}")
         
+        # 等待本对话排队中的写入落库后再删除，避免删除后才写入的消息成为孤儿数据
+        if not write_behind.flush_key(conversation_id, MESSAGE_FLUSH_TIMEOUT):
+            print(f"⚠️ 对话 {conversation_id} 的排队写入未在 {MESSAGE_FLUSH_TIMEOUT} 秒内落库")
+        
         # 先删除消息，再删除对话
         try:
             start_time = time.time()
@@ -1,6 +1,8 @@
 from flask import Blueprint, jsonify, request
 from app.services.database import get_db
+from app.services.name_cache import name_cache
 from app.utils.auth import token_required
+from app.utils.latency import LATENCY_BUCKETS, LATENCY_BUCKET_LABELS
 from app.utils.response import ApiResponse, handle_exception
 from datetime import datetime, timedelta
 from bson import ObjectId
@@ -98,12 +100,12 @@ def get_dashboard_analytics(current_user):
             dates.append(date)
             values.append(daily_stats.get(date, 0))
         
-        # 获取智能体使用统计
+        # 获取智能体使用统计（名称批量解析）
+        agent_names = name_cache.resolve(db, 'agents', [conv['agent_id'] for conv in conversations if conv.get('agent_id')])
         agent_stats = {}
         for conv in conversations:
             if conv.get('agent_id'):
-                agent = db.agents.find_one({'_id': conv['agent_id']})
-                agent_name = agent['name'] if agent else '未知智能体'
+                agent_name = agent_names.get(str(conv['agent_id'])) or '未知智能体'
                 if agent_name not in agent_stats:
                     agent_stats[agent_name] = 0
                 agent_stats[agent_name] += 1
@@ -113,28 +115,57 @@ def get_dashboard_analytics(current_user):
         for name, count in agent_stats.items():
             agent_usage.append({'name': name, 'value': count})
         
-        # 获取消息统计
+        # 获取消息统计（对话上维护的计数）
         total_messages = 0
+        user_messages = 0
+        assistant_messages = 0
         for conv in conversations:
             total_messages += conv.get('message_count', 0)
+            user_messages += conv.get('user_message_count', 0)
+            assistant_messages += conv.get('assistant_message_count', 0)
         
-        # 消息类型分布（模拟数据）
+        # 消息类型分布
         message_types = [
-            {'name': '用户消息', 'value': int(total_messages * 0.6)},
-            {'name': 'AI回复', 'value': int(total_messages * 0.4)}
+            {'name': '用户消息', 'value': user_messages},
+            {'name': 'AI回复', 'value': assistant_messages}
         ]
         
-        # 响应时间分析（模拟数据）
+        # 响应时间分析（AI消息 metadata.latency 中记录的单轮耗时）
+        latency_buckets = {b['_id']: b for b in db.messages.aggregate([
+            {'$match': {
+                'user_id': current_user['id'],
+                'type': 'assistant',
+                'created_at': {'$gte': start_date},
+                'metadata.latency.total_ms': {'$exists': True}
+            }},
+            {'$bucket': {
+                'groupBy': '$metadata.latency.total_ms',
+                'boundaries': LATENCY_BUCKETS,
+                'default': 'overflow',
+                'output': {
+                    'count': {'$sum': 1},
+                    'total_ms': {'$sum': '$metadata.latency.total_ms'},
+                    'ttft_ms': {'$sum': '$metadata.latency.ttft_ms'}
+                }
+            }}
+        ])}
+        # 最后一个区间没有上限，落在 default 分组
+        bucket_keys = LATENCY_BUCKETS[:-1] + ['overflow']
+        counts = [latency_buckets.get(key, {}).get('count', 0) for key in bucket_keys]
+        timed_messages = sum(counts)
+        total_ms = sum(b.get('total_ms', 0) for b in latency_buckets.values())
+        ttft_ms = sum(b.get('ttft_ms', 0) for b in latency_buckets.values())
         response_times = {
-            'ranges': ['0-1s', '1-2s', '2-3s', '3-5s', '5s+'],
-            'counts': [45, 30, 15, 8, 2]
+            'ranges': LATENCY_BUCKET_LABELS,
+            'counts': counts
         }
         
         analytics = {
             'total_conversations': len(conversations),
             'active_agents': len(agent_stats),
             'total_messages': total_messages,
-            'avg_response_time': 2.3,
+            'avg_response_time': round(total_ms / timed_messages / 1000, 2) if timed_messages else 0,
+            'avg_first_token_time': round(ttft_ms / timed_messages / 1000, 2) if timed_messages else 0,
             'conversation_trend': {
                 'dates': dates,
                 'values': values
@@ -298,8 +329,8 @@ def check_ollama_health(current_user):
         # 获取Ollama服务器地址，优先使用请求参数，否则使用用户配置
         server_url = request.args.get('server_url', default_ollama_url)
         
-        from app.services.ollama import OllamaService
-        ollama_service = OllamaService(server_url)
+        from app.services.ollama import get_ollama_service
+        ollama_service = get_ollama_service(server_url)
         ollama_status = 'healthy' if ollama_service.health_check() else 'unhealthy'
         
         print(f"✅ Ollama服务状态: {ollama_status}")
@@ -1,12 +1,19 @@
 from flask import Blueprint, request, jsonify
 from app.services.database import get_db
+from app.services.knowledge_service import KnowledgeService
+from app.services.document_ingestion import document_ingestion, detect_file_type, KNOWLEDGE_UPLOAD_DIR, SUPPORTED_EXTENSIONS
+from app.services.embedding_store import embedding_store
 from app.utils.auth import token_required
 from app.utils.response import ApiResponse, handle_exception, validate_required_fields, serialize_mongo_data
 from bson import ObjectId
 from datetime import datetime
+import os
 
 knowledge_bp = Blueprint('knowledge', __name__)
 
+# 初始化知识库服务
+knowledge_service = KnowledgeService()
+
 @knowledge_bp.route('', methods=['GET'])
 @knowledge_bp.route('/', methods=['GET'])
 @token_required
@@ -126,6 +133,8 @@ def create_knowledge_base(current_user):
             'name': data['name'],
             'description': data['description'],
             'type': data.get('type', 'general'),
+            'vector_dimension': data.get('vector_dimension', 384),
+            'similarity_threshold': data.get('similarity_threshold', 0.7),
             'status': 'active',
             'created_at': datetime.now(),
             'updated_at': datetime.now()
@@ -196,6 +205,8 @@ def update_knowledge_base(current_user, kb_id):
             update_data['type'] = data['type']
         if 'status' in data:
             update_data['status'] = data['status']
+        if 'similarity_threshold' in data:
+            update_data['similarity_threshold'] = data['similarity_threshold']
         
         db.knowledge_bases.update_one(
             {'_id': ObjectId(kb_id)},
@@ -231,9 +242,10 @@ def delete_knowledge_base(current_user, kb_id):
         if not kb:
             return jsonify(ApiResponse.error('知识库不存在')), 404
         
-        # 删除知识库和所有相关文档
+        # 删除知识库和所有相关文档、分块和向量索引
         db.knowledge_bases.delete_one({'_id': ObjectId(kb_id)})
         db.documents.delete_many({'knowledge_base_id': kb_id})
+        knowledge_service.drop_index(kb_id)
         
         print(f"✅ 知识库删除成功: {kb_id}")
         
@@ -327,19 +339,40 @@ def upload_document(current_user, kb_id):
         if file.filename == '':
             return jsonify(ApiResponse.error('没有选择文件')), 400
         
-        # 保存文档数据
+        file_type = detect_file_type(file.filename)
+        if not file_type:
+            return jsonify(ApiResponse.error(f"不支持的文件类型，支持: {', '.join(SUPPORTED_EXTENSIONS)}")), 400
+        
+        # 保存文档数据，文件保存后由后台任务解析、分块和向量化
+        doc_id = ObjectId()
+        file_dir = os.path.join(KNOWLEDGE_UPLOAD_DIR, kb_id)
+        os.makedirs(file_dir, exist_ok=True)
+        file_path = os.path.join(file_dir, f"{doc_id}{os.path.splitext(file.filename)[1].lower()}")
+        file.save(file_path)
+        
         doc_data = {
+            '_id': doc_id,
             'knowledge_base_id': kb_id,
             'name': file.filename,
             'type': file.content_type,
-            'size': 0,  # 实际大小需要计算
-            'status': 'processing',
+            'file_type': file_type,
+            'file_path': file_path,
+            'size': os.path.getsize(file_path),
+            'status': 'queued',
+            'user_id': current_user['id'],
+            'is_active': True,
             'created_at': datetime.now(),
             'updated_at': datetime.now()
         }
         
-        result = db.documents.insert_one(doc_data)
-        doc_data['id'] = str(result.inserted_id)
+        db.documents.insert_one(doc_data)
+        db.knowledge_bases.update_one(
+            {'_id': ObjectId(kb_id)},
+            {'$inc': {'document_count': 1}, '$set': {'updated_at': datetime.now()}}
+        )
+        document_ingestion.submit(doc_id)
+        doc_data['id'] = str(doc_data.pop('_id'))
+        doc_data.pop('file_path')
         
         # 格式化时间
         doc_data['created_at'] = doc_data['created_at'].isoformat()
@@ -374,20 +407,100 @@ def rebuild_index(current_user, kb_id):
         if not kb:
             return jsonify(ApiResponse.error('知识库不存在')), 404
         
-        # 这里应该实现重建索引的逻辑
-        # 1. 获取知识库中的所有文档
-        # 2. 重新处理文档内容
-        # 3. 更新索引
-        # 4. 更新知识库状态
+        # 按已保存的分块文本重新生成向量
+        chunk_count = knowledge_service.rebuild_index(kb_id)
+        db.knowledge_bases.update_one(
+            {'_id': ObjectId(kb_id)},
+            {'$set': {'indexed_at': datetime.now(), 'updated_at': datetime.now()}}
+        )
         
-        print(f"✅ 索引重建成功: {kb_id}")
+        print(f"✅ 索引重建成功: {kb_id}, 分块数: {chunk_count}")
         
-        return jsonify(ApiResponse.success(None, "索引重建成功"))
+        return jsonify(ApiResponse.success({'chunk_count': chunk_count}, "索引重建成功"))
         
     except Exception as e:
         print(f"❌ 重建索引失败: {str(e)}")
         return jsonify(ApiResponse.error(str(e))), 400
 
+@knowledge_bp.route('/ingestion/stats', methods=['GET'])
+@token_required
+@handle_exception
+def get_ingestion_stats(current_user):
+    """获取文档入库的累计吞吐（pages/sec、chunks/sec）和分块向量存储的命中率"""
+    stats = document_ingestion.get_stats()
+    stats['embedding_store'] = embedding_store.get_stats()
+    return jsonify(ApiResponse.success(stats, "获取入库统计成功"))
+
+@knowledge_bp.route('/<kb_id>/documents/<doc_id>/reingest', methods=['POST'])
+@token_required
+@handle_exception
+def reingest_document(current_user, kb_id, doc_id):
+    """重新解析和向量化文档（入库失败后重试），入库进行中的文档返回409"""
+    try:
+        if not ObjectId.is_valid(kb_id) or not ObjectId.is_valid(doc_id):
+            return jsonify(ApiResponse.error('无效的ID')), 400
+        
+        db = get_db()
+        
+        doc = db.documents.find_one({
+            '_id': ObjectId(doc_id),
+            'knowledge_base_id': kb_id,
+            'user_id': current_user['id']
+        })
+        
+        if not doc or not doc.get('file_path'):
+            return jsonify(ApiResponse.error('文档不存在')), 404
+        
+        # 条件更新，并发请求中只有一个能把文档重新入队，避免两个任务同时处理同一文档产生重复分块
+        result = db.documents.update_one(
+            {'_id': ObjectId(doc_id), 'status': {'$in': ['failed', 'ready']}},
+            {'$set': {'status': 'queued', 'error': None, 'updated_at': datetime.now()}}
+        )
+        if result.modified_count == 0:
+            return jsonify(ApiResponse.error('文档正在入库中，请稍后再试')), 409
+        document_ingestion.submit(doc_id)
+        
+        return jsonify(ApiResponse.success({'id': doc_id, 'status': 'queued'}, "文档已重新加入入库队列"))
+        
+    except Exception as e:
+        print(f"❌ 重新入库失败: {str(e)}")
+        return jsonify(ApiResponse.error(str(e))), 400
+
+@knowledge_bp.route('/<kb_id>/search', methods=['POST'])
+@token_required
+@handle_exception
+def search_knowledge(current_user, kb_id):
+    """
+    在知识库中检索与查询最相关的分块
+    mode 为 hybrid（默认，关键词与向量RRF融合）、vector（相似度分数）或 keyword（BM25分数），
+    rerank 为 true 时用交叉编码器重排，budgets_ms 覆盖各阶段耗时预算
+    """
+    try:
+        data = request.get_json()
+        validate_required_fields(data, ['query'])
+        limit = min(max(int(data.get('limit', 5)), 1), 50)
+        mode = data.get('mode', 'hybrid')
+        if mode not in ('hybrid', 'vector', 'keyword'):
+            return jsonify(ApiResponse.error('无效的检索模式')), 400
+        options = {key: data[key] for key in ('rerank', 'candidates', 'rerank_top_n', 'budgets_ms') if key in data}
+        
+        timings = {}
+        results = knowledge_service.search_knowledge(
+            kb_id, current_user['id'], data['query'], limit, mode, options=options, timings=timings
+        )
+        
+        print(f"✅ 知识库检索完成: {kb_id}, 结果数: {len(results)}, 耗时: {timings.get('total_ms')}ms")
+        
+        return jsonify(ApiResponse.success({
+            'results': serialize_mongo_data(results),
+            'took_ms': timings.get('total_ms'),
+            'timings': timings
+        }, "检索成功"))
+        
+    except Exception as e:
+        print(f"❌ 知识库检索失败: {str(e)}")
+        return jsonify(ApiResponse.error(str(e))), 400
+
 @knowledge_bp.route('/<kb_id>/documents/<doc_id>', methods=['DELETE'])
 @token_required
 @handle_exception
@@ -418,8 +531,16 @@ def delete_document(current_user, kb_id, doc_id):
         if not doc:
             return jsonify(ApiResponse.error('文档不存在')), 404
         
-        # 删除文档
+        # 删除文档及其分块、向量和上传的文件
         db.documents.delete_one({'_id': ObjectId(doc_id)})
+        knowledge_service.remove_document_chunks(kb_id, doc_id)
+        db.knowledge_bases.update_one(
+            {'_id': ObjectId(kb_id)},
+            {'$inc': {'document_count': -1, 'total_tokens': -doc.get('token_count', 0)},
+             '$set': {'updated_at': datetime.now()}}
+        )
+        if doc.get('file_path') and os.path.exists(doc['file_path']):
+            os.remove(doc['file_path'])
         
         print(f"✅ 文档删除成功: {doc_id}")
         
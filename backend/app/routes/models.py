@@ -3,9 +3,15 @@
 
 from flask import Blueprint, request, jsonify
 from app.services.database import get_db
-from app.services.ollama import OllamaService
+from app.services.ollama import get_ollama_service, invalidate_model_config, get_model_config_cache_stats
+from app.services.response_cache import response_cache
+from app.services.semantic_cache import semantic_cache
+from app.services.name_cache import name_cache
+from app.services.ollama_pool import backend_pool
+from app.services.single_flight import single_flight
+from app.services.generation_scheduler import generation_scheduler, GenerationRejected, PRIORITY_BATCH
 from app.utils.auth import token_required
-from app.utils.response import ApiResponse, handle_exception, validate_pagination, validate_required_fields, sanitize_data, serialize_mongo_data
+from app.utils.response import ApiResponse, handle_exception, too_many_requests, validate_pagination, validate_required_fields, sanitize_data, serialize_mongo_data
 from bson import ObjectId
 from datetime import datetime
 import json
@@ -13,6 +19,24 @@ import json
 # 创建模型蓝图
 models_bp = Blueprint('models', __name__)
 
+def _invalidate_model_caches(db, model_id: str, names: list):
+    """
+    模型变更或删除后清除相关缓存：各名称的模型配置和响应缓存、名称缓存，
+    以及使用该模型的智能体的语义缓存（按 model_name/model 名称或 model_id 关联）
+    """
+    names = [name for name in dict.fromkeys(names) if name]
+    for name in names:
+        invalidate_model_config(name)
+        response_cache.invalidate_model(name)
+    name_cache.invalidate('models', model_id)
+    agents = db.agents.find({'$or': [
+        {'model_name': {'$in': names}},
+        {'model': {'$in': names}},
+        {'model_id': {'$in': [model_id, ObjectId(model_id)]}}
+    ]}, {'_id': 1})
+    for agent in agents:
+        semantic_cache.invalidate_agent(str(agent['_id']))
+
 @models_bp.route('', methods=['GET'])
 @models_bp.route('/', methods=['GET'])
 @token_required
@@ -177,6 +201,8 @@ def create_model(current_user):
         'version': data.get('version', '1.0.0'),
         'api_key': data.get('api_key', ''),
         'server_url': data.get('server_url', ''),  # 保持与前端一致的字段名
+        'server_urls': data.get('server_urls', []),  # 额外的Ollama服务器，与server_url组成后端池
+        'max_concurrency': data.get('max_concurrency'),  # 最大并发生成数，为空时使用全局默认值
         'max_tokens': data.get('max_tokens', 4096),
         'temperature': data.get('temperature', 0.7),
         'top_p': data.get('top_p', 1.0),
@@ -201,6 +227,7 @@ def create_model(current_user):
     
     # 插入数据库
     result = db.models.insert_one(model_data)
+    invalidate_model_config(model_data['name'])
     
     # 重新获取插入的数据，确保所有字段都正确格式化
     inserted_model = db.models.find_one({'_id': result.inserted_id})
@@ -269,8 +296,8 @@ def update_model(current_user, model_id):
     
     # 只更新提供的字段
     allowed_fields = [
-        'name', 'description', 'version', 'api_key', 'server_url',
-        'max_tokens', 'temperature', 'top_p', 'frequency_penalty',
+        'name', 'description', 'version', 'api_key', 'server_url', 'server_urls',
+        'max_concurrency', 'max_tokens', 'temperature', 'top_p', 'frequency_penalty',
         'presence_penalty', 'parameters', 'settings', 'metadata',
         'is_active', 'status'
     ]
@@ -287,6 +314,9 @@ def update_model(current_user, model_id):
         {'$set': update_data}
     )
     
+    # 模型配置已变更，清除旧名称和新名称对应的缓存
+    _invalidate_model_caches(db, model_id, [existing_model['name'], update_data.get('name')])
+    
     if result.modified_count > 0:
         print(f"✅ 模型更新成功: {model_id}")
         return jsonify(ApiResponse.success(None, "模型更新成功"))
@@ -318,6 +348,7 @@ def delete_model(current_user, model_id):
     
     # 执行删除
     result = db.models.delete_one({'_id': ObjectId(model_id)})
+    _invalidate_model_caches(db, model_id, [existing_model['name']])
     
     if result.deleted_count > 0:
         print(f"✅ 模型删除成功: {model_id}")
@@ -358,20 +389,24 @@ def test_model(current_user, model_id):
             
             print(f"🔧 使用Ollama测试 - 服务器: {server_url}, 模型: {model_name}")
             
-            ollama_service = OllamaService(server_url)
-            response = ollama_service.generate_text(
-                model_name=model_name,
-                prompt=message,
+            ollama_service = get_ollama_service(server_url)
+            result = ollama_service.generate(
+                model_name,
+                message,
                 temperature=model.get('temperature', 0.7),
-                max_tokens=model.get('max_tokens', 1000)
+                max_tokens=model.get('max_tokens', 1000),
+                use_cache=data.get('use_cache', model.get('parameters', {}).get('response_cache', False)),
+                priority=PRIORITY_BATCH,
+                user_id=current_user['id']
             )
             
             print(f"✅ Ollama模型测试成功")
             return jsonify(ApiResponse.success({
                 'success': True,
-                'response': response,
+                'response': result.get('content', ''),
                 'model_name': model_name,
-                'provider': 'ollama'
+                'provider': 'ollama',
+                'metadata': {'cached': result.get('cached', False)}
             }, "模型测试成功"))
         else:
             # 其他提供商的测试逻辑
@@ -383,6 +418,9 @@ def test_model(current_user, model_id):
                 'provider': model.get('provider')
             }, "模型测试成功"))
             
+    except GenerationRejected as e:
+        print(f"⚠️ 模型测试请求被拒绝: {str(e)}")
+        return too_many_requests(e)
     except Exception as e:
         print(f"❌ 模型测试失败: {str(e)}")
         return jsonify(ApiResponse.success({
@@ -420,6 +458,39 @@ def get_model_types(current_user):
     ]
     return jsonify(ApiResponse.success(types, "获取模型类型列表成功"))
 
+@models_bp.route('/cache/stats', methods=['GET'])
+@token_required
+@handle_exception
+def get_cache_stats(current_user):
+    """
+    获取模型相关缓存的命中统计和请求合并统计
+    """
+    return jsonify(ApiResponse.success({
+        'model_config': get_model_config_cache_stats(),
+        'response': response_cache.get_stats(),
+        'semantic': semantic_cache.get_stats(),
+        'coalescing': single_flight.get_stats(),
+        'names': name_cache.get_stats()
+    }, "获取缓存统计成功"))
+
+@models_bp.route('/ollama/backends', methods=['GET'])
+@token_required
+@handle_exception
+def get_ollama_backends(current_user):
+    """
+    获取Ollama后端池状态
+    """
+    return jsonify(ApiResponse.success(backend_pool.get_stats(), "获取后端池状态成功"))
+
+@models_bp.route('/scheduler/stats', methods=['GET'])
+@token_required
+@handle_exception
+def get_scheduler_stats(current_user):
+    """
+    获取生成调度器的并发、排队和拒绝统计
+    """
+    return jsonify(ApiResponse.success(generation_scheduler.get_stats(), "获取调度统计成功"))
+
 @models_bp.route('/ollama/health', methods=['GET'])
 @token_required
 @handle_exception
@@ -427,8 +498,6 @@ def check_ollama_health(current_user):
     """
     检查Ollama服务器状态
     """
-    from app.services.ollama import OllamaService
-    
     # 获取用户配置中的Ollama地址
     db = get_db()
     default_ollama_url = 'http://localhost:11434'
@@ -448,7 +517,7 @@ def check_ollama_health(current_user):
     print(f"🔍 检查Ollama健康状态: {server_url}")
     
     try:
-        ollama_service = OllamaService(server_url)
+        ollama_service = get_ollama_service(server_url)
         is_healthy = ollama_service.health_check()
         
         print(f"🏥 Ollama健康检查结果: {is_healthy}")
@@ -468,8 +537,6 @@ def get_ollama_models(current_user):
     """
     获取Ollama可用模型列表
     """
-    from app.services.ollama import OllamaService
-    
     # 获取用户配置中的Ollama地址
     db = get_db()
     default_ollama_url = 'http://localhost:11434'
@@ -489,7 +556,7 @@ def get_ollama_models(current_user):
     print(f"📋 获取Ollama模型列表: {server_url}")
     
     try:
-        ollama_service = OllamaService(server_url)
+        ollama_service = get_ollama_service(server_url)
         models = ollama_service.list_models()
         
         # OllamaService现在直接返回模型名称列表
@@ -535,8 +602,7 @@ def pull_ollama_model(current_user):
     print(f"📥 拉取Ollama模型: {model_name} from {server_url}")
     
     try:
-        from app.services.ollama import OllamaService
-        ollama_service = OllamaService(server_url)
+        ollama_service = get_ollama_service(server_url)
         
         result = ollama_service.pull_model(model_name)
         
@@ -581,19 +647,30 @@ def test_ollama_model(current_user):
     print(f"🧪 测试Ollama模型: {model_name} with prompt: {prompt[:50]}...")
     
     try:
-        from app.services.ollama import OllamaService
-        ollama_service = OllamaService(server_url)
+        ollama_service = get_ollama_service(server_url)
         
-        result = ollama_service.generate_text(model_name, prompt)
+        result = ollama_service.generate(
+            model_name,
+            prompt,
+            temperature=data.get('temperature', 0.7),
+            max_tokens=1000,
+            use_cache=data.get('use_cache', False),
+            priority=PRIORITY_BATCH,
+            user_id=current_user['id']
+        )
         
         print(f"✅ 模型测试成功: {model_name}")
         
         return jsonify(ApiResponse.success({
             'success': True,
-            'response': result,
+            'response': result.get('content', ''),
             'model_name': model_name,
-            'provider': 'ollama'
+            'provider': 'ollama',
+            'metadata': {'cached': result.get('cached', False)}
         }, "模型测试成功"))
+    except GenerationRejected as e:
+        print(f"⚠️ 模型测试请求被拒绝: {str(e)}")
+        return too_many_requests(e)
     except Exception as e:
         print(f"❌ 模型测试失败: {str(e)}")
         return jsonify(ApiResponse.success({
@@ -1,11 +1,12 @@
 """
 活动服务模块
-记录用户活动日志
+记录用户活动日志，写入经写后队列批量完成，不占用请求时间
 """
 
 from datetime import datetime
 from typing import Dict, Any
 from app.services.database import get_db
+from app.services.write_behind import write_behind
 
 class ActivityService:
     def __init__(self):
@@ -16,7 +17,6 @@ class ActivityService:
         记录对话开始活动
         """
         try:
-            db = get_db()
             activity = {
                 'user_id': user_id,
                 'type': 'conversation_started',
@@ -28,7 +28,7 @@ class ActivityService:
                 },
                 'created_at': datetime.now()
             }
-            db.activities.insert_one(activity)
+            write_behind.insert('activities', activity)
         except Exception as e:
             print(f"记录活动失败: {e}")
     
@@ -37,7 +37,6 @@ class ActivityService:
         记录智能体创建活动
         """
         try:
-            db = get_db()
             activity = {
                 'user_id': user_id,
                 'type': 'agent_created',
@@ -49,7 +48,7 @@ class ActivityService:
                 },
                 'created_at': datetime.now()
             }
-            db.activities.insert_one(activity)
+            write_behind.insert('activities', activity)
         except Exception as e:
             print(f"记录活动失败: {e}")
     
@@ -58,7 +57,6 @@ class ActivityService:
         记录知识库更新活动
         """
         try:
-            db = get_db()
             activity = {
                 'user_id': user_id,
                 'type': 'knowledge_updated',
@@ -70,7 +68,7 @@ class ActivityService:
                 },
                 'created_at': datetime.now()
             }
-            db.activities.insert_one(activity)
+            write_behind.insert('activities', activity)
         except Exception as e:
             print(f"记录活动失败: {e}")
     
@@ -79,7 +77,6 @@ class ActivityService:
         记录插件安装活动
         """
         try:
-            db = get_db()
             activity = {
                 'user_id': user_id,
                 'type': 'plugin_installed',
@@ -91,7 +88,7 @@ class ActivityService:
                 },
                 'created_at': datetime.now()
             }
-            db.activities.insert_one(activity)
+            write_behind.insert('activities', activity)
         except Exception as e:
             print(f"记录活动失败: {e}")
     
@@ -0,0 +1,275 @@
+"""
+知识库关键词索引模块
+每个知识库一个进程内 BM25 倒排索引，文档为分块（ID与向量索引共用 vector_id）。
+中日韩文字按字二元组（bigram）切分，拉丁字母和数字按单词切分；
+倒排表用 array 存储差分编码的分块ID和词频，查询时用 numpy 批量解码和打分。
+"""
+
+import os
+import re
+import math
+import threading
+from array import array
+from collections import OrderedDict, Counter
+from typing import Dict, List, Tuple, Iterable, Callable
+
+try:
+    import numpy as np
+    BM25_AVAILABLE = True
+except ImportError:
+    np = None
+    BM25_AVAILABLE = False
+
+# BM25 配置
+BM25_K1 = float(os.environ.get('BM25_K1', 1.2))  # 词频饱和参数
+BM25_B = float(os.environ.get('BM25_B', 0.75))  # 文档长度归一化参数
+BM25_MAX_LOADED = int(os.environ.get('BM25_MAX_LOADED', 50))  # 内存中最多保留的知识库索引数
+BM25_COMPACT_RATIO = float(os.environ.get('BM25_COMPACT_RATIO', 0.2))  # 已删除分块占比超过该值时压缩倒排表
+
+# 中日韩文字（假名、汉字、兼容汉字、谚文）连续片段，或拉丁字母/数字组成的单词；
+# 不含CJK标点和全角空格（U+3000-U+303F），标点处断开，二元组不跨句
+_TOKEN_PATTERN = re.compile(r'[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff]+|[a-z0-9]+')
+_CJK_START = '\u3040'
+_MAX_TF = 65535
+
+
+def tokenize(text: str) -> List[str]:
+    """切分为检索词：中日韩片段取相邻两字（单字片段保留单字），英文数字转小写按单词"""
+    tokens = []
+    for match in _TOKEN_PATTERN.finditer((text or '').lower()):
+        run = match.group()
+        if run[0] >= _CJK_START and len(run) > 1:
+            tokens.extend(run[i:i + 2] for i in range(len(run) - 1))
+        else:
+            tokens.append(run)
+    return tokens
+
+
+class _Postings:
+    """单个词的倒排表：分块ID差分编码，last_id 为最后一个分块的ID"""
+
+    __slots__ = ('deltas', 'tfs', 'last_id')
+
+    def __init__(self):
+        self.deltas = array('I')
+        self.tfs = array('H')
+        self.last_id = 0
+
+    def append(self, doc_id: int, tf: int):
+        if self.deltas and doc_id <= self.last_id:
+            self._insert(doc_id, tf)
+            return
+        self.deltas.append(doc_id - self.last_id)
+        self.tfs.append(min(tf, _MAX_TF))
+        self.last_id = doc_id
+
+    def doc_ids(self) -> 'np.ndarray':
+        return np.frombuffer(self.deltas, dtype=np.uint32).cumsum(dtype=np.int64)
+
+    def _insert(self, doc_id: int, tf: int):
+        """分块ID小于已有ID时（重建顺序不同）解码后重新编码"""
+        ids = self.doc_ids().tolist()
+        tfs = self.tfs.tolist()
+        position = next(i for i, existing in enumerate(ids) if existing >= doc_id)
+        if ids[position] == doc_id:
+            return
+        ids.insert(position, doc_id)
+        tfs.insert(position, min(tf, _MAX_TF))
+        self.rebuild(ids, tfs)
+
+    def rebuild(self, ids: List[int], tfs: List[int]):
+        self.deltas = array('I', [ids[0]] + [b - a for a, b in zip(ids, ids[1:])]) if ids else array('I')
+        self.tfs = array('H', tfs)
+        self.last_id = ids[-1] if ids else 0
+
+
+class KnowledgeBM25Index:
+    """单个知识库的 BM25 索引"""
+
+    def __init__(self, knowledge_base_id: str):
+        self.knowledge_base_id = knowledge_base_id
+        self.postings: Dict[str, _Postings] = {}
+        # 按分块ID索引的文档长度，0 表示不存在或已删除
+        self.doc_lengths = array('I')
+        self.doc_count = 0
+        self.total_length = 0
+        self.deleted = 0
+        self._lock = threading.Lock()
+
+    def add(self, doc_id: int, text: str):
+        """写入分块，已存在的分块忽略"""
+        tokens = tokenize(text)
+        if not tokens:
+            return
+        with self._lock:
+            if doc_id < len(self.doc_lengths) and self.doc_lengths[doc_id]:
+                return
+            if doc_id >= len(self.doc_lengths):
+                self.doc_lengths.extend([0] * (doc_id + 1 - len(self.doc_lengths)))
+            for term, tf in Counter(tokens).items():
+                postings = self.postings.get(term)
+                if postings is None:
+                    postings = self.postings[term] = _Postings()
+                postings.append(doc_id, tf)
+            self.doc_lengths[doc_id] = len(tokens)
+            self.doc_count += 1
+            self.total_length += len(tokens)
+
+    def remove(self, doc_ids: Iterable[int]) -> int:
+        """删除分块：文档长度置0，倒排表中的条目在压缩时清除"""
+        removed = 0
+        with self._lock:
+            for doc_id in doc_ids:
+                if doc_id < len(self.doc_lengths) and self.doc_lengths[doc_id]:
+                    self.total_length -= self.doc_lengths[doc_id]
+                    self.doc_lengths[doc_id] = 0
+                    self.doc_count -= 1
+                    removed += 1
+            self.deleted += removed
+            if self.deleted > BM25_COMPACT_RATIO * max(self.doc_count, 1):
+                self._compact()
+        return removed
+
+    def _compact(self):
+        """清除倒排表中已删除的分块"""
+        lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32)
+        for term in list(self.postings):
+            postings = self.postings[term]
+            ids = postings.doc_ids()
+            keep = lengths[ids] > 0
+            if keep.all():
+                continue
+            if not keep.any():
+                del self.postings[term]
+                continue
+            postings.rebuild(ids[keep].tolist(), np.frombuffer(postings.tfs, dtype=np.uint16)[keep].tolist())
+        del lengths
+        self.deleted = 0
+
+    def search(self, query: str, k: int) -> List[Tuple[int, float]]:
+        """
+        BM25 检索
+
+        Returns:
+            list: (vector_id, BM25分数) 列表，按分数降序
+        """
+        terms = Counter(tokenize(query))
+        if not terms or k <= 0:
+            return []
+        with self._lock:
+            if self.doc_count == 0:
+                return []
+            lengths = np.frombuffer(self.doc_lengths, dtype=np.uint32)
+            avg_length = self.total_length / self.doc_count
+            scores = np.zeros(len(lengths), dtype=np.float32)
+            for term, query_tf in terms.items():
+                postings = self.postings.get(term)
+                if postings is None:
+                    continue
+                ids = postings.doc_ids()
+                tfs = np.frombuffer(postings.tfs, dtype=np.uint16).astype(np.float32)
+                doc_lengths = lengths[ids].astype(np.float32)
+                # 文档频率只计未删除的分块，否则删除较多时常见词的 idf 为负
+                df = int(np.count_nonzero(doc_lengths))
+                if df == 0:
+                    continue
+                idf = math.log(1 + (self.doc_count - df + 0.5) / (df + 0.5))
+                norm = BM25_K1 * (1 - BM25_B + BM25_B * doc_lengths / avg_length)
+                term_scores = idf * query_tf * tfs * (BM25_K1 + 1) / (tfs + norm)
+                term_scores[doc_lengths == 0] = 0
+                scores[ids] += term_scores
+            del lengths
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.argsort(-scores[candidates])]
+        return [(int(doc_id), float(scores[doc_id])) for doc_id in candidates]
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                'documents': self.doc_count,
+                'terms': len(self.postings),
+                'postings': sum(len(p.deltas) for p in self.postings.values()),
+                'deleted': self.deleted
+            }
+
+
+class BM25IndexManager:
+    """按知识库构建和缓存 BM25 索引，首次使用时从分块集合加载"""
+
+    def __init__(self, max_loaded: int = BM25_MAX_LOADED):
+        self.max_loaded = max_loaded
+        self._indexes: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._build_locks: Dict[str, threading.Lock] = {}
+
+    def is_available(self) -> bool:
+        """依赖是否已安装"""
+        return BM25_AVAILABLE
+
+    def get(self, knowledge_base_id: str, loader: Callable[[], Iterable[Tuple[int, str]]]) -> KnowledgeBM25Index:
+        """
+        获取知识库索引，未加载时调用 loader 读取全部 (vector_id, 分块文本) 构建
+
+        同一知识库只构建一次，其他请求等待构建完成
+        """
+        knowledge_base_id = str(knowledge_base_id)
+        with self._lock:
+            index = self._indexes.get(knowledge_base_id)
+            if index is not None:
+                self._indexes.move_to_end(knowledge_base_id)
+                return index
+            build_lock = self._build_locks.setdefault(knowledge_base_id, threading.Lock())
+
+        with build_lock:
+            with self._lock:
+                index = self._indexes.get(knowledge_base_id)
+            if index is None:
+                index = KnowledgeBM25Index(knowledge_base_id)
+                for doc_id, text in loader():
+                    index.add(doc_id, text)
+                with self._lock:
+                    self._indexes[knowledge_base_id] = index
+                    self._build_locks.pop(knowledge_base_id, None)
+                    while len(self._indexes) > self.max_loaded:
+                        self._indexes.popitem(last=False)
+                print(f"🔧 知识库 {knowledge_base_id} 关键词索引构建完成: {index.doc_count} 个分块, {len(index.postings)} 个词")
+        return index
+
+    def _loaded(self, knowledge_base_id: str):
+        """返回已加载的索引，正在构建时等待构建完成，未加载时返回 None"""
+        knowledge_base_id = str(knowledge_base_id)
+        with self._lock:
+            index = self._indexes.get(knowledge_base_id)
+            build_lock = self._build_locks.get(knowledge_base_id)
+        if index is None and build_lock is not None:
+            with build_lock:
+                with self._lock:
+                    index = self._indexes.get(knowledge_base_id)
+        return index
+
+    def add(self, knowledge_base_id: str, documents: Iterable[Tuple[int, str]]):
+        """写入分块，知识库索引未加载时跳过（加载时会从分块集合读取）"""
+        index = self._loaded(knowledge_base_id)
+        if index is not None:
+            for doc_id, text in documents:
+                index.add(doc_id, text)
+
+    def remove(self, knowledge_base_id: str, doc_ids: Iterable[int]):
+        """删除分块，知识库索引未加载时跳过"""
+        index = self._loaded(knowledge_base_id)
+        if index is not None:
+            index.remove(doc_ids)
+
+    def drop(self, knowledge_base_id: str):
+        with self._lock:
+            self._indexes.pop(str(knowledge_base_id), None)
+
+    def get_stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            indexes = list(self._indexes.items())
+        return {kb_id: index.get_stats() for kb_id, index in indexes}
+
+# 创建全局实例
+bm25_indexes = BM25IndexManager()
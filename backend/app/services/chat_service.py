@@ -3,14 +3,33 @@
 # 包含同步和流式两种生成模式
 
 import json
+import os
+import heapq
+import hashlib
+import threading
 import time
-from typing import Dict, Any, Generator
+from typing import Dict, Any, Generator, Optional, Tuple
 from app.services.database import get_db
-from app.services.ollama import OllamaService
+from app.services.ollama import get_ollama_service
+from app.services.generation_scheduler import PRIORITY_BATCH
 from app.services.activity_service import activity_service
+from app.services.write_behind import write_behind
+from app.services.semantic_cache import semantic_cache, SEMANTIC_CACHE_THRESHOLD
+from app.services.knowledge_service import KnowledgeService
+from app.utils.tokens import estimate_tokens
 from bson import ObjectId
 from datetime import datetime
 
+# 对话历史配置
+HISTORY_TOKEN_BUDGET = int(os.environ.get('HISTORY_TOKEN_BUDGET', 0))  # 历史token预算上限，0表示按模型上下文计算
+HISTORY_MAX_MESSAGES = int(os.environ.get('HISTORY_MAX_MESSAGES', 200))  # 单次最多扫描的历史消息数
+SUMMARY_MAX_TOKENS = int(os.environ.get('SUMMARY_MAX_TOKENS', 512))  # 滚动摘要的最大长度
+SUMMARY_BATCH_TOKENS = int(os.environ.get('SUMMARY_BATCH_TOKENS', 4000))  # 每次压缩的历史token上限
+
+# 正在生成摘要的对话
+_summary_running = set()
+_summary_lock = threading.Lock()
+
 class ChatService:
     """
     聊天服务类
@@ -20,8 +39,10 @@ class ChatService:
     def __init__(self):
         """初始化聊天服务"""
         self.db = get_db()
+        self.knowledge_service = KnowledgeService()
     
-    def generate_response_sync(self, conversation_id: str, agent: Dict[str, Any], user_message: str) -> str:
+    def generate_response_sync(self, conversation_id: str, agent: Dict[str, Any], user_message: str,
+                               user_id: Optional[str] = None) -> Dict[str, Any]:
         """
         同步生成智能体回复
         
@@ -29,33 +50,54 @@ class ChatService:
             conversation_id: 对话ID
             agent: 智能体配置信息
             user_message: 用户消息
+            user_id: 用户ID，用于生成调度的公平分配
             
         Returns:
-            str: AI回复内容
+            dict: 包含回复内容 content 和是否命中缓存 cached 的字典
         """
         try:
             print(f"🤖 开始生成智能体回复 - 智能体: {agent.get('name', '未知')}")
             
-            # 获取对话历史
-            messages = self._get_conversation_history(conversation_id)
+            stats = {}
             
             # 构建系统提示词
+            started = time.perf_counter()
             system_prompt = self._build_agent_system_prompt(agent)
+            prompt_seconds = time.perf_counter() - started
+            
+            # 关联知识库时检索相关分块，附加到系统提示词
+            system_prompt = self._append_knowledge_context(agent, system_prompt, user_message, stats)
+            
+            # 按token预算获取对话历史
+            started = time.perf_counter()
+            token_budget = self._get_history_token_budget(agent, system_prompt, user_message)
+            summary, messages = self._get_conversation_history(conversation_id, agent, user_message, token_budget)
+            stats['history_seconds'] = time.perf_counter() - started
+            
+            # 构建结构化消息列表
+            started = time.perf_counter()
+            chat_messages = self._build_chat_messages(user_message, messages, system_prompt, summary)
+            stats['prompt_build_seconds'] = prompt_seconds + time.perf_counter() - started
             
-            # 构建用户消息
-            user_prompt = self._build_user_prompt(user_message, messages)
+            # 开启语义缓存时，相同上下文下的相似问题直接返回已有回答
+            hit, question_vector, context = self._lookup_semantic_cache(agent, user_message, chat_messages)
+            if hit:
+                return {'content': hit['content'], 'cached': True, 'semantic_score': hit['score']}
             
             # 调用Ollama生成回复
-            response = self._call_ollama_for_agent(agent, system_prompt, user_prompt)
+            response = self._call_ollama_for_agent(agent, chat_messages, conversation_id, user_id)
+            self._store_semantic_cache(agent, user_message, response.get('content'), question_vector, context)
+            response['stats'] = self._collect_stats(stats, response)
             
-            print(f"✅ 智能体回复生成成功，长度: {len(response)}")
+            print(f"✅ 智能体回复生成成功，长度: {len(response['content'])}, 缓存命中: {response.get('cached', False)}")
             return response
             
         except Exception as e:
             print(f"❌ 生成智能体回复失败: {str(e)}")
             raise e
     
-    def generate_model_response_sync(self, conversation_id: str, model: Dict[str, Any], user_message: str) -> str:
+    def generate_model_response_sync(self, conversation_id: str, model: Dict[str, Any], user_message: str,
+                                     user_id: Optional[str] = None) -> Dict[str, Any]:
         """
         同步生成模型回复
         
@@ -63,30 +105,41 @@ class ChatService:
             conversation_id: 对话ID
             model: 模型配置信息
             user_message: 用户消息
+            user_id: 用户ID，用于生成调度的公平分配
             
         Returns:
-            str: AI回复内容
+            dict: 包含回复内容 content 和是否命中缓存 cached 的字典
         """
         try:
             print(f"🤖 开始生成模型回复 - 模型: {model.get('name', '未知')}")
             
-            # 获取对话历史
-            messages = self._get_conversation_history(conversation_id)
+            stats = {}
             
-            # 构建用户消息
-            user_prompt = self._build_user_prompt(user_message, messages)
+            # 按token预算获取对话历史
+            started = time.perf_counter()
+            token_budget = self._get_history_token_budget(model, None, user_message)
+            summary, messages = self._get_conversation_history(conversation_id, model, user_message, token_budget)
+            stats['history_seconds'] = time.perf_counter() - started
+            
+            # 构建结构化消息列表
+            started = time.perf_counter()
+            chat_messages = self._build_chat_messages(user_message, messages, summary=summary)
+            stats['prompt_build_seconds'] = time.perf_counter() - started
             
             # 调用Ollama生成回复
-            response = self._call_ollama_for_model(model, user_prompt)
+            response = self._call_ollama_for_model(model, chat_messages, conversation_id, user_id)
+            response['stats'] = self._collect_stats(stats, response)
             
-            print(f"✅ 模型回复生成成功，长度: {len(response)}")
+            print(f"✅ 模型回复生成成功，长度: {len(response['content'])}, 缓存命中: {response.get('cached', False)}")
             return response
             
         except Exception as e:
             print(f"❌ 生成模型回复失败: {str(e)}")
             raise e
     
-    def stream_response(self, conversation_id: str, agent: Dict[str, Any], user_message: str) -> Generator[str, None, None]:
+    def stream_response(self, conversation_id: str, agent: Dict[str, Any], user_message: str,
+                        user_id: Optional[str] = None,
+                        stats: Optional[Dict[str, Any]] = None) -> Generator[str, None, None]:
         """
         流式生成智能体回复
         
@@ -94,6 +147,8 @@ class ChatService:
             conversation_id: 对话ID
             agent: 智能体配置信息
             user_message: 用户消息
+            user_id: 用户ID，用于生成调度的公平分配
+            stats: 接收各阶段耗时和生成统计的字典（可选）
             
         Yields:
             str: 流式回复片段
@@ -101,18 +156,48 @@ class ChatService:
         try:
             print(f"🤖 开始流式生成智能体回复 - 智能体: {agent.get('name', '未知')}")
             
-            # 获取对话历史
-            messages = self._get_conversation_history(conversation_id)
+            stats = stats if stats is not None else {}
             
             # 构建系统提示词
+            started = time.perf_counter()
             system_prompt = self._build_agent_system_prompt(agent)
+            prompt_seconds = time.perf_counter() - started
+            
+            # 关联知识库时检索相关分块，附加到系统提示词
+            system_prompt = self._append_knowledge_context(agent, system_prompt, user_message, stats)
+            
+            # 按token预算获取对话历史
+            started = time.perf_counter()
+            token_budget = self._get_history_token_budget(agent, system_prompt, user_message)
+            summary, messages = self._get_conversation_history(conversation_id, agent, user_message, token_budget)
+            stats['history_seconds'] = time.perf_counter() - started
             
-            # 构建用户消息
-            user_prompt = self._build_user_prompt(user_message, messages)
+            # 构建结构化消息列表
+            started = time.perf_counter()
+            chat_messages = self._build_chat_messages(user_message, messages, system_prompt, summary)
+            stats['prompt_build_seconds'] = prompt_seconds + time.perf_counter() - started
+            
+            # 开启语义缓存时，相同上下文下的相似问题直接返回已有回答
+            hit, question_vector, context = self._lookup_semantic_cache(agent, user_message, chat_messages)
+            if hit:
+                stats['cached'] = True
+                yield hit['content']
+                return
             
             # 调用Ollama流式生成回复
-            for chunk in self._call_ollama_stream_for_agent(agent, system_prompt, user_prompt):
-                yield chunk
+            chunks = []
+            stream = self._call_ollama_stream_for_agent(agent, chat_messages, stats, conversation_id, user_id)
+            try:
+                for chunk in stream:
+                    chunks.append(chunk)
+                    yield chunk
+            finally:
+                # 调用方提前关闭（如客户端断开）时立即关闭上游流
+                stream.close()
+            
+            # 仅缓存正常结束的回答
+            if stats.get('done'):
+                self._store_semantic_cache(agent, user_message, ''.join(chunks), question_vector, context)
                 
             print(f"✅ 智能体流式回复生成完成")
             
@@ -120,15 +205,19 @@ class ChatService:
             print(f"❌ 流式生成智能体回复失败: {str(e)}")
             yield f"抱歉，智能体 {agent.get('name', '未知')} 暂时无法响应：{str(e)}"
     
-    def stream_model_response(self, conversation_id: str, model: Dict[str, Any], user_message: str, show_thinking: bool = False) -> Generator[str, None, None]:
+    def stream_model_response(self, conversation_id: Optional[str], model: Dict[str, Any], user_message: str,
+                              show_thinking: bool = False, user_id: Optional[str] = None,
+                              stats: Optional[Dict[str, Any]] = None) -> Generator[str, None, None]:
         """
         流式生成模型回复
         
         Args:
-            conversation_id: 对话ID
+            conversation_id: 对话ID，为空时不带历史消息
             model: 模型配置信息
             user_message: 用户消息
             show_thinking: 是否显示思考过程
+            user_id: 用户ID，用于生成调度的公平分配
+            stats: 接收各阶段耗时和生成统计的字典（可选）
             
         Yields:
             str: 流式回复片段
@@ -136,15 +225,25 @@ class ChatService:
         try:
             print(f"🤖 开始流式生成模型回复 - 模型: {model.get('name', '未知')}")
             
-            # 获取对话历史
-            messages = self._get_conversation_history(conversation_id)
+            stats = stats if stats is not None else {}
             
-            # 构建用户消息
-            user_prompt = self._build_user_prompt(user_message, messages)
+            # 按token预算获取对话历史
+            started = time.perf_counter()
+            summary, messages = None, []
+            if conversation_id:
+                token_budget = self._get_history_token_budget(model, None, user_message)
+                summary, messages = self._get_conversation_history(conversation_id, model, user_message, token_budget)
+            stats['history_seconds'] = time.perf_counter() - started
+            
+            # 构建结构化消息列表
+            started = time.perf_counter()
+            chat_messages = self._build_chat_messages(user_message, messages, summary=summary)
+            stats['prompt_build_seconds'] = time.perf_counter() - started
             
             # 调用Ollama流式生成回复
-            for chunk in self._call_ollama_stream_for_model(model, user_prompt, show_thinking):
-                yield chunk
+            # yield from 会把调用方的关闭传递给上游流
+            yield from self._call_ollama_stream_for_model(model, chat_messages, show_thinking, stats=stats,
+                                                          route_key=conversation_id, user_id=user_id)
                 
             print(f"✅ 模型流式回复生成完成")
             
@@ -152,31 +251,264 @@ class ChatService:
             print(f"❌ 流式生成模型回复失败: {str(e)}")
             yield f"抱歉，模型 {model.get('name', '未知')} 暂时无法响应：{str(e)}"
     
-    def _get_conversation_history(self, conversation_id: str) -> list:
+    @staticmethod
+    def _collect_stats(stats: Dict[str, Any], response: Dict[str, Any]) -> Dict[str, Any]:
+        """合并各阶段耗时和非流式响应中的排队时间、token统计"""
+        for key in ('queue_wait', 'prompt_eval_count', 'eval_count', 'eval_duration', 'cached'):
+            if response.get(key):
+                stats[key] = response[key]
+        return stats
+    
+    def _get_history_token_budget(self, target: Dict[str, Any], system_prompt: Optional[str], user_message: str) -> int:
+        """
+        计算对话历史可用的token预算
+        
+        上下文长度优先取参数中的 num_ctx / context_length，否则取模型配置的 max_tokens，
+        再扣除回复预留、系统提示词和当前消息占用的token。
+        
+        Args:
+            target: 智能体或模型配置信息
+            system_prompt: 系统提示词
+            user_message: 当前用户消息
+            
+        Returns:
+            int: 历史消息token预算
+        """
+        parameters = target.get('parameters', {})
+        if parameters.get('history_token_budget'):
+            return int(parameters['history_token_budget'])
+        
+        context_tokens = parameters.get('num_ctx') or parameters.get('context_length') or target.get('context_length')
+        if not context_tokens:
+            if target.get('max_tokens'):
+                context_tokens = target['max_tokens']
+            else:
+                # 智能体没有上下文配置时，使用其底层模型的配置
+                server_url, model_name = self._resolve_model(target)
+                context_tokens = get_ollama_service(server_url).get_model_config(model_name).get('max_tokens', 4096)
+        
+        reserved = parameters.get('max_tokens', 1000) + estimate_tokens(system_prompt) + estimate_tokens(user_message)
+        budget = max(int(context_tokens) - reserved, 0)
+        if HISTORY_TOKEN_BUDGET > 0:
+            budget = min(budget, HISTORY_TOKEN_BUDGET)
+        return budget
+    
+    def _resolve_model(self, target: Dict[str, Any]) -> Tuple[str, str]:
+        """获取智能体或模型对应的Ollama服务器地址和模型名称"""
+        server_url = target.get('server_url', 'http://localhost:11434')
+        model_name = target.get('model_name') or target.get('name', 'llama2')
+        return server_url, model_name
+    
+    def _get_conversation_history(self, conversation_id: str, target: Dict[str, Any],
+                                  user_message: str, token_budget: int) -> Tuple[Optional[str], list]:
         """
         获取对话历史消息
         
+        从最新消息向前填充，直到用完token预算；放不下的早期消息由后台
+        压缩为滚动摘要保存在对话上，因此提示词长度不随对话轮数增长。
+        
         Args:
             conversation_id: 对话ID
+            target: 智能体或模型配置信息（用于生成摘要）
+            user_message: 当前用户消息
+            token_budget: 历史token预算
             
         Returns:
-            list: 消息历史列表
+            tuple: (滚动摘要, 消息历史列表)
         """
         try:
-            # 查询最近的消息历史（限制数量以避免token过多）
-            messages = list(self.db.messages.find({
-                'conversation_id': ObjectId(conversation_id)
-            }).sort('created_at', -1).limit(10))
+            conversation = self.db.conversations.find_one(
+                {'_id': ObjectId(conversation_id)},
+                {'summary': 1}
+            ) or {}
+            summary = conversation.get('summary') or {}
+            summarized_until = summary.get('until')
+            remaining = token_budget - summary.get('token_count', 0)
+            
+            query = {'conversation_id': ObjectId(conversation_id)}
+            if summarized_until:
+                query['created_at'] = {'$gt': summarized_until}
+            
+            # 写后队列中尚未落库的本对话消息先于查询读取，再与查询结果按时间倒序合并去重
+            pending = [m for m in write_behind.pending(conversation_id, 'messages')
+                       if not summarized_until or m.get('created_at') > summarized_until]
+            pending.sort(key=lambda m: m.get('created_at'), reverse=True)
+            cursor = (self.db.messages.find(query, {'type': 1, 'content': 1, 'created_at': 1})
+                      .sort('created_at', -1)
+                      .limit(HISTORY_MAX_MESSAGES)
+                      .batch_size(20))
+            
+            messages = []
+            overflow_at = None
+            scanned = 0
+            seen = set()
+            merged = heapq.merge(pending, cursor, key=lambda m: m.get('created_at'), reverse=True)
+            for msg in merged:
+                if msg['_id'] in seen:
+                    continue
+                seen.add(msg['_id'])
+                if scanned >= HISTORY_MAX_MESSAGES:
+                    break
+                scanned += 1
+                # 当前用户消息已入库，不计入历史预算
+                if not messages and msg.get('type') == 'user' and msg.get('content') == user_message:
+                    messages.append(msg)
+                    continue
+                tokens = estimate_tokens(msg.get('content', ''))
+                if tokens > remaining:
+                    overflow_at = msg.get('created_at')
+                    break
+                remaining -= tokens
+                messages.append(msg)
+            cursor.close()
+            
+            # 扫描达到上限但预算未用完时，更早的消息同样需要压缩进摘要，否则既不发送也不摘要
+            if overflow_at is None and scanned >= HISTORY_MAX_MESSAGES and messages:
+                older_query = dict(query, created_at={'$lt': messages[-1]['created_at']})
+                if summarized_until:
+                    older_query['created_at']['$gt'] = summarized_until
+                older = self.db.messages.find_one(older_query, {'created_at': 1}, sort=[('created_at', -1)])
+                if older:
+                    overflow_at = older['created_at']
             
             # 按时间正序排列
             messages.reverse()
             
-            print(f"📝 获取到 {len(messages)} 条历史消息")
-            return messages
+            # 超出预算的早期消息交给后台压缩
+            if overflow_at:
+                self._schedule_summary(conversation_id, target, summarized_until, overflow_at)
+            
+            print(f"📝 获取到 {len(messages)} 条历史消息，剩余预算: {remaining}")
+            return summary.get('content'), messages
             
         except Exception as e:
             print(f"❌ 获取对话历史失败: {str(e)}")
-            return []
+            return None, []
+    
+    def _schedule_summary(self, conversation_id: str, target: Dict[str, Any], summarized_until, overflow_at):
+        """在后台线程中更新对话的滚动摘要，同一对话同时只运行一个任务"""
+        with _summary_lock:
+            if conversation_id in _summary_running:
+                return
+            _summary_running.add(conversation_id)
+        
+        thread = threading.Thread(
+            target=self._update_summary,
+            args=(conversation_id, target, summarized_until, overflow_at)
+        )
+        thread.daemon = True
+        thread.start()
+    
+    def _update_summary(self, conversation_id: str, target: Dict[str, Any], summarized_until, overflow_at):
+        """
+        将未摘要的早期消息合并进滚动摘要
+        
+        每次最多压缩 SUMMARY_BATCH_TOKENS 的消息，剩余部分在后续轮次继续压缩。
+        """
+        try:
+            query = {'conversation_id': ObjectId(conversation_id), 'created_at': {'$lte': overflow_at}}
+            if summarized_until:
+                query['created_at']['$gt'] = summarized_until
+            
+            cursor = self.db.messages.find(query, {'type': 1, 'content': 1, 'created_at': 1}).sort('created_at', 1)
+            
+            lines = []
+            used = 0
+            last_created_at = None
+            for msg in cursor:
+                if msg.get('type') not in ('user', 'assistant'):
+                    continue
+                tokens = estimate_tokens(msg.get('content', ''))
+                if lines and used + tokens > SUMMARY_BATCH_TOKENS:
+                    break
+                role = '用户' if msg['type'] == 'user' else '助手'
+                lines.append(f"{role}: {msg.get('content', '')}")
+                used += tokens
+                last_created_at = msg['created_at']
+            cursor.close()
+            
+            if not lines:
+                return
+            
+            conversation = self.db.conversations.find_one({'_id': ObjectId(conversation_id)}, {'summary': 1}) or {}
+            previous = (conversation.get('summary') or {}).get('content', '')
+            
+            prompt = "请将以下对话压缩为简洁的摘要，保留关键事实、用户的偏好和要求以及尚未解决的问题，不要添加对话中没有的内容。\n\n"
+            if previous:
+                prompt += f"已有摘要：\n{previous}\n\n"
+            prompt += "新增对话：\n" + "\n".join(lines) + "\n\n摘要："
+            
+            server_url, model_name = self._resolve_model(target)
+            content = get_ollama_service(server_url).chat_text(
+                model_name=model_name,
+                messages=[{'role': 'user', 'content': prompt}],
+                temperature=0.2,
+                max_tokens=SUMMARY_MAX_TOKENS,
+                priority=PRIORITY_BATCH
+            ).strip()
+            
+            if not content:
+                return
+            
+            # 仅在摘要未被其他任务更新时写入
+            self.db.conversations.update_one(
+                {'_id': ObjectId(conversation_id), 'summary.until': summarized_until},
+                {'$set': {'summary': {
+                    'content': content,
+                    'token_count': estimate_tokens(content),
+                    'until': last_created_at,
+                    'updated_at': datetime.now()
+                }}}
+            )
+            print(f"✅ 对话摘要已更新: {conversation_id}, 压缩消息 {len(lines)} 条")
+            
+        except Exception as e:
+            print(f"❌ 更新对话摘要失败: {str(e)}")
+        finally:
+            with _summary_lock:
+                _summary_running.discard(conversation_id)
+    
+    def _lookup_semantic_cache(self, agent: Dict[str, Any], user_message: str,
+                               chat_messages: list) -> Tuple[Optional[Dict[str, Any]], Any, Optional[str]]:
+        """
+        查询智能体的语义缓存
+        
+        智能体在 parameters 或 config 中设置 semantic_cache 为 true 时启用，
+        相似度阈值可通过 semantic_cache_threshold 调整。
+        当前问题之前的全部消息（系统提示词、知识库上下文、摘要和历史）计算为上下文指纹，
+        只命中相同上下文下保存的回答。
+        
+        Returns:
+            tuple: (命中结果, 问题向量, 上下文指纹)，未启用时均为 None
+        """
+        options = {**agent.get('config', {}), **agent.get('parameters', {})}
+        if not options.get('semantic_cache') or not semantic_cache.is_available():
+            return None, None, None
+        
+        try:
+            agent_id = str(agent.get('_id'))
+            threshold = float(options.get('semantic_cache_threshold', SEMANTIC_CACHE_THRESHOLD))
+            context = hashlib.sha256(
+                json.dumps(chat_messages[:-1], ensure_ascii=False, sort_keys=True).encode('utf-8')
+            ).hexdigest()
+            question_vector = semantic_cache.embed(user_message)
+            hit = semantic_cache.lookup(agent_id, user_message, threshold, question_vector, context)
+            if hit:
+                print(f"⚡ 命中语义缓存 - 智能体: {agent.get('name', '未知')}, 相似度: {hit['score']:.4f}")
+            return hit, question_vector, context
+        except Exception as e:
+            print(f"⚠️ 查询语义缓存失败: {str(e)}")
+            return None, None, None
+    
+    def _store_semantic_cache(self, agent: Dict[str, Any], user_message: str, answer: str, question_vector,
+                              context: Optional[str]):
+        """将回答及其上下文指纹写入智能体的语义缓存"""
+        if question_vector is None or not answer:
+            return
+        try:
+            semantic_cache.store(str(agent.get('_id')), user_message, answer, question_vector, context or '')
+        except Exception as e:
+            print(f"⚠️ 写入语义缓存失败: {str(e)}")
     
     def _build_agent_system_prompt(self, agent: Dict[str, Any]) -> str:
         """
@@ -214,55 +546,93 @@ class ChatService:
             print(f"❌ 构建智能体系统提示词失败: {str(e)}")
             return "你是一个有用的AI助手。"
     
-    def _build_user_prompt(self, user_message: str, messages: list) -> str:
+    def _append_knowledge_context(self, agent: Dict[str, Any], system_prompt: str, user_message: str,
+                                  stats: Dict[str, Any]) -> str:
+        """
+        检索智能体关联知识库中与用户消息相关的分块，附加到系统提示词末尾
+        
+        检索参数取智能体 config.retrieval（模式、top_k、重排、各阶段预算），
+        检索耗时记入 stats 的 retrieval_seconds，各阶段耗时记入 retrieval
+        """
+        config = agent.get('config') or {}
+        knowledge_base_ids = config.get('knowledge_bases') or agent.get('knowledge_base_ids') or []
+        if not knowledge_base_ids:
+            return system_prompt
+        
+        started = time.perf_counter()
+        timings = {}
+        context = self.knowledge_service.get_relevant_context_sync(
+            user_message, [str(base_id) for base_id in knowledge_base_ids],
+            options=config.get('retrieval'), timings=timings
+        )
+        stats['retrieval_seconds'] = time.perf_counter() - started
+        stats['retrieval'] = timings
+        if not context:
+            return system_prompt
+        return f"""{system_prompt}
+
+以下是知识库中与用户问题相关的内容，回答时优先参考，内容不相关时忽略：
+
+{context}"""
+    
+    def _build_chat_messages(self, user_message: str, messages: list, system_prompt: str = None,
+                             summary: str = None) -> list:
         """
-        构建用户消息提示词
+        构建结构化对话消息列表
+        
+        使用 /api/chat 的消息格式发送历史，每轮只在末尾追加新消息，
+        Ollama 可以复用已缓存的前缀，无需重新预填充整段对话。
         
         Args:
             user_message: 当前用户消息
             messages: 历史消息列表
+            system_prompt: 系统提示词（可选）
+            summary: 早期对话的滚动摘要（可选）
             
         Returns:
-            str: 完整的用户提示词
+            list: [{'role': ..., 'content': ...}] 格式的消息列表
         """
-        try:
-            # 构建对话历史
-            conversation_history = ""
-            for msg in messages:
-                if msg['type'] == 'user':
-                    conversation_history += f"用户: {msg['content']}\n"
-                elif msg['type'] == 'assistant':
-                    conversation_history += f"助手: {msg['content']}\n"
-            
-            # 添加当前用户消息
-            full_prompt = f"{conversation_history}用户: {user_message}\n助手:"
-            
-            print(f"📝 构建用户提示词，历史消息数: {len(messages)}")
-            return full_prompt
-            
-        except Exception as e:
-            print(f"❌ 构建用户提示词失败: {str(e)}")
-            return f"用户: {user_message}\n助手:"
+        chat_messages = []
+        if system_prompt:
+            chat_messages.append({'role': 'system', 'content': system_prompt})
+        if summary:
+            chat_messages.append({'role': 'system', 'content': f"以下是本次对话早期内容的摘要：\n{summary}"})
+        
+        # 当前用户消息在生成前已经入库，避免重复发送
+        history = list(messages)
+        if history and history[-1].get('type') == 'user' and history[-1].get('content') == user_message:
+            history = history[:-1]
+        
+        for msg in history:
+            if msg.get('type') in ('user', 'assistant'):
+                chat_messages.append({'role': msg['type'], 'content': msg.get('content', '')})
+        
+        chat_messages.append({'role': 'user', 'content': user_message})
+        
+        print(f"📝 构建对话消息，历史消息数: {len(history)}")
+        return chat_messages
     
-    def _call_ollama_for_agent(self, agent: Dict[str, Any], system_prompt: str, user_prompt: str) -> str:
+    def _call_ollama_for_agent(self, agent: Dict[str, Any], chat_messages: list,
+                               route_key: Optional[str] = None, user_id: Optional[str] = None) -> Dict[str, Any]:
         """
         调用Ollama生成智能体回复
         
         Args:
             agent: 智能体配置信息
-            system_prompt: 系统提示词
-            user_prompt: 用户提示词
+            chat_messages: 结构化消息列表（含系统提示词）
+            route_key: 粘性路由键（对话ID）
+            user_id: 用户ID
             
         Returns:
-            str: AI回复内容
+            dict: Ollama返回的回复信息
         """
         try:
             # 获取Ollama服务器地址
             server_url = agent.get('server_url', 'http://localhost:11434')
             print(f"🔧 调用Ollama生成智能体回复 - 服务器: {server_url}")
             
-            # 创建Ollama服务实例
-            ollama_service = OllamaService(server_url)
+            # 获取共享的Ollama客户端
+            ollama_service = get_ollama_service(server_url)
             
             # 获取模型名称
             model_name = agent.get('model_name', 'llama2')
@@ -272,15 +642,15 @@ class ChatService:
             temperature = parameters.get('temperature', 0.7)
             max_tokens = parameters.get('max_tokens', 1000)
             
-            # 构建完整的提示词（包含系统提示词）
-            full_prompt = f"{system_prompt}\n\n{user_prompt}"
-            
-            # 调用Ollama生成回复
-            response = ollama_service.generate_text(
-                model_name=model_name,
-                prompt=full_prompt,
+            # 调用Ollama生成回复，temperature 为 0 或开启 response_cache 时使用响应缓存
+            response = ollama_service.chat(
+                model_name,
+                chat_messages,
                 temperature=temperature,
-                max_tokens=max_tokens
+                max_tokens=max_tokens,
+                use_cache=parameters.get('response_cache', False),
+                route_key=route_key,
+                user_id=user_id
             )
             
             return response
@@ -289,25 +659,27 @@ class ChatService:
             print(f"❌ 调用Ollama生成智能体回复失败: {str(e)}")
             raise e
     
-    def _call_ollama_for_model(self, model: Dict[str, Any], user_prompt: str) -> str:
+    def _call_ollama_for_model(self, model: Dict[str, Any], chat_messages: list,
+                               route_key: Optional[str] = None, user_id: Optional[str] = None) -> Dict[str, Any]:
         """
         调用Ollama生成模型回复
         
         Args:
             model: 模型配置信息
-            user_prompt: 用户提示词
+            chat_messages: 结构化消息列表
+            route_key: 粘性路由键（对话ID）
+            user_id: 用户ID
             
         Returns:
-            str: AI回复内容
+            dict: Ollama返回的回复信息
         """
         try:
             # 获取Ollama服务器地址，优先使用模型配置的server_url
             server_url = model.get('server_url', 'http://localhost:11434')
             print(f"🔧 使用Ollama生成 - 服务器: {server_url}")
             
-            # 创建Ollama服务实例，使用模型配置的服务器地址
-            from app.services.ollama import OllamaService
-            ollama_service = OllamaService(server_url)
+            # 获取共享的Ollama客户端，使用模型配置的服务器地址
+            ollama_service = get_ollama_service(server_url)
             
             # 获取模型名称
             model_name = model.get('name', 'llama2')
@@ -317,12 +689,15 @@ class ChatService:
             temperature = parameters.get('temperature', 0.7)
             max_tokens = parameters.get('max_tokens', 1000)
             
-            # 调用Ollama生成回复
-            response = ollama_service.generate_text(
-                model_name=model_name,
-                prompt=user_prompt,
+            # 调用Ollama生成回复，temperature 为 0 或开启 response_cache 时使用响应缓存
+            response = ollama_service.chat(
+                model_name,
+                chat_messages,
                 temperature=temperature,
-                max_tokens=max_tokens
+                max_tokens=max_tokens,
+                use_cache=parameters.get('response_cache', False),
+                route_key=route_key,
+                user_id=user_id
             )
             
             return response
@@ -331,14 +706,19 @@ class ChatService:
             print(f"❌ 调用Ollama生成模型回复失败: {str(e)}")
             raise e
     
-    def _call_ollama_stream_for_agent(self, agent: Dict[str, Any], system_prompt: str, user_prompt: str) -> Generator[str, None, None]:
+    def _call_ollama_stream_for_agent(self, agent: Dict[str, Any], chat_messages: list,
+                                      stats: Optional[Dict[str, Any]] = None,
+                                      route_key: Optional[str] = None,
+                                      user_id: Optional[str] = None) -> Generator[str, None, None]:
         """
         调用Ollama流式生成智能体回复
         
         Args:
             agent: 智能体配置信息
-            system_prompt: 系统提示词
-            user_prompt: 用户提示词
+            chat_messages: 结构化消息列表（含系统提示词）
+            stats: 接收生成统计的字典（可选）
+            route_key: 粘性路由键（对话ID）
+            user_id: 用户ID
             
         Yields:
             str: 流式回复片段
@@ -348,8 +728,8 @@ class ChatService:
             server_url = agent.get('server_url', 'http://localhost:11434')
             print(f"🔧 调用Ollama流式生成智能体回复 - 服务器: {server_url}")
             
-            # 创建Ollama服务实例
-            ollama_service = OllamaService(server_url)
+            # 获取共享的Ollama客户端
+            ollama_service = get_ollama_service(server_url)
             
             # 获取模型名称
             model_name = agent.get('model_name', 'llama2')
@@ -359,30 +739,35 @@ class ChatService:
             temperature = parameters.get('temperature', 0.7)
             max_tokens = parameters.get('max_tokens', 1000)
             
-            # 构建完整的提示词（包含系统提示词）
-            full_prompt = f"{system_prompt}\n\n{user_prompt}"
-            
             # 调用Ollama流式生成回复
-            for chunk in ollama_service.stream_text(
+            yield from ollama_service.stream_chat(
                 model_name=model_name,
-                prompt=full_prompt,
+                messages=chat_messages,
                 temperature=temperature,
-                max_tokens=max_tokens
-            ):
-                yield chunk
+                max_tokens=max_tokens,
+                stats=stats,
+                route_key=route_key,
+                user_id=user_id
+            )
                 
         except Exception as e:
             print(f"❌ 调用Ollama流式生成智能体回复失败: {str(e)}")
             yield f"抱歉，智能体 {agent.get('name', '未知')} 暂时无法响应：{str(e)}"
     
-    def _call_ollama_stream_for_model(self, model: Dict[str, Any], user_prompt: str, show_thinking: bool = False) -> Generator[str, None, None]:
+    def _call_ollama_stream_for_model(self, model: Dict[str, Any], chat_messages: list, show_thinking: bool = False,
+                                      stats: Optional[Dict[str, Any]] = None,
+                                      route_key: Optional[str] = None,
+                                      user_id: Optional[str] = None) -> Generator[str, None, None]:
         """
         调用Ollama流式生成模型回复
         
         Args:
             model: 模型配置信息
-            user_prompt: 用户提示词
+            chat_messages: 结构化消息列表
             show_thinking: 是否显示思考过程
+            stats: 接收生成统计的字典（可选）
+            route_key: 粘性路由键（对话ID）
+            user_id: 用户ID
             
         Yields:
             str: 流式回复片段
@@ -392,9 +777,8 @@ class ChatService:
             server_url = model.get('server_url', 'http://localhost:11434')
             print(f"🔧 使用Ollama流式生成 - 服务器: {server_url}")
             
-            # 创建Ollama服务实例，使用模型配置的服务器地址
-            from app.services.ollama import OllamaService
-            ollama_service = OllamaService(server_url)
+            # 获取共享的Ollama客户端，使用模型配置的服务器地址
+            ollama_service = get_ollama_service(server_url)
             
             # 获取模型名称
             model_name = model.get('name', 'llama2')
@@ -405,13 +789,15 @@ class ChatService:
             max_tokens = parameters.get('max_tokens', 1000)
             
             # 调用Ollama流式生成回复
-            for chunk in ollama_service.stream_text(
+            yield from ollama_service.stream_chat(
                 model_name=model_name,
-                prompt=user_prompt,
+                messages=chat_messages,
                 temperature=temperature,
-                max_tokens=max_tokens
-            ):
-                yield chunk
+                max_tokens=max_tokens,
+                stats=stats,
+                route_key=route_key,
+                user_id=user_id
+            )
                 
         except Exception as e:
             print(f"❌ 调用Ollama流式生成模型回复失败: {str(e)}")
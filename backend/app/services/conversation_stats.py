@@ -0,0 +1,123 @@
+"""
+对话统计模块
+对话文档上维护冗余的计数和最后一条消息预览，消息写入时通过 $inc 原子更新，
+列表和统计接口直接读取对话文档，不再扫描消息集合
+"""
+
+import os
+from datetime import datetime
+from typing import Dict, Any, List, Optional, Iterable
+from bson import ObjectId
+from pymongo import UpdateOne
+from app.services.database import get_db
+from app.services.write_behind import write_behind
+from app.utils.tokens import estimate_tokens
+
+# 统计配置
+CONVERSATION_PREVIEW_LENGTH = int(os.environ.get('CONVERSATION_PREVIEW_LENGTH', 100))  # 最后一条消息预览的最大字符数
+CONVERSATION_BACKFILL_BATCH = int(os.environ.get('CONVERSATION_BACKFILL_BATCH', 500))  # 回填时每批写入的对话数
+
+# 对话文档上的统计字段，新建对话时初始化
+EMPTY_STATS = {
+    'message_count': 0,
+    'user_message_count': 0,
+    'assistant_message_count': 0,
+    'token_count': 0,
+    'last_message_at': None,
+    'last_message_preview': '',
+    'last_message_type': None
+}
+
+
+def make_preview(content: str) -> str:
+    """截断消息内容作为预览，去掉换行"""
+    text = ' '.join((content or '').split())
+    if len(text) > CONVERSATION_PREVIEW_LENGTH:
+        text = text[:CONVERSATION_PREVIEW_LENGTH] + '…'
+    return text
+
+
+def build_message_update(message: Dict[str, Any]) -> List[Dict[str, Any]]:
+    """
+    根据一条新消息生成对话文档的增量更新（聚合管道更新，需要 MongoDB 4.2+）
+    写后队列批量写入时消息可能乱序到达，预览和类型只在消息不早于当前 last_message_at 时覆盖
+    """
+    created_at = message.get('created_at') or datetime.now()
+    message_type = message.get('type')
+    counters = {
+        'message_count': 1,
+        'token_count': estimate_tokens(message.get('content', ''))
+    }
+    if message_type in ('user', 'assistant'):
+        counters[f'{message_type}_message_count'] = 1
+    # 管道中的阶段按更新前的文档求值，条件读到的是旧的 last_message_at
+    is_latest = {'$lte': [{'$ifNull': ['$last_message_at', None]}, created_at]}
+    fields = {name: {'$add': [{'$ifNull': [f'${name}', 0]}, value]} for name, value in counters.items()}
+    fields.update({
+        'last_message_at': {'$max': ['$last_message_at', created_at]},
+        'updated_at': {'$max': ['$updated_at', created_at]},
+        # 预览是用户内容，用 $literal 避免以 $ 开头时被当作字段路径
+        'last_message_preview': {'$cond': [is_latest, {'$literal': make_preview(message.get('content', ''))},
+                                           '$last_message_preview']},
+        'last_message_type': {'$cond': [is_latest, {'$literal': message_type}, '$last_message_type']}
+    })
+    return [{'$set': fields}]
+
+
+def record_message(conversation_id: str, message: Dict[str, Any]):
+    """消息写入后更新对话统计（经写后队列与消息一起批量写入）"""
+    write_behind.update('conversations', {'_id': ObjectId(conversation_id)}, build_message_update(message),
+                        key=str(conversation_id))
+
+
+def backfill_conversation_stats(conversation_ids: Optional[Iterable[str]] = None,
+                                db=None) -> Dict[str, int]:
+    """
+    回填/修复对话统计：按消息集合重新计算并覆盖对话上的统计字段
+
+    Args:
+        conversation_ids: 只修复指定的对话，不传时处理全部对话
+        db: 数据库连接，不传时使用默认连接
+
+    Returns:
+        dict: 处理的对话数和消息数
+    """
+    db = db if db is not None else get_db()
+    query = {}
+    if conversation_ids is not None:
+        ids = [str(cid) for cid in conversation_ids]
+        query['_id'] = {'$in': [ObjectId(cid) for cid in ids if ObjectId.is_valid(cid)]}
+
+    updates = []
+    totals = {'conversations': 0, 'messages': 0}
+    for conversation in db.conversations.find(query, {'_id': 1}):
+        conversation_id = conversation['_id']
+        stats = dict(EMPTY_STATS)
+        last = None
+        # 历史数据中 conversation_id 有ObjectId和字符串两种存储方式
+        cursor = db.messages.find(
+            {'conversation_id': {'$in': [conversation_id, str(conversation_id)]}},
+            {'type': 1, 'content': 1, 'created_at': 1}
+        ).sort([('created_at', 1), ('_id', 1)])
+        for message in cursor:
+            stats['message_count'] += 1
+            stats['token_count'] += estimate_tokens(message.get('content', ''))
+            if message.get('type') in ('user', 'assistant'):
+                stats[f"{message['type']}_message_count"] += 1
+            last = message
+        if last is not None:
+            stats['last_message_at'] = last.get('created_at')
+            stats['last_message_preview'] = make_preview(last.get('content', ''))
+            stats['last_message_type'] = last.get('type')
+
+        updates.append(UpdateOne({'_id': conversation_id}, {'$set': stats}))
+        totals['conversations'] += 1
+        totals['messages'] += stats['message_count']
+        if len(updates) >= CONVERSATION_BACKFILL_BATCH:
+            db.conversations.bulk_write(updates, ordered=False)
+            updates = []
+
+    if updates:
+        db.conversations.bulk_write(updates, ordered=False)
+    print(f"✅ 对话统计回填完成: {totals['conversations']} 个对话, {totals['messages']} 条消息")
+    return totals
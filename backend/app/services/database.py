@@ -90,8 +90,9 @@ def create_indexes(db):
         db.conversations.create_index([("created_at", -1)])
         
         # 消息集合索引
-        db.messages.create_index([("conversation_id", 1)])
+        db.messages.create_index([("conversation_id", 1), ("created_at", 1), ("_id", 1)])
         db.messages.create_index([("created_at", 1)])
+        db.messages.create_index([("user_id", 1), ("type", 1), ("created_at", 1)])
         
         # 知识库集合索引
         db.knowledge_bases.create_index([("user_id", 1)])
@@ -101,6 +102,10 @@ def create_indexes(db):
         db.documents.create_index([("knowledge_base_id", 1)])
         db.documents.create_index([("status", 1)])
         
+        # 知识库分块集合索引
+        db.knowledge_chunks.create_index([("knowledge_base_id", 1), ("vector_id", 1)], unique=True)
+        db.knowledge_chunks.create_index([("knowledge_base_id", 1), ("document_id", 1)])
+        
         # 插件集合索引
         db.plugins.create_index([("user_id", 1)])
         db.plugins.create_index([("status", 1)])
@@ -0,0 +1,214 @@
+"""
+知识库文档入库模块
+上传的文件在后台线程池中解析（PDF/DOCX/TXT）、按token分块、批量向量化并写入知识库索引。
+文档的 status 依次为 queued -> parsing -> embedding -> ready，失败时为 failed 并记录 error；
+每个文档记录解析/向量化耗时和 pages/sec、chunks/sec，全局吞吐通过 get_stats 查看。
+"""
+
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from typing import Dict, Any, List
+from bson import ObjectId
+from app.services.database import get_db
+from app.services.knowledge_service import KnowledgeService
+from app.utils.tokens import estimate_tokens
+
+try:
+    import fitz  # PyMuPDF
+    PDF_AVAILABLE = True
+except ImportError:
+    fitz = None
+    PDF_AVAILABLE = False
+
+try:
+    import docx  # python-docx
+    DOCX_AVAILABLE = True
+except ImportError:
+    docx = None
+    DOCX_AVAILABLE = False
+
+# 入库配置
+INGESTION_WORKERS = int(os.environ.get('INGESTION_WORKERS', 2))  # 并发处理的文档数
+KNOWLEDGE_UPLOAD_DIR = os.environ.get('KNOWLEDGE_UPLOAD_DIR', 'uploads/knowledge')  # 知识库文件保存目录
+
+# 支持的文件类型
+SUPPORTED_EXTENSIONS = {'.pdf': 'pdf', '.docx': 'docx', '.txt': 'text', '.md': 'text'}
+
+# 处理中的状态，进程重启后需要重新入队
+PENDING_STATUSES = ('queued', 'parsing', 'embedding')
+
+
+def detect_file_type(filename: str) -> str:
+    """按扩展名识别文件类型，不支持时返回空字符串"""
+    return SUPPORTED_EXTENSIONS.get(os.path.splitext(filename or '')[1].lower(), '')
+
+
+def extract_pages(path: str, file_type: str) -> List[str]:
+    """
+    提取文件文本
+
+    Returns:
+        list: 每页的文本，DOCX和纯文本没有分页，整体作为一页
+    """
+    if file_type == 'pdf':
+        if not PDF_AVAILABLE:
+            raise Exception("未安装 PyMuPDF，无法解析PDF文件")
+        with fitz.open(path) as pdf:
+            return [page.get_text() for page in pdf]
+    if file_type == 'docx':
+        if not DOCX_AVAILABLE:
+            raise Exception("未安装 python-docx，无法解析DOCX文件")
+        document = docx.Document(path)
+        parts = [paragraph.text for paragraph in document.paragraphs]
+        for table in document.tables:
+            for row in table.rows:
+                parts.append('\t'.join(cell.text for cell in row.cells))
+        return ['\n'.join(parts)]
+    with open(path, 'rb') as f:
+        raw = f.read()
+    # 中文文本文件常见GBK编码
+    for encoding in ('utf-8-sig', 'gb18030'):
+        try:
+            return [raw.decode(encoding)]
+        except UnicodeDecodeError:
+            continue
+    return [raw.decode('utf-8', errors='replace')]
+
+
+class DocumentIngestion:
+    """文档入库任务队列"""
+
+    def __init__(self, max_workers: int = INGESTION_WORKERS):
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='ingestion')
+        self._lock = threading.Lock()
+        self._stats = {
+            'documents': 0, 'failed': 0, 'pages': 0, 'chunks': 0, 'tokens': 0,
+            'cached_chunks': 0, 'parse_seconds': 0.0, 'embed_seconds': 0.0
+        }
+        self._knowledge_service = None
+
+    def _get_knowledge_service(self):
+        if self._knowledge_service is None:
+            self._knowledge_service = KnowledgeService()
+        return self._knowledge_service
+
+    def submit(self, document_id: str):
+        """文档加入入库队列"""
+        self._executor.submit(self._run, str(document_id))
+
+    def resume_pending(self) -> int:
+        """重新入队进程退出时未处理完的文档"""
+        db = get_db()
+        count = 0
+        for document in db.documents.find({'status': {'$in': list(PENDING_STATUSES)}}, {'_id': 1}):
+            db.documents.update_one({'_id': document['_id']}, {'$set': {'status': 'queued'}})
+            self.submit(document['_id'])
+            count += 1
+        if count:
+            print(f"🔁 重新入队未完成的文档: {count} 个")
+        return count
+
+    def _set_status(self, db, document_id: str, status: str, **fields):
+        fields.update({'status': status, 'updated_at': datetime.now()})
+        db.documents.update_one({'_id': ObjectId(document_id)}, {'$set': fields})
+
+    def _run(self, document_id: str):
+        db = get_db()
+        try:
+            self._ingest(db, document_id)
+        except Exception as e:
+            print(f"❌ 文档入库失败 {document_id}: {str(e)}")
+            with self._lock:
+                self._stats['failed'] += 1
+            self._set_status(db, document_id, 'failed', error=str(e))
+
+    def _ingest(self, db, document_id: str):
+        document = db.documents.find_one({'_id': ObjectId(document_id)})
+        if not document:
+            return
+        knowledge_base_id = document['knowledge_base_id']
+        base = db.knowledge_bases.find_one({'_id': ObjectId(knowledge_base_id)})
+        if not base:
+            raise Exception("知识库不存在")
+        service = self._get_knowledge_service()
+        started_at = datetime.now()
+
+        # 解析并分块
+        self._set_status(db, document_id, 'parsing', error=None)
+        started = time.perf_counter()
+        pages = extract_pages(document['file_path'], document['file_type'])
+        chunks = service.split_document('\n\n'.join(pages))
+        parse_seconds = time.perf_counter() - started
+        token_count = sum(estimate_tokens(chunk) for chunk in chunks)
+
+        # 重新入库时先清除旧分块
+        service.remove_document_chunks(knowledge_base_id, document_id)
+
+        # 批量向量化并写入索引，每批更新一次进度
+        self._set_status(db, document_id, 'embedding', progress={'chunks_total': len(chunks), 'chunks_done': 0})
+
+        def on_progress(done: int):
+            db.documents.update_one(
+                {'_id': ObjectId(document_id)},
+                {'$set': {'progress.chunks_done': done}}
+            )
+
+        started = time.perf_counter()
+        index_stats = {}
+        service.index_chunks(base, document_id, document['name'], chunks, progress=on_progress, stats=index_stats)
+        cached_chunks = index_stats.get('cached_chunks', 0)
+        embed_seconds = time.perf_counter() - started
+
+        # 入库过程中文档被删除时清理刚写入的分块
+        if not db.documents.find_one({'_id': ObjectId(document_id)}, {'_id': 1}):
+            service.remove_document_chunks(knowledge_base_id, document_id)
+            return
+
+        total_seconds = parse_seconds + embed_seconds
+        self._set_status(
+            db, document_id, 'ready',
+            page_count=len(pages),
+            chunk_count=len(chunks),
+            token_count=token_count,
+            ingestion={
+                'started_at': started_at,
+                'finished_at': datetime.now(),
+                'parse_seconds': round(parse_seconds, 3),
+                'embed_seconds': round(embed_seconds, 3),
+                'cached_chunks': cached_chunks,
+                'pages_per_sec': round(len(pages) / total_seconds, 2) if total_seconds else None,
+                'chunks_per_sec': round(len(chunks) / embed_seconds, 2) if embed_seconds else None
+            }
+        )
+        db.knowledge_bases.update_one(
+            {'_id': ObjectId(knowledge_base_id)},
+            {'$inc': {'total_tokens': token_count - document.get('token_count', 0)},
+             '$set': {'updated_at': datetime.now()}}
+        )
+        with self._lock:
+            self._stats['documents'] += 1
+            self._stats['pages'] += len(pages)
+            self._stats['chunks'] += len(chunks)
+            self._stats['cached_chunks'] += cached_chunks
+            self._stats['tokens'] += token_count
+            self._stats['parse_seconds'] += parse_seconds
+            self._stats['embed_seconds'] += embed_seconds
+        print(f"✅ 文档入库完成: {document['name']}, {len(pages)} 页, {len(chunks)} 个分块, "
+              f"解析 {parse_seconds:.2f}s, 向量化 {embed_seconds:.2f}s, 复用向量 {cached_chunks} 个")
+
+    def get_stats(self) -> Dict[str, Any]:
+        """累计入库吞吐"""
+        with self._lock:
+            stats = dict(self._stats)
+        total_seconds = stats['parse_seconds'] + stats['embed_seconds']
+        stats['pages_per_sec'] = round(stats['pages'] / total_seconds, 2) if total_seconds else 0.0
+        stats['chunks_per_sec'] = round(stats['chunks'] / stats['embed_seconds'], 2) if stats['embed_seconds'] else 0.0
+        stats['parse_seconds'] = round(stats['parse_seconds'], 3)
+        stats['embed_seconds'] = round(stats['embed_seconds'], 3)
+        return stats
+
+# 创建全局实例
+document_ingestion = DocumentIngestion()
@@ -0,0 +1,78 @@
+"""
+向量嵌入服务模块
+基于 sentence-transformers 生成归一化的文本向量，模型在首次使用时加载
+"""
+
+import os
+import threading
+from typing import List, Optional
+
+try:
+    import numpy as np
+    from sentence_transformers import SentenceTransformer
+    EMBEDDING_AVAILABLE = True
+except ImportError:
+    np = None
+    SentenceTransformer = None
+    EMBEDDING_AVAILABLE = False
+
+# 嵌入模型配置，默认使用支持中文的384维多语言模型
+EMBEDDING_MODEL = os.environ.get('EMBEDDING_MODEL', 'paraphrase-multilingual-MiniLM-L12-v2')
+EMBEDDING_BATCH_SIZE = int(os.environ.get('EMBEDDING_BATCH_SIZE', 32))
+
+class EmbeddingService:
+    """文本嵌入服务"""
+
+    def __init__(self, model_name: str = EMBEDDING_MODEL):
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    def is_available(self) -> bool:
+        """依赖是否已安装"""
+        return EMBEDDING_AVAILABLE
+
+    def _get_model(self):
+        """延迟加载嵌入模型"""
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    if not EMBEDDING_AVAILABLE:
+                        raise Exception("未安装 sentence-transformers，无法生成向量")
+                    print(f"🔧 加载嵌入模型: {self.model_name}")
+                    self._model = SentenceTransformer(self.model_name)
+        return self._model
+
+    @property
+    def dimension(self) -> int:
+        """向量维度"""
+        return self._get_model().get_sentence_embedding_dimension()
+
+    @property
+    def max_input_tokens(self) -> int:
+        """模型单次编码的最大词片数（扣除首尾特殊符号），超出部分被截断"""
+        return max(self._get_model().max_seq_length - 2, 1)
+
+    def embed(self, texts: List[str], batch_size: Optional[int] = None) -> 'np.ndarray':
+        """
+        批量生成向量
+
+        Returns:
+            float32 矩阵，每行已做L2归一化，内积即余弦相似度
+        """
+        model = self._get_model()
+        vectors = model.encode(
+            texts,
+            batch_size=batch_size or EMBEDDING_BATCH_SIZE,
+            normalize_embeddings=True,
+            convert_to_numpy=True,
+            show_progress_bar=False
+        )
+        return vectors.astype('float32')
+
+    def embed_one(self, text: str) -> 'np.ndarray':
+        """生成单条文本的向量"""
+        return self.embed([text])[0]
+
+# 创建全局实例
+embedding_service = EmbeddingService()
@@ -0,0 +1,248 @@
+"""
+分块向量存储模块
+按 (嵌入模型, 规范化分块文本的哈希) 保存向量，所有知识库共用：同一份手册上传到多个知识库、
+重新入库或重建索引时，已向量化过的分块直接读取，不再调用嵌入模型。
+每个模型一个目录，向量保存在定长行的内存映射文件（默认float16，归一化向量的内积误差约1e-3），
+哈希按行号顺序追加在索引文件中，启动时读入内存字典；先写向量再写哈希，进程中途退出不会读到半行向量。
+"""
+
+import os
+import re
+import json
+import hashlib
+import threading
+import unicodedata
+from typing import Dict, Any, List, Optional, Tuple
+
+try:
+    import numpy as np
+    EMBEDDING_STORE_AVAILABLE = True
+except ImportError:
+    np = None
+    EMBEDDING_STORE_AVAILABLE = False
+
+try:
+    import fcntl  # 多进程追加时加文件锁，Windows 下只保证进程内安全
+except ImportError:
+    fcntl = None
+
+from app.services.embedding_service import embedding_service
+
+# 向量存储配置
+EMBEDDING_STORE_DIR = os.environ.get('EMBEDDING_STORE_DIR', 'data/embedding_store')  # 存储目录
+EMBEDDING_STORE_DTYPE = os.environ.get('EMBEDDING_STORE_DTYPE', 'float16')  # 向量精度：float16 或 float32
+EMBEDDING_STORE_INITIAL_ROWS = int(os.environ.get('EMBEDDING_STORE_INITIAL_ROWS', 4096))  # 向量文件初始行数，之后按倍数扩容
+
+_HASH_SIZE = 16
+_WHITESPACE = re.compile(r'\s+')
+
+
+def content_hash(text: str) -> bytes:
+    """规范化分块文本（NFKC、合并空白）后的哈希，排版差异不影响命中"""
+    normalized = _WHITESPACE.sub(' ', unicodedata.normalize('NFKC', text or '')).strip()
+    return hashlib.blake2b(normalized.encode('utf-8'), digest_size=_HASH_SIZE).digest()
+
+
+class _ModelStore:
+    """单个嵌入模型的向量文件和哈希索引"""
+
+    def __init__(self, directory: str, model_name: str, dimension: int, dtype: str):
+        self.directory = directory
+        self.model_name = model_name
+        self.dimension = dimension
+        self.dtype = np.dtype(dtype)
+        self.vectors_path = os.path.join(directory, 'vectors.bin')
+        self.hashes_path = os.path.join(directory, 'hashes.bin')
+        self.rows: Dict[bytes, int] = {}
+        self._hashes_size = 0
+        self._vectors = None
+        self._lock = threading.Lock()
+        self._sync()
+
+    @classmethod
+    def open(cls, directory: str, model_name: str) -> Optional['_ModelStore']:
+        """打开已有的存储，不存在时返回 None"""
+        meta_path = os.path.join(directory, 'meta.json')
+        if not os.path.exists(meta_path):
+            return None
+        with open(meta_path, 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        return cls(directory, model_name, meta['dimension'], meta['dtype'])
+
+    @classmethod
+    def create(cls, directory: str, model_name: str, dimension: int, dtype: str) -> '_ModelStore':
+        os.makedirs(directory, exist_ok=True)
+        meta_path = os.path.join(directory, 'meta.json')
+        tmp_path = meta_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump({'model': model_name, 'dimension': dimension, 'dtype': dtype}, f)
+        os.replace(tmp_path, meta_path)
+        return cls(directory, model_name, dimension, dtype)
+
+    @property
+    def row_bytes(self) -> int:
+        return self.dimension * self.dtype.itemsize
+
+    def _sync(self):
+        """读入其他进程追加的哈希，末尾不完整的记录留到下次读取"""
+        if not os.path.exists(self.hashes_path):
+            return
+        size = os.path.getsize(self.hashes_path)
+        size -= size % _HASH_SIZE
+        if size <= self._hashes_size:
+            return
+        with open(self.hashes_path, 'rb') as f:
+            f.seek(self._hashes_size)
+            data = f.read(size - self._hashes_size)
+        row = self._hashes_size // _HASH_SIZE
+        for offset in range(0, len(data), _HASH_SIZE):
+            self.rows.setdefault(data[offset:offset + _HASH_SIZE], row)
+            row += 1
+        self._hashes_size = size
+
+    def _map(self, rows: int):
+        """映射至少 rows 行的向量文件，容量不足时按倍数扩容"""
+        if self._vectors is not None and len(self._vectors) >= rows:
+            return
+        capacity = os.path.getsize(self.vectors_path) // self.row_bytes if os.path.exists(self.vectors_path) else 0
+        if capacity < rows:
+            capacity = max(EMBEDDING_STORE_INITIAL_ROWS, capacity)
+            while capacity < rows:
+                capacity *= 2
+            with open(self.vectors_path, 'ab') as f:
+                f.truncate(capacity * self.row_bytes)
+        self._vectors = np.memmap(self.vectors_path, dtype=self.dtype, mode='r+', shape=(capacity, self.dimension))
+
+    def get(self, keys: List[bytes]) -> Dict[int, 'np.ndarray']:
+        """
+        读取已保存的向量
+
+        Returns:
+            dict: keys 中的位置 -> float32 向量，未命中的位置不在结果中
+        """
+        with self._lock:
+            if any(key not in self.rows for key in keys):
+                self._sync()
+            found = {i: self.rows[key] for i, key in enumerate(keys) if key in self.rows}
+            if not found:
+                return {}
+            self._map(max(found.values()) + 1)
+            return {i: np.asarray(self._vectors[row], dtype=np.float32) for i, row in found.items()}
+
+    def put(self, keys: List[bytes], vectors: 'np.ndarray'):
+        """追加新向量，已存在的哈希跳过"""
+        if vectors.shape[1] != self.dimension:
+            raise Exception(f"向量维度 {vectors.shape[1]} 与存储维度 {self.dimension} 不一致")
+        with self._lock, open(self.hashes_path, 'ab') as hashes_file:
+            if fcntl is not None:
+                fcntl.flock(hashes_file, fcntl.LOCK_EX)
+            try:
+                self._sync()
+                # 上次追加中途退出留下的半条记录先截掉，否则之后的记录全部错位
+                if hashes_file.tell() != self._hashes_size:
+                    hashes_file.truncate(self._hashes_size)
+                new = {}
+                for key, vector in zip(keys, vectors):
+                    if key not in self.rows and key not in new:
+                        new[key] = vector
+                if not new:
+                    return
+                start = self._hashes_size // _HASH_SIZE
+                self._map(start + len(new))
+                self._vectors[start:start + len(new)] = np.stack(list(new.values())).astype(self.dtype)
+                self._vectors.flush()
+                # 向量落盘后再写哈希，读到哈希时对应的向量一定完整
+                hashes_file.write(b''.join(new))
+                hashes_file.flush()
+                for row, key in enumerate(new, start=start):
+                    self.rows[key] = row
+                self._hashes_size += len(new) * _HASH_SIZE
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(hashes_file, fcntl.LOCK_UN)
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                'model': self.model_name,
+                'dimension': self.dimension,
+                'dtype': self.dtype.name,
+                'vectors': len(self.rows),
+                'file_bytes': os.path.getsize(self.vectors_path) if os.path.exists(self.vectors_path) else 0
+            }
+
+
+class EmbeddingStore:
+    """按内容哈希复用分块向量，未命中的分块调用嵌入模型并写入存储"""
+
+    def __init__(self, directory: str = EMBEDDING_STORE_DIR, dtype: str = EMBEDDING_STORE_DTYPE):
+        self.directory = directory
+        self.dtype = dtype
+        self._stores: Dict[str, _ModelStore] = {}
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0}
+
+    def is_available(self) -> bool:
+        """依赖是否已安装"""
+        return EMBEDDING_STORE_AVAILABLE
+
+    def _model_directory(self, model_name: str) -> str:
+        return os.path.join(self.directory, re.sub(r'[^\w.-]', '_', model_name))
+
+    def _get_store(self, model_name: str, dimension: Optional[int] = None) -> Optional[_ModelStore]:
+        """获取模型的存储，不存在且给出维度时创建"""
+        with self._lock:
+            store = self._stores.get(model_name)
+            if store is None:
+                directory = self._model_directory(model_name)
+                store = _ModelStore.open(directory, model_name)
+                if store is None and dimension is not None:
+                    store = _ModelStore.create(directory, model_name, dimension, self.dtype)
+                if store is not None:
+                    self._stores[model_name] = store
+            return store
+
+    def embed(self, texts: List[str]) -> Tuple['np.ndarray', int]:
+        """
+        生成分块向量，已保存的直接读取
+
+        Returns:
+            tuple: (float32 向量矩阵, 命中存储的分块数)
+        """
+        model_name = embedding_service.model_name
+        keys = [content_hash(text) for text in texts]
+        store = self._get_store(model_name)
+        found = store.get(keys) if store is not None else {}
+
+        # 同一批中重复的分块只向量化一次
+        missing: Dict[bytes, List[int]] = {}
+        for i, key in enumerate(keys):
+            if i not in found:
+                missing.setdefault(key, []).append(i)
+        if missing:
+            positions = list(missing.values())
+            vectors = embedding_service.embed([texts[group[0]] for group in positions])
+            if store is None:
+                store = self._get_store(model_name, vectors.shape[1])
+            store.put(list(missing), vectors)
+            for group, vector in zip(positions, vectors):
+                for i in group:
+                    found[i] = vector
+
+        cached = len(texts) - sum(len(group) for group in missing.values())
+        with self._lock:
+            self._stats['hits'] += cached
+            self._stats['misses'] += len(missing)
+        return np.stack([found[i] for i in range(len(texts))]).astype(np.float32), cached
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stores = list(self._stores.values())
+        lookups = stats['hits'] + stats['misses']
+        stats['hit_rate'] = round(stats['hits'] / lookups, 4) if lookups else 0.0
+        stats['models'] = [store.get_stats() for store in stores]
+        return stats
+
+# 创建全局实例
+embedding_store = EmbeddingStore()
@@ -0,0 +1,231 @@
+"""
+生成调度模块
+在请求到达Ollama之前做准入控制：按模型限制并发生成数，
+排队时交互式对话优先于测试/批量调用，同优先级下当前占用最少的用户优先，
+队列已满或排队超时的请求直接拒绝，由接口返回429和Retry-After
+"""
+
+import os
+import time
+import math
+import threading
+from collections import deque
+from typing import Dict, Any, Optional
+from app.utils.response import GenerationRejected
+
+# 调度配置
+GENERATION_MAX_CONCURRENCY = int(os.environ.get('GENERATION_MAX_CONCURRENCY', 2))  # 每个模型的默认最大并发生成数
+GENERATION_MAX_QUEUE = int(os.environ.get('GENERATION_MAX_QUEUE', 16))  # 每个模型的最大排队数
+GENERATION_QUEUE_TIMEOUT = float(os.environ.get('GENERATION_QUEUE_TIMEOUT', 30))  # 最长排队时间（秒）
+
+# 优先级，数值越小越优先
+PRIORITY_INTERACTIVE = 'interactive'  # 用户对话
+PRIORITY_BATCH = 'batch'  # 模型测试、摘要等后台调用
+_PRIORITY_RANK = {PRIORITY_INTERACTIVE: 0, PRIORITY_BATCH: 1}
+
+class _Waiter:
+    """排队中的请求"""
+
+    def __init__(self, user_id: Optional[str], priority: str, seq: int):
+        self.user_id = user_id
+        self.rank = _PRIORITY_RANK.get(priority, 0)
+        self.seq = seq
+        self.enqueued_at = time.time()
+        self.event = threading.Event()
+        self.granted = False
+
+class _ModelQueue:
+    """单个模型的并发和排队状态"""
+
+    def __init__(self, limit: int):
+        self.limit = limit
+        self.active = 0
+        self.active_by_user: Dict[Optional[str], int] = {}
+        self.waiters = []
+        self.avg_service_time = None
+        self.wait_times = deque(maxlen=1000)
+        self.admitted = 0
+        self.rejected = 0
+        self.timeouts = 0
+
+class GenerationSlot:
+    """一个已获得的生成名额，生成结束后调用 release（可重复调用）"""
+
+    def __init__(self, scheduler: 'GenerationScheduler', model: str, user_id: Optional[str], wait_time: float):
+        self.scheduler = scheduler
+        self.model = model
+        self.user_id = user_id
+        self.wait_time = wait_time
+        self.started_at = time.time()
+        self._released = False
+
+    def release(self):
+        if self._released:
+            return
+        self._released = True
+        self.scheduler._release(self)
+
+class GenerationScheduler:
+    """按模型的生成调度器"""
+
+    def __init__(self, max_concurrency: int = GENERATION_MAX_CONCURRENCY,
+                 max_queue: int = GENERATION_MAX_QUEUE, queue_timeout: float = GENERATION_QUEUE_TIMEOUT):
+        self.max_concurrency = max_concurrency
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout
+        self._queues: Dict[str, _ModelQueue] = {}
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def acquire(self, model: str, user_id: Optional[str] = None, priority: str = PRIORITY_INTERACTIVE,
+                limit: Optional[int] = None) -> GenerationSlot:
+        """
+        获取生成名额，没有空闲名额时排队等待
+
+        Args:
+            model: 模型名称
+            user_id: 用户ID，用于同优先级下的公平分配
+            priority: interactive 或 batch
+            limit: 模型配置的并发上限，不传时使用默认值
+
+        Raises:
+            GenerationRejected: 队列已满或排队超时
+        """
+        with self._lock:
+            queue = self._get_queue(model, limit)
+            if queue.active < queue.limit and not queue.waiters:
+                return self._grant(queue, model, user_id, 0.0)
+            if len(queue.waiters) >= self.max_queue:
+                queue.rejected += 1
+                raise GenerationRejected(f"模型 {model} 当前请求过多，请稍后重试", self._retry_after(queue))
+            self._seq += 1
+            waiter = _Waiter(user_id, priority, self._seq)
+            queue.waiters.append(waiter)
+
+        try:
+            waiter.event.wait(self.queue_timeout)
+        except BaseException:
+            # 等待中的线程被中断（客户端断开、GreenletExit等）：移出队列，已分到的名额立即归还
+            with self._lock:
+                if waiter.granted:
+                    slot = GenerationSlot(self, model, user_id, 0.0)
+                else:
+                    queue.waiters.remove(waiter)
+                    slot = None
+            if slot is not None:
+                slot.release()
+            raise
+
+        with self._lock:
+            if not waiter.granted:
+                queue.waiters.remove(waiter)
+                queue.timeouts += 1
+                queue.rejected += 1
+                raise GenerationRejected(f"模型 {model} 排队超时，请稍后重试", self._retry_after(queue))
+            wait_time = time.time() - waiter.enqueued_at
+            queue.wait_times.append(wait_time)
+            return GenerationSlot(self, model, user_id, wait_time)
+
+    def try_acquire(self, model: str, user_id: Optional[str] = None,
+                    limit: Optional[int] = None) -> Optional[GenerationSlot]:
+        """有空闲名额且无人排队时立即获取名额，否则返回 None（不排队）"""
+        with self._lock:
+            queue = self._get_queue(model, limit)
+            if queue.active < queue.limit and not queue.waiters:
+                return self._grant(queue, model, user_id, 0.0)
+            return None
+
+    def check_admission(self, model: str, limit: Optional[int] = None):
+        """
+        快速检查队列是否已满，流式接口在开始输出前调用，以便直接返回429
+
+        Raises:
+            GenerationRejected: 队列已满
+        """
+        with self._lock:
+            queue = self._get_queue(model, limit)
+            if queue.active >= queue.limit and len(queue.waiters) >= self.max_queue:
+                queue.rejected += 1
+                raise GenerationRejected(f"模型 {model} 当前请求过多，请稍后重试", self._retry_after(queue))
+
+    def _get_queue(self, model: str, limit: Optional[int]) -> _ModelQueue:
+        """获取模型队列（调用方需持有锁），传入的并发上限变更时同步更新"""
+        queue = self._queues.get(model)
+        if queue is None:
+            queue = _ModelQueue(max(int(limit or self.max_concurrency), 1))
+            self._queues[model] = queue
+        elif limit and queue.limit != max(int(limit), 1):
+            queue.limit = max(int(limit), 1)
+            self._dispatch(queue)
+        return queue
+
+    def _grant(self, queue: _ModelQueue, model: str, user_id: Optional[str], wait_time: float) -> GenerationSlot:
+        """占用名额（调用方需持有锁）"""
+        queue.active += 1
+        queue.active_by_user[user_id] = queue.active_by_user.get(user_id, 0) + 1
+        queue.admitted += 1
+        queue.wait_times.append(wait_time)
+        return GenerationSlot(self, model, user_id, wait_time)
+
+    def _release(self, slot: GenerationSlot):
+        duration = time.time() - slot.started_at
+        with self._lock:
+            queue = self._queues[slot.model]
+            queue.active = max(queue.active - 1, 0)
+            remaining = queue.active_by_user.get(slot.user_id, 1) - 1
+            if remaining > 0:
+                queue.active_by_user[slot.user_id] = remaining
+            else:
+                queue.active_by_user.pop(slot.user_id, None)
+            if queue.avg_service_time is None:
+                queue.avg_service_time = duration
+            else:
+                queue.avg_service_time = 0.2 * duration + 0.8 * queue.avg_service_time
+            self._dispatch(queue)
+
+    def _dispatch(self, queue: _ModelQueue):
+        """把空闲名额分给排队的请求（调用方需持有锁）"""
+        while queue.active < queue.limit and queue.waiters:
+            # 优先级最高的请求先执行，同优先级下当前占用名额最少的用户优先，再按到达顺序
+            waiter = min(queue.waiters, key=lambda w: (w.rank, queue.active_by_user.get(w.user_id, 0), w.seq))
+            queue.waiters.remove(waiter)
+            queue.active += 1
+            queue.active_by_user[waiter.user_id] = queue.active_by_user.get(waiter.user_id, 0) + 1
+            queue.admitted += 1
+            waiter.granted = True
+            waiter.event.set()
+
+    def _retry_after(self, queue: _ModelQueue) -> int:
+        """按平均生成耗时估算排队清空所需秒数（调用方需持有锁）"""
+        service_time = queue.avg_service_time or 5.0
+        return max(1, math.ceil(service_time * (len(queue.waiters) + 1) / queue.limit))
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取各模型的并发、排队和排队耗时统计"""
+        with self._lock:
+            stats = {}
+            for model, queue in self._queues.items():
+                waits = sorted(queue.wait_times)
+                stats[model] = {
+                    'limit': queue.limit,
+                    'active': queue.active,
+                    'queued': len(queue.waiters),
+                    'admitted': queue.admitted,
+                    'rejected': queue.rejected,
+                    'timeouts': queue.timeouts,
+                    'avg_service_time': round(queue.avg_service_time, 4) if queue.avg_service_time is not None else None,
+                    'queue_time': {
+                        'avg': round(sum(waits) / len(waits), 4) if waits else 0.0,
+                        'p95': round(waits[min(len(waits) - 1, int(len(waits) * 0.95))], 4) if waits else 0.0,
+                        'max': round(waits[-1], 4) if waits else 0.0
+                    }
+                }
+            return {
+                'max_concurrency': self.max_concurrency,
+                'max_queue': self.max_queue,
+                'queue_timeout': self.queue_timeout,
+                'models': stats
+            }
+
+# 创建全局实例
+generation_scheduler = GenerationScheduler()
@@ -1,9 +1,24 @@
 import os
 import json
-from typing import List, Dict, Any, Optional
+import time
+from typing import List, Dict, Any, Optional, Callable, Tuple
 from datetime import datetime
 from bson import ObjectId
+from pymongo import ReturnDocument
 from app.services.database import get_db
+from app.services.embedding_service import embedding_service, EMBEDDING_BATCH_SIZE
+from app.services.embedding_store import embedding_store
+from app.services.vector_index import vector_indexes
+from app.services.bm25_index import bm25_indexes
+from app.services.retrieval import (
+    resolve_retrieval_options, submit_stage, wait_with_budget, reciprocal_rank_fusion, reranker
+)
+from app.utils.tokens import estimate_tokens
+from app.utils.chunking import split_into_chunks, CHUNK_MAX_TOKENS
+
+# 知识检索配置
+KNOWLEDGE_DEFAULT_DIMENSION = 384  # 知识库未配置向量维度时的默认值
+KNOWLEDGE_CONTEXT_LIMIT = int(os.environ.get('KNOWLEDGE_CONTEXT_LIMIT', 5))  # 对话上下文最多引用的分块数
 
 class KnowledgeService:
     def __init__(self):
@@ -130,8 +145,9 @@ class KnowledgeService:
             if result.deleted_count == 0:
                 raise Exception("知识库不存在")
             
-            # 删除相关文档
+            # 删除相关文档、分块和向量索引
             self.db.documents.delete_many({'knowledge_base_id': knowledge_base_id})
+            self.drop_index(knowledge_base_id)
             
             return True
             
@@ -170,6 +186,12 @@ class KnowledgeService:
             document['id'] = str(result.inserted_id)
             del document['_id']
             
+            # 分块并写入检索索引
+            if document['content']:
+                document['chunk_count'] = self.index_chunks(
+                    base, document['id'], document['name'], self.split_document(document['content'])
+                )
+            
             # 更新知识库统计信息
             self.db.knowledge_bases.update_one(
                 {'_id': ObjectId(knowledge_base_id)},
@@ -188,8 +210,16 @@ class KnowledgeService:
             raise Exception(f"上传文档失败: {str(e)}")
     
     def search_knowledge(self, knowledge_base_id: str, user_id: str, query: str, 
-                        limit: int = 5) -> List[Dict[str, Any]]:
-        """搜索知识库"""
+                        limit: int = 5, mode: str = 'hybrid', options: Optional[Dict[str, Any]] = None,
+                        timings: Optional[Dict[str, Any]] = None) -> List[Dict[str, Any]]:
+        """
+        搜索知识库
+        
+        Args:
+            mode: hybrid 关键词与向量混合检索，vector 仅向量检索，keyword 仅BM25关键词检索
+            options: 其他检索参数（rerank、candidates、budgets_ms 等，见 DEFAULT_RETRIEVAL_OPTIONS）
+            timings: 接收各阶段耗时的字典（可选）
+        """
         try:
             if not ObjectId.is_valid(knowledge_base_id):
                 raise Exception("无效的知识库ID")
@@ -203,23 +233,11 @@ class KnowledgeService:
             if not base:
                 raise Exception("知识库不存在")
             
-            # 简单的文本搜索（可以后续集成向量搜索）
-            documents = list(self.db.documents.find({
-                'knowledge_base_id': knowledge_base_id,
-                'is_active': True,
-                '$or': [
-                    {'name': {'$regex': query, '$options': 'i'}},
-                    {'content': {'$regex': query, '$options': 'i'}}
-                ]
-            }).limit(limit))
-            
-            # 格式化结果
-            for doc in documents:
-                doc['id'] = str(doc['_id'])
-                doc['created_at'] = doc['created_at'].isoformat() if doc.get('created_at') else None
-                del doc['_id']
-            
-            return documents
+            options = dict(options or {}, mode=mode, top_k=limit)
+            results, stage_timings = self.retrieve([base], query, options)
+            if timings is not None:
+                timings.update(stage_timings)
+            return results
             
         except Exception as e:
             raise Exception(f"搜索知识库失败: {str(e)}")
@@ -248,6 +266,8 @@ class KnowledgeService:
             if result.deleted_count == 0:
                 raise Exception("文档不存在")
             
+            self.remove_document_chunks(document['knowledge_base_id'], document_id)
+            
             # 更新知识库统计信息
             self.db.knowledge_bases.update_one(
                 {'_id': ObjectId(document['knowledge_base_id'])},
@@ -265,34 +285,374 @@ class KnowledgeService:
         except Exception as e:
             raise Exception(f"删除文档失败: {str(e)}")
     
-    def get_relevant_context_sync(self, query: str, knowledge_base_ids: List[str]) -> str:
-        """同步获取相关上下文"""
+    def is_vector_search_available(self) -> bool:
+        """向量检索依赖是否已安装"""
+        return vector_indexes.is_available() and embedding_service.is_available() and embedding_store.is_available()
+    
+    def _index_dimension(self, base: Dict[str, Any]) -> Optional[int]:
+        """
+        知识库的向量维度，与嵌入模型不一致时：
+        知识库还没有分块则改用嵌入模型的维度；已有分块则返回 None，该知识库只用关键词检索，
+        并在知识库上记录 vector_warning，重建索引后恢复向量检索
+        """
+        dimension = base.get('vector_dimension') or KNOWLEDGE_DEFAULT_DIMENSION
+        model_dimension = embedding_service.dimension
+        if dimension == model_dimension:
+            return dimension
+        knowledge_base_id = str(base['_id'])
+        if self.db.knowledge_chunks.find_one({'knowledge_base_id': knowledge_base_id}, {'_id': 1}) is None:
+            vector_indexes.drop(knowledge_base_id)
+            self.db.knowledge_bases.update_one(
+                {'_id': base['_id']},
+                {'$set': {'vector_dimension': model_dimension}, '$unset': {'vector_warning': ''}}
+            )
+            base['vector_dimension'] = model_dimension
+            print(f"🔧 知识库 {knowledge_base_id} 向量维度 {dimension} 改为嵌入模型维度 {model_dimension}")
+            return model_dimension
+        warning = f"知识库向量维度 {dimension} 与嵌入模型维度 {model_dimension} 不一致，仅使用关键词检索，请重建索引"
+        if base.get('vector_warning') != warning:
+            self.db.knowledge_bases.update_one({'_id': base['_id']}, {'$set': {'vector_warning': warning}})
+            base['vector_warning'] = warning
+            print(f"⚠️ 知识库 {knowledge_base_id}: {warning}")
+        return None
+    
+    def _get_index(self, base: Dict[str, Any]):
+        """获取知识库的向量索引，向量维度与嵌入模型不一致时返回 None"""
+        dimension = self._index_dimension(base)
+        return vector_indexes.get(str(base['_id']), dimension) if dimension else None
+    
+    def split_document(self, text: str) -> List[str]:
+        """
+        文档分块，分块上限不超过嵌入模型的输入长度，避免分块后半部分被截断而不进入向量
+        """
+        max_tokens = CHUNK_MAX_TOKENS
+        if self.is_vector_search_available():
+            max_tokens = min(max_tokens, embedding_service.max_input_tokens)
+        return split_into_chunks(text, max_tokens=max_tokens)
+    
+    def _get_keyword_index(self, knowledge_base_id: str):
+        """获取知识库的BM25索引，首次使用时从分块集合构建"""
+        def load_chunks():
+            cursor = self.db.knowledge_chunks.find(
+                {'knowledge_base_id': knowledge_base_id},
+                {'vector_id': 1, 'content': 1}
+            ).sort('vector_id', 1)
+            return ((chunk['vector_id'], chunk.get('content', '')) for chunk in cursor)
+        return bm25_indexes.get(knowledge_base_id, load_chunks)
+    
+    def _allocate_vector_ids(self, knowledge_base_id: str, count: int) -> List[int]:
+        """原子地分配知识库内连续的向量ID"""
+        base = self.db.knowledge_bases.find_one_and_update(
+            {'_id': ObjectId(knowledge_base_id)},
+            {'$inc': {'next_vector_id': count}},
+            projection={'next_vector_id': 1},
+            return_document=ReturnDocument.AFTER
+        )
+        end = base['next_vector_id']
+        return list(range(end - count, end))
+    
+    def index_chunks(self, base: Dict[str, Any], document_id: str, document_name: str,
+                     chunks: List[str], progress: Optional[Callable[[int], None]] = None,
+                     stats: Optional[Dict[str, Any]] = None) -> int:
+        """
+        分块写入知识库的关键词索引和向量索引
+        分块文本保存在 knowledge_chunks 集合，向量保存在向量索引和分块向量存储中（已向量化过的分块直接复用）；
+        未安装向量依赖时只写关键词索引
+        
+        Args:
+            progress: 每写入一批后以已完成的分块数回调（可选）
+            stats: 接收复用向量的分块数 cached_chunks 的字典（可选）
+        
+        Returns:
+            int: 写入的分块数
+        """
+        chunks = [chunk for chunk in chunks if chunk.strip()]
+        if not chunks:
+            return 0
+        knowledge_base_id = str(base['_id'])
+        # 与重建索引互斥，重建不会漏掉写入中的分块，写入也不会落到被替换的旧索引上
+        with vector_indexes.write_lock(knowledge_base_id):
+            index = self._get_index(base) if self.is_vector_search_available() else None
+            cached_chunks = 0
+            
+            for start in range(0, len(chunks), EMBEDDING_BATCH_SIZE):
+                batch = chunks[start:start + EMBEDDING_BATCH_SIZE]
+                vectors = None
+                if index is not None:
+                    vectors, cached = embedding_store.embed(batch)
+                    cached_chunks += cached
+                vector_ids = self._allocate_vector_ids(knowledge_base_id, len(batch))
+                now = datetime.now()
+                self.db.knowledge_chunks.insert_many([{
+                    'knowledge_base_id': knowledge_base_id,
+                    'document_id': document_id,
+                    'document_name': document_name,
+                    'chunk_index': start + i,
+                    'content': chunk,
+                    'token_count': estimate_tokens(chunk),
+                    'vector_id': vector_id,
+                    'created_at': now
+                } for i, (chunk, vector_id) in enumerate(zip(batch, vector_ids))])
+                if index is not None:
+                    index.add(vector_ids, vectors)
+                bm25_indexes.add(knowledge_base_id, zip(vector_ids, batch))
+                if progress:
+                    progress(start + len(batch))
+        if stats is not None:
+            stats['cached_chunks'] = cached_chunks
+        return len(chunks)
+    
+    def remove_document_chunks(self, knowledge_base_id: str, document_id: str) -> int:
+        """删除文档的分块和向量"""
+        vector_ids = [chunk['vector_id'] for chunk in self.db.knowledge_chunks.find(
+            {'knowledge_base_id': knowledge_base_id, 'document_id': document_id},
+            {'vector_id': 1}
+        )]
+        if not vector_ids:
+            return 0
+        with vector_indexes.write_lock(knowledge_base_id):
+            bm25_indexes.remove(knowledge_base_id, vector_ids)
+            if self.is_vector_search_available():
+                base = self.db.knowledge_bases.find_one({'_id': ObjectId(knowledge_base_id)})
+                index = self._get_index(base) if base else None
+                if index is not None:
+                    index.remove(vector_ids)
+            self.db.knowledge_chunks.delete_many({'knowledge_base_id': knowledge_base_id, 'document_id': document_id})
+        return len(vector_ids)
+    
+    def drop_index(self, knowledge_base_id: str):
+        """删除知识库的全部分块、关键词索引和向量索引"""
+        self.db.knowledge_chunks.delete_many({'knowledge_base_id': knowledge_base_id})
+        bm25_indexes.drop(knowledge_base_id)
+        if vector_indexes.is_available():
+            vector_indexes.drop(knowledge_base_id)
+    
+    def rebuild_index(self, knowledge_base_id: str) -> int:
+        """
+        按已保存的分块文本重建向量索引（更换嵌入模型、修改索引配置或索引文件损坏时使用），
+        分块向量存储中已有的向量直接复用，只有新模型下未向量化过的分块需要重新计算。
+        新索引单独构建，完成后原子替换，重建期间检索继续使用旧索引；与分块写入、删除互斥
+        
+        Returns:
+            int: 重建的分块数
+        """
+        base = self.db.knowledge_bases.find_one({'_id': ObjectId(knowledge_base_id)})
+        if not base:
+            raise Exception("知识库不存在")
+        
+        with vector_indexes.write_lock(knowledge_base_id):
+            # 重建时全部分块重新向量化，直接使用嵌入模型的维度
+            dimension = embedding_service.dimension
+            index = vector_indexes.build(knowledge_base_id, dimension)
+            total = 0
+            cached_chunks = 0
+            batch = []
+            cursor = self.db.knowledge_chunks.find(
+                {'knowledge_base_id': knowledge_base_id},
+                {'content': 1, 'vector_id': 1}
+            ).sort('vector_id', 1)
+            for chunk in cursor:
+                batch.append(chunk)
+                if len(batch) >= EMBEDDING_BATCH_SIZE:
+                    cached_chunks += self._add_to_index(index, batch)
+                    total += len(batch)
+                    batch = []
+            if batch:
+                cached_chunks += self._add_to_index(index, batch)
+                total += len(batch)
+            vector_indexes.replace(knowledge_base_id, index)
+            self.db.knowledge_bases.update_one(
+                {'_id': base['_id']},
+                {'$set': {'vector_dimension': dimension}, '$unset': {'vector_warning': ''}}
+            )
+        
+        print(f"🔧 知识库 {knowledge_base_id} 向量索引重建完成: {total} 个分块, 复用向量 {cached_chunks} 个")
+        return total
+    
+    def _add_to_index(self, index, chunks: List[Dict[str, Any]]) -> int:
+        """分块向量写入向量索引，返回复用存储向量的分块数"""
+        vectors, cached = embedding_store.embed([chunk['content'] for chunk in chunks])
+        index.add([chunk['vector_id'] for chunk in chunks], vectors)
+        return cached
+    
+    def _vector_hits(self, base: Dict[str, Any], query_vector, limit: int) -> List[Tuple[int, float]]:
+        """向量检索，过滤低于知识库相似度阈值的结果"""
+        index = self._get_index(base)
+        if index is None:
+            return []
+        threshold = base.get('similarity_threshold', 0.0)
+        return [(vector_id, score) for vector_id, score in index.search(query_vector, limit)
+                if score >= threshold]
+    
+    def retrieve(self, bases: List[Dict[str, Any]], query: str,
+                 options: Optional[Dict[str, Any]] = None) -> Tuple[List[Dict[str, Any]], Dict[str, Any]]:
+        """
+        检索流水线：关键词与向量检索并行 -> RRF融合 -> 可选交叉编码器重排
+        每个阶段超出 budgets_ms 中的预算（或该阶段同时执行的数量已满）时丢弃该阶段结果并记入 over_budget
+        
+        Args:
+            bases: 知识库文档列表
+            options: 检索参数，未指定的使用 DEFAULT_RETRIEVAL_OPTIONS
+        
+        Returns:
+            tuple: (分块列表, 各阶段耗时)。分块的 score 为重排分数、混合模式的RRF分数或单路检索的原始分数，
+                   scores 中保留各路原始分数
+        """
+        options = resolve_retrieval_options(options)
+        budgets = options['budgets_ms']
+        candidates = options['candidates']
+        mode = options['mode']
+        if mode != 'keyword' and not self.is_vector_search_available():
+            mode = 'keyword'
+        timings: Dict[str, Any] = {'mode': mode, 'over_budget': [], 'reranked': False}
+        started = time.perf_counter()
+        
+        def ms(seconds: float) -> float:
+            return round(seconds * 1000, 2)
+        
+        def keyword_stage():
+            stage_started = time.perf_counter()
+            ranked = []
+            for base in bases:
+                knowledge_base_id = str(base['_id'])
+                hits = self._get_keyword_index(knowledge_base_id).search(query, candidates)
+                ranked.append(('keyword', [((knowledge_base_id, vector_id), score) for vector_id, score in hits]))
+            return ranked, time.perf_counter() - stage_started
+        
+        def vector_stage():
+            stage_started = time.perf_counter()
+            # 查询向量只计算一次，所有知识库共用
+            query_vector = embedding_service.embed_one(query)
+            ranked = []
+            for base in bases:
+                knowledge_base_id = str(base['_id'])
+                hits = self._vector_hits(base, query_vector, candidates)
+                ranked.append(('vector', [((knowledge_base_id, vector_id), score) for vector_id, score in hits]))
+            return ranked, time.perf_counter() - stage_started
+        
+        # 第一阶段：各路检索并行，分别按各自预算等待
+        stages = []
+        if mode in ('hybrid', 'keyword'):
+            stages.append(('keyword', submit_stage('keyword', keyword_stage)))
+        if mode in ('hybrid', 'vector'):
+            stages.append(('vector', submit_stage('vector', vector_stage)))
+        ranked_lists = []
+        for name, future in stages:
+            try:
+                result, over_budget = wait_with_budget(future, budgets[name], started)
+            except Exception as e:
+                print(f"⚠️ {name} 检索失败: {str(e)}")
+                timings[f'{name}_error'] = str(e)
+                continue
+            if over_budget:
+                timings['over_budget'].append(name)
+                continue
+            ranked, seconds = result
+            ranked_lists.extend(ranked)
+            timings[f'{name}_ms'] = ms(seconds)
+        
+        # 第二阶段：RRF融合，读取需要返回或重排的分块
+        stage_started = time.perf_counter()
+        fused = reciprocal_rank_fusion(ranked_lists)
+        rerank = options['rerank'] and reranker.is_available()
+        fused = fused[:max(options['top_k'], options['rerank_top_n'] if rerank else 0)]
+        by_base: Dict[str, List[Tuple[int, float]]] = {}
+        for (knowledge_base_id, vector_id), score, _ in fused:
+            by_base.setdefault(knowledge_base_id, []).append((vector_id, score))
+        chunks = {}
+        for knowledge_base_id, hits in by_base.items():
+            for chunk in self._load_chunks(knowledge_base_id, hits):
+                chunks[(knowledge_base_id, chunk['vector_id'])] = chunk
+        results = []
+        for key, rrf_score, sources in fused:
+            chunk = chunks.get(key)
+            if chunk is None:
+                continue
+            chunk['scores'] = dict(sources, rrf=round(rrf_score, 6))
+            # 单路检索保留原始分数（相似度或BM25分数），混合检索使用RRF分数
+            chunk['score'] = chunk['scores']['rrf'] if len(stages) > 1 else round(next(iter(sources.values())), 4)
+            results.append(chunk)
+        timings['fusion_ms'] = ms(time.perf_counter() - stage_started)
+        
+        # 第三阶段：交叉编码器重排，超出预算时保持融合顺序
+        if rerank and results:
+            stage_started = time.perf_counter()
+            future = submit_stage('rerank', reranker.score, query, [chunk['content'] for chunk in results])
+            try:
+                scores, over_budget = wait_with_budget(future, budgets['rerank'], stage_started)
+            except Exception as e:
+                print(f"⚠️ 重排失败: {str(e)}")
+                scores, over_budget = None, False
+                timings['rerank_error'] = str(e)
+            if over_budget:
+                timings['over_budget'].append('rerank')
+            elif scores is not None:
+                for chunk, score in zip(results, scores):
+                    chunk['scores']['rerank'] = round(score, 4)
+                    chunk['score'] = round(score, 4)
+                results.sort(key=lambda chunk: chunk['score'], reverse=True)
+                timings['reranked'] = True
+                timings['rerank_ms'] = ms(time.perf_counter() - stage_started)
+        
+        timings['total_ms'] = ms(time.perf_counter() - started)
+        return results[:options['top_k']], timings
+    
+    def _load_chunks(self, knowledge_base_id: str, hits: List[tuple]) -> List[Dict[str, Any]]:
+        """按检索结果 (vector_id, 分数) 批量读取分块内容，保持检索顺序"""
+        if not hits:
+            return []
+        chunks = {chunk['vector_id']: chunk for chunk in self.db.knowledge_chunks.find(
+            {'knowledge_base_id': knowledge_base_id, 'vector_id': {'$in': [vector_id for vector_id, _ in hits]}},
+            {'document_id': 1, 'document_name': 1, 'chunk_index': 1, 'content': 1, 'vector_id': 1}
+        )}
+        results = []
+        for vector_id, score in hits:
+            chunk = chunks.get(vector_id)
+            if chunk is None:
+                continue
+            results.append({
+                'id': str(chunk['_id']),
+                'knowledge_base_id': knowledge_base_id,
+                'document_id': chunk.get('document_id'),
+                'document_name': chunk.get('document_name'),
+                'chunk_index': chunk.get('chunk_index'),
+                'vector_id': vector_id,
+                'content': chunk.get('content', ''),
+                'score': round(score, 4)
+            })
+        return results
+    
+    def get_relevant_context_sync(self, query: str, knowledge_base_ids: List[str],
+                                  limit: int = KNOWLEDGE_CONTEXT_LIMIT, options: Optional[Dict[str, Any]] = None,
+                                  timings: Optional[Dict[str, Any]] = None) -> str:
+        """
+        同步获取相关上下文：在各知识库中检索，取前 limit 个分块
+        
+        Args:
+            options: 检索参数（通常来自智能体 config.retrieval），其中的 top_k 优先于 limit
+            timings: 接收各阶段耗时的字典（可选）
+        """
         try:
             if not knowledge_base_ids:
                 return ""
             
-            # 从所有知识库中搜索相关内容
-            all_results = []
-            for base_id in knowledge_base_ids:
-                if ObjectId.is_valid(base_id):
-                    documents = list(self.db.documents.find({
-                        'knowledge_base_id': base_id,
-                        'is_active': True,
-                        '$or': [
-                            {'name': {'$regex': query, '$options': 'i'}},
-                            {'content': {'$regex': query, '$options': 'i'}}
-                        ]
-                    }).limit(3))
-                    
-                    all_results.extend(documents)
-            
-            # 按相关性排序（这里使用简单的文本匹配，可以后续优化）
-            relevant_docs = sorted(all_results, key=lambda x: len(x.get('content', '')), reverse=True)[:5]
+            base_ids = [ObjectId(base_id) for base_id in knowledge_base_ids if ObjectId.is_valid(base_id)]
+            bases = list(self.db.knowledge_bases.find({'_id': {'$in': base_ids}}))
+            if not bases:
+                return ""
+            
+            options = dict(options or {})
+            options.setdefault('top_k', limit)
+            relevant_chunks, stage_timings = self.retrieve(bases, query, options)
+            if timings is not None:
+                timings.update(stage_timings)
+            print(f"🔍 知识检索: {len(relevant_chunks)} 个分块, 耗时 {stage_timings['total_ms']}ms, "
+                  f"超出预算: {stage_timings['over_budget'] or '无'}")
             
             # 构建上下文
             context_parts = []
-            for doc in relevant_docs:
-                context_parts.append(f"文档: {doc.get('name', '')}\n内容: {doc.get('content', '')}")
+            for chunk in relevant_chunks:
+                context_parts.append(f"文档: {chunk.get('document_name', '')}\n内容: {chunk.get('content', '')}")
             
             return "\n\n".join(context_parts)
             
@@ -0,0 +1,146 @@
+"""
+多模型对比模块
+同一提示词并发发给多个模型，各模型的token流在线程池中读取，按到达顺序合并为一个事件流，
+每个模型单独统计首token延迟、总耗时和生成速度
+"""
+
+import os
+import time
+import queue
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Generator
+from app.services.chat_service import ChatService
+from app.utils.sse import ChunkCoalescer
+from app.utils.tokens import estimate_tokens
+
+# 对比配置
+COMPARE_MAX_MODELS = int(os.environ.get('COMPARE_MAX_MODELS', 5))  # 单次对比的最大模型数
+COMPARE_MAX_WORKERS = int(os.environ.get('COMPARE_MAX_WORKERS', 16))  # 读取模型流的线程数（所有对比请求共享）
+COMPARE_STALL_TIMEOUT = float(os.environ.get('COMPARE_STALL_TIMEOUT', 300))  # 所有模型都没有新事件超过该秒数时结束对比
+
+_executor = ThreadPoolExecutor(max_workers=COMPARE_MAX_WORKERS, thread_name_prefix='model-compare')
+_chat_service = None
+
+
+def _get_chat_service() -> ChatService:
+    global _chat_service
+    if _chat_service is None:
+        _chat_service = ChatService()
+    return _chat_service
+
+
+def _run_model(model: Dict[str, Any], content: str, conversation_id: Optional[str], show_thinking: bool,
+               user_id: Optional[str], events: queue.Queue, cancelled: threading.Event):
+    """读取单个模型的流，分片和结束统计写入事件队列，任何异常都会写入带 error 的结束事件"""
+    model_id = str(model['_id'])
+    stats: Dict[str, Any] = {}
+    started = time.time()
+    first_token_at = None
+    parts = []
+    error = None
+    stream = None
+    try:
+        stream = _get_chat_service().stream_model_response(
+            conversation_id, model, content, show_thinking=show_thinking, user_id=user_id, stats=stats
+        )
+        for chunk in stream:
+            if cancelled.is_set():
+                break
+            if first_token_at is None:
+                first_token_at = time.time()
+            parts.append(chunk)
+            events.put(('chunk', model_id, chunk))
+    except Exception as e:
+        error = str(e)
+    finally:
+        # 取消时关闭生成器，由其关闭上游连接
+        if stream is not None:
+            try:
+                stream.close()
+            except Exception as e:
+                error = error or str(e)
+
+    finished = time.time()
+    output_tokens = stats.get('eval_count') or estimate_tokens(''.join(parts))
+    generation_time = finished - (first_token_at or finished)
+    events.put(('done', model_id, {
+        'model_id': model_id,
+        'model_name': model.get('name'),
+        'ttft_ms': round((first_token_at - started) * 1000, 1) if first_token_at else None,
+        'latency_ms': round((finished - started) * 1000, 1),
+        'prompt_tokens': stats.get('prompt_eval_count', 0),
+        'output_tokens': output_tokens,
+        'tokens_per_sec': round(output_tokens / generation_time, 2) if generation_time > 0 else None,
+        'length': sum(len(p) for p in parts),
+        'complete': bool(stats.get('done')),
+        'cancelled': cancelled.is_set(),
+        'error': error
+    }))
+
+
+def compare_stream(models: List[Dict[str, Any]], content: str, conversation_id: Optional[str] = None,
+                   show_thinking: bool = False, user_id: Optional[str] = None) -> Generator[Dict[str, Any], None, None]:
+    """
+    并发生成并合并各模型的输出
+
+    Yields:
+        dict: {'model_id', 'chunk'} 分片（按模型合并发送）、{'model_id', 'metrics'} 单个模型结束、
+              最后一帧 {'done': True, 'results': [...]}
+    """
+    events: queue.Queue = queue.Queue()
+    cancelled = threading.Event()
+    coalescers = {str(m['_id']): ChunkCoalescer() for m in models}
+    results = {}
+
+    for model in models:
+        _executor.submit(_run_model, model, content, conversation_id, show_thinking, user_id, events, cancelled)
+
+    try:
+        stall_deadline = time.monotonic() + COMPARE_STALL_TIMEOUT
+        while len(results) < len(models):
+            # 等待时间不超过最早到期的合并缓冲，上游停顿时已缓冲的文本按时间窗口发出
+            wait = stall_deadline - time.monotonic()
+            for coalescer in coalescers.values():
+                due = coalescer.timeout()
+                if due is not None:
+                    wait = min(wait, due)
+            try:
+                kind, model_id, payload = events.get(timeout=max(wait, 0))
+            except queue.Empty:
+                if time.monotonic() < stall_deadline:
+                    for model_id, coalescer in coalescers.items():
+                        if coalescer.timeout() == 0:
+                            text = coalescer.flush()
+                            if text:
+                                yield {'model_id': model_id, 'chunk': text}
+                    continue
+                # 兜底：读取线程异常退出未写入结束事件时，未结束的模型按超时结束，不再无限等待
+                for model in models:
+                    model_id = str(model['_id'])
+                    if model_id not in results:
+                        text = coalescers[model_id].flush()
+                        if text:
+                            yield {'model_id': model_id, 'chunk': text}
+                        results[model_id] = {
+                            'model_id': model_id, 'model_name': model.get('name'),
+                            'complete': False, 'cancelled': False, 'error': '等待模型输出超时'
+                        }
+                        yield {'model_id': model_id, 'metrics': results[model_id]}
+                break
+            stall_deadline = time.monotonic() + COMPARE_STALL_TIMEOUT
+            if kind == 'chunk':
+                text = coalescers[model_id].add(payload)
+                if text:
+                    yield {'model_id': model_id, 'chunk': text}
+            else:
+                text = coalescers[model_id].flush()
+                if text:
+                    yield {'model_id': model_id, 'chunk': text}
+                results[model_id] = payload
+                yield {'model_id': model_id, 'metrics': payload}
+        # 按请求中的模型顺序返回汇总
+        yield {'done': True, 'results': [results[str(m['_id'])] for m in models]}
+    finally:
+        # 客户端断开时通知所有模型停止读取
+        cancelled.set()
@@ -0,0 +1,82 @@
+"""
+名称缓存模块
+列表接口按ID批量解析智能体/模型名称：先查进程内缓存，未命中的ID合并为一次 $in 查询，
+每页的查询次数与行数无关
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional
+from bson import ObjectId
+
+# 名称缓存配置
+NAME_CACHE_MAX_ENTRIES = int(os.environ.get('NAME_CACHE_MAX_ENTRIES', 10000))  # 最大条目数
+NAME_CACHE_TTL = int(os.environ.get('NAME_CACHE_TTL', 300))  # 缓存有效期（秒），名称修改时会主动失效
+
+class NameCache:
+    """LRU + TTL 名称缓存，键为 (集合名, 文档ID)"""
+
+    def __init__(self, max_entries: int = NAME_CACHE_MAX_ENTRIES, ttl: int = NAME_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        # (集合名, ID) -> (名称, 过期时间)
+        self._entries: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'queries': 0}
+
+    def resolve(self, db, collection: str, ids: Iterable[str]) -> Dict[str, Optional[str]]:
+        """
+        批量解析名称
+
+        Returns:
+            dict: ID -> 名称，文档不存在或ID无效时为 None
+        """
+        now = time.time()
+        names: Dict[str, Optional[str]] = {}
+        missing = []
+        with self._lock:
+            for doc_id in {str(i) for i in ids if i}:
+                entry = self._entries.get((collection, doc_id))
+                if entry and entry[1] > now:
+                    self._entries.move_to_end((collection, doc_id))
+                    names[doc_id] = entry[0]
+                    self._stats['hits'] += 1
+                else:
+                    missing.append(doc_id)
+                    self._stats['misses'] += 1
+
+        object_ids = [ObjectId(doc_id) for doc_id in missing if ObjectId.is_valid(doc_id)]
+        found = {}
+        if object_ids:
+            with self._lock:
+                self._stats['queries'] += 1
+            for doc in db[collection].find({'_id': {'$in': object_ids}}, {'name': 1}):
+                found[str(doc['_id'])] = doc.get('name')
+
+        with self._lock:
+            for doc_id in missing:
+                name = found.get(doc_id)
+                names[doc_id] = name
+                # 不存在的文档不缓存，避免新建后短时间内解析不到
+                if name is not None:
+                    self._entries[(collection, doc_id)] = (name, now + self.ttl)
+                    self._entries.move_to_end((collection, doc_id))
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return names
+
+    def invalidate(self, collection: str, doc_id: str):
+        """名称修改或文档删除时清除缓存"""
+        with self._lock:
+            self._entries.pop((collection, str(doc_id)), None)
+
+    def get_stats(self) -> Dict[str, int]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._entries)
+        return stats
+
+# 创建全局实例
+name_cache = NameCache()
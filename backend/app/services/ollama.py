@@ -1,36 +1,124 @@
 import requests
 import json
 import os
+import atexit
+import weakref
+import threading
+import time
+from requests.adapters import HTTPAdapter
 from typing import List, Dict, Any, Optional, Union, Generator
 from app.services.database import get_db
+from app.services.response_cache import response_cache
+from app.services.ollama_pool import backend_pool
+from app.services.single_flight import single_flight
+from app.services.generation_scheduler import generation_scheduler, GenerationRejected, PRIORITY_INTERACTIVE
 from app.models.model import Model
 from bson import ObjectId
 
 # 主进程标志 - 通过环境变量判断
 _is_main_process = os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
 
+# 连接池配置
+DEFAULT_OLLAMA_URL = 'http://localhost:11434'
+OLLAMA_POOL_CONNECTIONS = int(os.environ.get('OLLAMA_POOL_CONNECTIONS', 10))  # 缓存的主机连接池数量
+OLLAMA_POOL_MAXSIZE = int(os.environ.get('OLLAMA_POOL_MAXSIZE', 20))  # 每个主机的最大连接数
+OLLAMA_POOL_BLOCK = os.environ.get('OLLAMA_POOL_BLOCK', 'true').lower() == 'true'  # 连接耗尽时等待而不是新建
+OLLAMA_CLIENT_IDLE_TIMEOUT = int(os.environ.get('OLLAMA_CLIENT_IDLE_TIMEOUT', 300))  # 客户端空闲回收时间（秒）
+OLLAMA_KEEP_ALIVE = os.environ.get('OLLAMA_KEEP_ALIVE', '')  # 模型常驻时间（如 30m），保持KV缓存热度
+
+# 模型配置缓存，避免每次生成都查询数据库
+MODEL_CONFIG_CACHE_TTL = int(os.environ.get('MODEL_CONFIG_CACHE_TTL', 60))  # 缓存有效期（秒）
+_model_config_cache: Dict[str, tuple] = {}
+_model_config_cache_lock = threading.Lock()
+_model_config_cache_stats = {'hits': 0, 'misses': 0, 'invalidations': 0}
+# 失效代数：按名称失效时该名称加一，清空时 '*' 加一；读库期间代数变化说明配置已更新，读到的文档不写入缓存
+_model_config_generations: Dict[str, int] = {'*': 0}
+
+
+def _load_model_document(model_name: str) -> Optional[Dict]:
+    """读取模型文档，命中缓存时不访问数据库（不存在的模型也会被缓存）"""
+    now = time.time()
+    with _model_config_cache_lock:
+        entry = _model_config_cache.get(model_name)
+        if entry and entry[1] > now:
+            _model_config_cache_stats['hits'] += 1
+            return entry[0]
+        _model_config_cache_stats['misses'] += 1
+        generation = (_model_config_generations['*'], _model_config_generations.get(model_name, 0))
+
+    db = get_db()
+    model = db.models.find_one({'name': model_name}, {
+        'server_url': 1, 'server_urls': 1, 'api_key': 1, 'max_tokens': 1, 'temperature': 1,
+        'top_p': 1, 'frequency_penalty': 1, 'presence_penalty': 1, 'max_concurrency': 1
+    })
+    with _model_config_cache_lock:
+        if generation == (_model_config_generations['*'], _model_config_generations.get(model_name, 0)):
+            _model_config_cache[model_name] = (model, now + MODEL_CONFIG_CACHE_TTL)
+    return model
+
+
+def invalidate_model_config(model_name: Optional[str] = None):
+    """使模型配置缓存失效，不传名称时清空全部缓存"""
+    with _model_config_cache_lock:
+        if model_name is None:
+            _model_config_cache.clear()
+            _model_config_generations['*'] += 1
+        else:
+            _model_config_cache.pop(model_name, None)
+            _model_config_generations[model_name] = _model_config_generations.get(model_name, 0) + 1
+        _model_config_cache_stats['invalidations'] += 1
+
+
+def get_model_config_cache_stats() -> Dict[str, Any]:
+    """获取模型配置缓存的命中统计"""
+    with _model_config_cache_lock:
+        hits = _model_config_cache_stats['hits']
+        misses = _model_config_cache_stats['misses']
+        total = hits + misses
+        return {
+            'size': len(_model_config_cache),
+            'ttl': MODEL_CONFIG_CACHE_TTL,
+            'hits': hits,
+            'misses': misses,
+            'invalidations': _model_config_cache_stats['invalidations'],
+            'hit_rate': round(hits / total, 4) if total else 0.0
+        }
+
 class OllamaService:
-    def __init__(self, base_url: str = "http://localhost:11434"):
+    def __init__(self, base_url: str = DEFAULT_OLLAMA_URL):
         self.base_url = base_url.rstrip('/')
         self.session = requests.Session()
+        # 挂载可调节的连接池，pool_block 保证每个主机的并发连接数不超过上限
+        adapter = HTTPAdapter(
+            pool_connections=OLLAMA_POOL_CONNECTIONS,
+            pool_maxsize=OLLAMA_POOL_MAXSIZE,
+            pool_block=OLLAMA_POOL_BLOCK
+        )
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.last_used = time.time()
         if _is_main_process:
             print(f"🔧 OllamaService初始化: {self.base_url}")
             # 启动时不检测连接，只在需要时才检测
     
-    def _get_model_config(self, model_name: str) -> Optional[Dict]:
-        """获取模型配置"""
+    def get_model_config(self, model_name: str) -> Dict[str, Any]:
+        """获取模型配置（连接地址、生成参数和并发上限），模型不存在时返回默认配置"""
         try:
-            db = get_db()
-            model = db.models.find_one({'name': model_name})
+            model = _load_model_document(model_name)
             if model:
+                api_base = model.get('server_url', self.base_url)
+                # server_urls 中的服务器与 server_url 一起组成后端池
+                api_bases = [api_base] + [u for u in (model.get('server_urls') or []) if u and u != api_base]
                 return {
-                    'api_base': model.get('server_url', self.base_url),
+                    'api_base': api_base,
+                    'api_bases': api_bases,
                     'api_key': model.get('api_key', ''),
                     'max_tokens': model.get('max_tokens', 4096),
                     'temperature': model.get('temperature', 0.7),
                     'top_p': model.get('top_p', 1.0),
                     'frequency_penalty': model.get('frequency_penalty', 0.0),
-                    'presence_penalty': model.get('presence_penalty', 0.0)
+                    'presence_penalty': model.get('presence_penalty', 0.0),
+                    'max_concurrency': model.get('max_concurrency')
                 }
         except Exception as e:
             if _is_main_process:
@@ -39,6 +127,7 @@ class OllamaService:
         # 返回默认配置
         return {
             'api_base': self.base_url,
+            'api_bases': [self.base_url],
             'api_key': '',
             'max_tokens': 4096,
             'temperature': 0.7,
@@ -164,9 +253,74 @@ class OllamaService:
                 print(f"❌ 拉取模型失败: {str(e)}")
             raise Exception(f"拉取模型失败: {str(e)}")
     
+    def _post(self, endpoint: str, payload: Dict[str, Any], config: Dict[str, Any],
+              route_key: Optional[str] = None, stream: bool = False,
+              priority: str = PRIORITY_INTERACTIVE, user_id: Optional[str] = None) -> requests.Response:
+        """
+        经生成调度器准入后，从后端池中选择服务器发送请求，连接失败时换一台后端重试
+
+        返回的响应对象带有 lease 属性，调用方读取完毕后需要调用 response.lease.release()，
+        生成名额随后端一起归还
+        """
+        slot = generation_scheduler.acquire(payload['model'], user_id, priority, config.get('max_concurrency'))
+        try:
+            response, lease = self._send(endpoint, payload, config, route_key, stream)
+        except BaseException:
+            slot.release()
+            raise
+        lease.on_release(slot.release)
+        response.queue_wait = slot.wait_time
+        
+        if _is_main_process:
+            print(f"📊 响应状态码: {response.status_code}")
+        
+        if response.status_code != 200:
+            # 只有服务端错误计入后端健康状态
+            lease.release(ok=response.status_code < 500)
+            if _is_main_process:
+                print(f"❌ Ollama API请求失败: {response.status_code} - {response.text}")
+            raise Exception(f"Ollama API请求失败: {response.status_code} - {response.text}")
+        
+        response.lease = lease
+        return response
+    
+    def _send(self, endpoint: str, payload: Dict[str, Any], config: Dict[str, Any],
+              route_key: Optional[str], stream: bool):
+        """发送请求，返回 (响应, 后端租约)"""
+        api_bases = config.get('api_bases') or [config['api_base']]
+        tried = []
+        while True:
+            lease = backend_pool.acquire(api_bases, route_key, exclude=tried)
+            
+            if _is_main_process:
+                print(f"📤 发送请求到: {lease.url}{endpoint}")
+            
+            try:
+                response = self.session.post(
+                    f"{lease.url}{endpoint}",
+                    json=payload,
+                    headers={'Content-Type': 'application/json'},
+                    timeout=60,
+                    stream=stream  # 流式模式下逐行读取，不等待完整响应
+                )
+                break
+            except requests.exceptions.ConnectionError:
+                lease.release(ok=False)
+                tried.append(lease.url)
+                if len(tried) >= len(api_bases):
+                    raise
+                print(f"⚠️ Ollama后端连接失败，切换后端重试: {lease.url}")
+            except requests.exceptions.RequestException:
+                lease.release(ok=False)
+                raise
+        lease.record_latency()
+        return response, lease
+    
     def chat(self, model: str, messages: List[Dict[str, str]], 
              temperature: float = 0.7, max_tokens: int = 2000,
-             stream: bool = False) -> Union[Dict[str, Any], requests.Response]:
+             stream: bool = False, use_cache: bool = False,
+             route_key: Optional[str] = None, priority: str = PRIORITY_INTERACTIVE,
+             user_id: Optional[str] = None) -> Union[Dict[str, Any], requests.Response]:
         """
         与Ollama模型进行对话
         
@@ -176,6 +330,10 @@ class OllamaService:
             temperature: 温度参数
             max_tokens: 最大token数
             stream: 是否流式返回
+            use_cache: 是否使用响应缓存并合并相同的进行中请求（temperature 为 0 时自动启用，仅非流式）
+            route_key: 粘性路由键（如对话ID），多后端时尽量路由到同一服务器
+            priority: 调度优先级，interactive 为用户对话，batch 为测试等后台调用
+            user_id: 发起请求的用户ID，排队时按用户公平分配
             
         Returns:
             包含回复的字典
@@ -184,17 +342,7 @@ class OllamaService:
             print(f"💬 开始聊天: 模型={model}, 温度={temperature}, 最大token={max_tokens}")
             
             # 获取模型配置
-            config = self._get_model_config(model)
-            if config is None:
-                config = {
-                    'api_base': self.base_url,
-                    'api_key': '',
-                    'max_tokens': 4096,
-                    'temperature': 0.7,
-                    'top_p': 1.0,
-                    'frequency_penalty': 0.0,
-                    'presence_penalty': 0.0
-                }
+            config = self.get_model_config(model)
             
             # 构建请求数据
             payload = {
@@ -209,39 +357,58 @@ class OllamaService:
                     'presence_penalty': config.get('presence_penalty', 0.0)
                 }
             }
+            if OLLAMA_KEEP_ALIVE:
+                payload['keep_alive'] = OLLAMA_KEEP_ALIVE
             
-            if _is_main_process:
-                print(f"📤 发送请求到: {config['api_base']}/api/chat")
-            
-            # 发送请求
-            response = self.session.post(
-                f"{config['api_base']}/api/chat",
-                json=payload,
-                headers={'Content-Type': 'application/json'},
-                timeout=60
-            )
-            
-            if _is_main_process:
-                print(f"📊 响应状态码: {response.status_code}")
-            
-            if response.status_code != 200:
-                if _is_main_process:
-                    print(f"❌ Ollama API请求失败: {response.status_code} - {response.text}")
-                raise Exception(f"Ollama API请求失败: {response.status_code} - {response.text}")
+            # 确定性请求或显式开启时查询响应缓存
+            cache_key = None
+            if not stream and (use_cache or temperature == 0):
+                cache_key = response_cache.make_key(model, messages, temperature, payload['options']['top_p'], max_tokens)
+                cached = response_cache.get(cache_key)
+                if cached:
+                    print(f"⚡ 命中响应缓存: 模型={model}")
+                    cached['cached'] = True
+                    return cached
             
             if stream:
-                return response
-            else:
-                result = response.json()
+                # 流式响应由调用方读取完毕后释放后端
+                return self._post('/api/chat', payload, config, route_key, True, priority, user_id)
+            
+            def fetch():
+                response = self._post('/api/chat', payload, config, route_key, False, priority, user_id)
+                try:
+                    result = response.json()
+                finally:
+                    response.lease.release()
                 if _is_main_process:
                     print("✅ 聊天完成")
-                return {
+                output = {
                     'content': result.get('message', {}).get('content', ''),
                     'model': result.get('model', model),
                     'usage': result.get('usage', {}),
-                    'done': result.get('done', True)
+                    'done': result.get('done', True),
+                    'prompt_eval_count': result.get('prompt_eval_count', 0),
+                    'eval_count': result.get('eval_count', 0),
+                    'eval_duration': result.get('eval_duration', 0)
                 }
+                if cache_key:
+                    response_cache.set(cache_key, model, output)
+                # 排队时间只属于本次请求，不写入缓存
+                return dict(output, queue_wait=response.queue_wait)
+            
+            if cache_key:
+                # 相同的确定性请求正在进行时直接等待其结果
+                output, shared = single_flight.do(cache_key, fetch)
+                output = dict(output)
+                output['coalesced'] = shared
+            else:
+                output = fetch()
+            output['cached'] = False
+            return output
                 
+        except GenerationRejected:
+            # 准入拒绝原样抛出，由接口返回429
+            raise
         except Exception as e:
             if _is_main_process:
                 print(f"❌ Ollama服务调用失败: {str(e)}")
@@ -249,7 +416,9 @@ class OllamaService:
     
     def generate(self, model: str, prompt: str, 
                 temperature: float = 0.7, max_tokens: int = 2000,
-                stream: bool = False) -> Union[Dict[str, Any], requests.Response]:
+                stream: bool = False, use_cache: bool = False,
+                route_key: Optional[str] = None, priority: str = PRIORITY_INTERACTIVE,
+                user_id: Optional[str] = None) -> Union[Dict[str, Any], requests.Response]:
         """
         使用Ollama模型生成文本
         
@@ -259,6 +428,10 @@ class OllamaService:
             temperature: 温度参数
             max_tokens: 最大token数
             stream: 是否流式返回
+            use_cache: 是否使用响应缓存并合并相同的进行中请求（temperature 为 0 时自动启用，仅非流式）
+            route_key: 粘性路由键（如对话ID），多后端时尽量路由到同一服务器
+            priority: 调度优先级，interactive 为用户对话，batch 为测试等后台调用
+            user_id: 发起请求的用户ID，排队时按用户公平分配
             
         Returns:
             包含生成文本的字典
@@ -267,17 +440,7 @@ class OllamaService:
             print(f"📝 开始生成: 模型={model}, 提示词长度={len(prompt)}")
             
             # 获取模型配置
-            config = self._get_model_config(model)
-            if config is None:
-                config = {
-                    'api_base': self.base_url,
-                    'api_key': '',
-                    'max_tokens': 4096,
-                    'temperature': 0.7,
-                    'top_p': 1.0,
-                    'frequency_penalty': 0.0,
-                    'presence_penalty': 0.0
-                }
+            config = self.get_model_config(model)
             
             # 构建请求数据
             payload = {
@@ -292,52 +455,73 @@ class OllamaService:
                     'presence_penalty': config.get('presence_penalty', 0.0)
                 }
             }
+            if OLLAMA_KEEP_ALIVE:
+                payload['keep_alive'] = OLLAMA_KEEP_ALIVE
             
-            if _is_main_process:
-                print(f"📤 发送请求到: {config['api_base']}/api/generate")
-            
-            # 发送请求
-            response = self.session.post(
-                f"{config['api_base']}/api/generate",
-                json=payload,
-                headers={'Content-Type': 'application/json'},
-                timeout=60
-            )
-            
-            if _is_main_process:
-                print(f"📊 响应状态码: {response.status_code}")
-            
-            if response.status_code != 200:
-                if _is_main_process:
-                    print(f"❌ Ollama API请求失败: {response.status_code} - {response.text}")
-                raise Exception(f"Ollama API请求失败: {response.status_code} - {response.text}")
+            # 确定性请求或显式开启时查询响应缓存
+            cache_key = None
+            if not stream and (use_cache or temperature == 0):
+                cache_key = response_cache.make_key(model, prompt, temperature, payload['options']['top_p'], max_tokens)
+                cached = response_cache.get(cache_key)
+                if cached:
+                    print(f"⚡ 命中响应缓存: 模型={model}")
+                    cached['cached'] = True
+                    return cached
             
             if stream:
-                return response
-            else:
-                result = response.json()
+                # 流式响应由调用方读取完毕后释放后端
+                return self._post('/api/generate', payload, config, route_key, True, priority, user_id)
+            
+            def fetch():
+                response = self._post('/api/generate', payload, config, route_key, False, priority, user_id)
+                try:
+                    result = response.json()
+                finally:
+                    response.lease.release()
                 if _is_main_process:
                     print("✅ 文本生成完成")
-                return {
+                output = {
                     'content': result.get('response', ''),
                     'model': result.get('model', model),
                     'usage': result.get('usage', {}),
-                    'done': result.get('done', True)
+                    'done': result.get('done', True),
+                    'prompt_eval_count': result.get('prompt_eval_count', 0),
+                    'eval_count': result.get('eval_count', 0),
+                    'eval_duration': result.get('eval_duration', 0)
                 }
+                if cache_key:
+                    response_cache.set(cache_key, model, output)
+                # 排队时间只属于本次请求，不写入缓存
+                return dict(output, queue_wait=response.queue_wait)
+            
+            if cache_key:
+                # 相同的确定性请求正在进行时直接等待其结果
+                output, shared = single_flight.do(cache_key, fetch)
+                output = dict(output)
+                output['coalesced'] = shared
+            else:
+                output = fetch()
+            output['cached'] = False
+            return output
                 
+        except GenerationRejected:
+            # 准入拒绝原样抛出，由接口返回429
+            raise
         except Exception as e:
             if _is_main_process:
                 print(f"❌ Ollama服务调用失败: {str(e)}")
             raise Exception(f"Ollama服务调用失败: {str(e)}") 
 
     def generate_text(self, model_name: str, prompt: str, 
-                     temperature: float = 0.7, max_tokens: int = 1000) -> str:
+                     temperature: float = 0.7, max_tokens: int = 1000, use_cache: bool = False,
+                     priority: str = PRIORITY_INTERACTIVE, user_id: Optional[str] = None) -> str:
         """
         生成文本（简化版本）
         """
         try:
             # 直接尝试生成，不进行健康检查
-            result = self.generate(model_name, prompt, temperature, max_tokens, stream=False)
+            result = self.generate(model_name, prompt, temperature, max_tokens, stream=False, use_cache=use_cache,
+                                   priority=priority, user_id=user_id)
             # 处理返回的字典类型
             if isinstance(result, dict):
                 return result.get('content', '抱歉，生成失败')
@@ -347,33 +531,185 @@ class OllamaService:
             print(f"❌ 文本生成失败: {str(e)}")
             raise e
     
+    def chat_text(self, model_name: str, messages: List[Dict[str, str]],
+                  temperature: float = 0.7, max_tokens: int = 1000, use_cache: bool = False,
+                  priority: str = PRIORITY_INTERACTIVE, user_id: Optional[str] = None) -> str:
+        """
+        对话生成文本（简化版本）
+        """
+        try:
+            result = self.chat(model_name, messages, temperature, max_tokens, stream=False, use_cache=use_cache,
+                               priority=priority, user_id=user_id)
+            if isinstance(result, dict):
+                return result.get('content', '抱歉，生成失败')
+            else:
+                return '抱歉，生成失败'
+        except Exception as e:
+            print(f"❌ 对话生成失败: {str(e)}")
+            raise e
+    
+    def stream_chat(self, model_name: str, messages: List[Dict[str, str]],
+                    temperature: float = 0.7, max_tokens: int = 1000,
+                    stats: Optional[Dict[str, Any]] = None,
+                    route_key: Optional[str] = None, priority: str = PRIORITY_INTERACTIVE,
+                    user_id: Optional[str] = None) -> Generator[str, None, None]:
+        """
+        流式对话生成
+
+        使用结构化的 /api/chat 接口，历史消息前缀保持不变，
+        Ollama 可以复用已缓存的KV前缀，而不是每轮重新预填充整段对话。
+        传入 stats 字典时，正常结束后会写入 done 标记和Ollama返回的token统计。
+        temperature 为 0 时输出是确定的，相同的并发请求共享同一个上游token流。
+        """
+        if temperature == 0:
+            key = single_flight.make_key('chat', self.base_url, model_name, messages, temperature, max_tokens)
+            return single_flight.stream(
+                key,
+                lambda flight_stats: self._stream_chat_upstream(model_name, messages, temperature, max_tokens, flight_stats,
+                                                                route_key, priority, user_id),
+                stats
+            )
+        return self._stream_chat_upstream(model_name, messages, temperature, max_tokens, stats, route_key, priority, user_id)
+    
+    def _stream_chat_upstream(self, model_name: str, messages: List[Dict[str, str]],
+                              temperature: float, max_tokens: int,
+                              stats: Optional[Dict[str, Any]] = None,
+                              route_key: Optional[str] = None, priority: str = PRIORITY_INTERACTIVE,
+                              user_id: Optional[str] = None) -> Generator[str, None, None]:
+        """读取 /api/chat 的流式响应"""
+        try:
+            print(f"💬 开始流式对话: 模型={model_name}, 消息数={len(messages)}")
+            
+            response = self.chat(model_name, messages, temperature, max_tokens, stream=True, route_key=route_key,
+                                 priority=priority, user_id=user_id)
+            if stats is not None:
+                stats['queue_wait'] = getattr(response, 'queue_wait', 0.0)
+            
+            if isinstance(response, requests.Response):
+                failed = False
+                aborted = threading.Event()
+                if stats is not None:
+                    stats['abort'] = lambda: _abort_response(response, aborted)
+                try:
+                    for line in response.iter_lines():
+                        if line:
+                            try:
+                                data = json.loads(line.decode('utf-8'))
+                                content = data.get('message', {}).get('content')
+                                if content:
+                                    yield content
+                                if data.get('done', False):
+                                    if stats is not None:
+                                        stats.update({
+                                            'done': True,
+                                            'prompt_eval_count': data.get('prompt_eval_count', 0),
+                                            'eval_count': data.get('eval_count', 0),
+                                            'eval_duration': data.get('eval_duration', 0),
+                                            'total_duration': data.get('total_duration', 0)
+                                        })
+                                    break
+                            except json.JSONDecodeError:
+                                continue
+                except requests.exceptions.RequestException:
+                    # 调用方主动中断读取时直接结束，不算后端故障
+                    if aborted.is_set():
+                        return
+                    failed = True
+                    raise
+                finally:
+                    # 客户端提前停止读取不算后端故障
+                    response.close()
+                    response.lease.release(ok=not failed)
+            else:
+                raise Exception("流式对话失败")
+        
+        except GenerationRejected as e:
+            print(f"⚠️ 生成请求被拒绝: {str(e)}")
+            yield f"抱歉，当前请求较多，请约 {e.retry_after} 秒后重试。"
+        except requests.exceptions.ConnectionError as e:
+            print(f"❌ Ollama连接失败: {str(e)}")
+            yield f"抱歉，无法连接到AI模型服务器。请检查网络连接或联系管理员。"
+        except requests.exceptions.Timeout as e:
+            print(f"❌ Ollama请求超时: {str(e)}")
+            yield f"抱歉，AI模型响应超时。请稍后重试。"
+        except Exception as e:
+            print(f"❌ 流式对话生成失败: {str(e)}")
+            yield f"抱歉，生成回复时遇到错误：{str(e)}"
+    
     def stream_text(self, model_name: str, prompt: str, 
-                   temperature: float = 0.7, max_tokens: int = 1000) -> Generator[str, None, None]:
+                   temperature: float = 0.7, max_tokens: int = 1000,
+                   stats: Optional[Dict[str, Any]] = None,
+                   route_key: Optional[str] = None, priority: str = PRIORITY_INTERACTIVE,
+                   user_id: Optional[str] = None) -> Generator[str, None, None]:
         """
         流式生成文本
+        传入 stats 字典时写入的统计与 stream_chat 一致；
+        temperature 为 0 时相同的并发请求共享同一个上游token流
         """
+        if temperature == 0:
+            key = single_flight.make_key('generate', self.base_url, model_name, prompt, temperature, max_tokens)
+            return single_flight.stream(
+                key,
+                lambda flight_stats: self._stream_text_upstream(model_name, prompt, temperature, max_tokens, flight_stats,
+                                                                route_key, priority, user_id),
+                stats
+            )
+        return self._stream_text_upstream(model_name, prompt, temperature, max_tokens, stats, route_key, priority, user_id)
+    
+    def _stream_text_upstream(self, model_name: str, prompt: str,
+                              temperature: float, max_tokens: int,
+                              stats: Optional[Dict[str, Any]] = None,
+                              route_key: Optional[str] = None, priority: str = PRIORITY_INTERACTIVE,
+                              user_id: Optional[str] = None) -> Generator[str, None, None]:
+        """读取 /api/generate 的流式响应"""
         try:
             print(f"📝 开始生成: 模型={model_name}, 提示词长度={len(prompt)}")
             
             # 直接尝试生成，不进行健康检查
-            response = self.generate(model_name, prompt, temperature, max_tokens, stream=True)
-            
-            # 处理返回的Response对象
-            from requests import Response
-            if isinstance(response, Response):
-                for line in response.iter_lines():
-                    if line:
-                        try:
-                            data = json.loads(line.decode('utf-8'))
-                            if 'response' in data:
-                                yield data['response']
-                            if data.get('done', False):
-                                break
-                        except json.JSONDecodeError:
-                            continue
+            response = self.generate(model_name, prompt, temperature, max_tokens, stream=True, route_key=route_key,
+                                     priority=priority, user_id=user_id)
+            if stats is not None:
+                stats['queue_wait'] = getattr(response, 'queue_wait', 0.0)
+            
+            if isinstance(response, requests.Response):
+                failed = False
+                aborted = threading.Event()
+                if stats is not None:
+                    stats['abort'] = lambda: _abort_response(response, aborted)
+                try:
+                    for line in response.iter_lines():
+                        if line:
+                            try:
+                                data = json.loads(line.decode('utf-8'))
+                                if 'response' in data:
+                                    yield data['response']
+                                if data.get('done', False):
+                                    if stats is not None:
+                                        stats.update({
+                                            'done': True,
+                                            'prompt_eval_count': data.get('prompt_eval_count', 0),
+                                            'eval_count': data.get('eval_count', 0),
+                                            'eval_duration': data.get('eval_duration', 0),
+                                            'total_duration': data.get('total_duration', 0)
+                                        })
+                                    break
+                            except json.JSONDecodeError:
+                                continue
+                except requests.exceptions.RequestException:
+                    # 调用方主动中断读取时直接结束，不算后端故障
+                    if aborted.is_set():
+                        return
+                    failed = True
+                    raise
+                finally:
+                    response.close()
+                    response.lease.release(ok=not failed)
             else:
                 raise Exception("流式生成失败")
                             
+        except GenerationRejected as e:
+            print(f"⚠️ 生成请求被拒绝: {str(e)}")
+            yield f"抱歉，当前请求较多，请约 {e.retry_after} 秒后重试。"
         except requests.exceptions.ConnectionError as e:
             print(f"❌ Ollama连接失败: {str(e)}")
             yield f"抱歉，无法连接到AI模型服务器。请检查网络连接或联系管理员。"
@@ -382,4 +718,76 @@ class OllamaService:
             yield f"抱歉，AI模型响应超时。请稍后重试。"
         except Exception as e:
             print(f"❌ 流式文本生成失败: {str(e)}")
-            yield f"抱歉，生成回复时遇到错误：{str(e)}" 
\ No newline at end of file
+            yield f"抱歉，生成回复时遇到错误：{str(e)}"
+
+
+def _abort_response(response: requests.Response, aborted: threading.Event):
+    """
+    从其他线程中断正在读取的流式响应
+    关闭底层套接字，阻塞在读取上的线程立即返回，模型长时间没有输出时也能及时释放连接和生成名额
+    """
+    aborted.set()
+    try:
+        raw = response.raw
+        if hasattr(raw, 'shutdown'):
+            raw.shutdown()
+        else:
+            response.close()
+    except Exception as e:
+        print(f"⚠️ 中断流式响应失败: {str(e)}")
+
+
+# 全局Ollama客户端注册表，按服务器地址复用长连接
+_clients: Dict[str, OllamaService] = {}
+_clients_lock = threading.Lock()
+_last_reap = time.time()
+
+
+def get_ollama_service(base_url: Optional[str] = None) -> OllamaService:
+    """
+    获取共享的Ollama客户端
+
+    同一服务器地址在进程内只创建一个客户端，复用其HTTP连接池，
+    避免每次请求都重新建立TCP连接。
+    """
+    global _last_reap
+    key = (base_url or DEFAULT_OLLAMA_URL).rstrip('/')
+    now = time.time()
+
+    with _clients_lock:
+        # 定期回收空闲客户端
+        if now - _last_reap > OLLAMA_CLIENT_IDLE_TIMEOUT:
+            _reap_idle_clients(now)
+            _last_reap = now
+
+        service = _clients.get(key)
+        if service is None:
+            service = OllamaService(key)
+            _clients[key] = service
+        service.last_used = now
+        return service
+
+
+def _reap_idle_clients(now: float):
+    """
+    从注册表移除空闲超时的客户端（调用方需持有锁）
+    调用方可能仍持有客户端并在使用其连接，这里不直接关闭会话，而是在客户端不再被引用时关闭
+    """
+    for key in list(_clients.keys()):
+        service = _clients[key]
+        if now - service.last_used > OLLAMA_CLIENT_IDLE_TIMEOUT:
+            weakref.finalize(service, service.session.close)
+            del _clients[key]
+            if _is_main_process:
+                print(f"🧹 回收空闲Ollama客户端: {key}")
+
+
+def close_ollama_services():
+    """关闭所有共享的Ollama客户端（进程退出时调用）"""
+    with _clients_lock:
+        for service in _clients.values():
+            service.session.close()
+        _clients.clear()
+
+
+atexit.register(close_ollama_services)
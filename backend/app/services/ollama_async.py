@@ -0,0 +1,285 @@
+"""
+Ollama异步客户端模块
+基于 asyncio/aiohttp 的流式生成客户端，接口与 OllamaService 的 generate/chat/stream_text/stream_chat 一致，
+单个事件循环即可同时维持大量token流，不依赖eventlet对阻塞IO的补丁
+"""
+
+import json
+import asyncio
+from typing import List, Dict, Any, Optional, AsyncGenerator
+from app.services.ollama import (
+    get_ollama_service, DEFAULT_OLLAMA_URL, OLLAMA_POOL_MAXSIZE, OLLAMA_KEEP_ALIVE
+)
+from app.services.response_cache import response_cache
+from app.services.ollama_pool import backend_pool
+from app.services.generation_scheduler import generation_scheduler, GenerationRejected, PRIORITY_INTERACTIVE
+
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    aiohttp = None
+    AIOHTTP_AVAILABLE = False
+
+
+def _release_acquired_slot(future: 'asyncio.Future'):
+    """已取消的排队请求拿到生成名额后释放"""
+    if not future.cancelled() and future.exception() is None:
+        future.result().release()
+
+
+class AsyncOllamaService:
+    """
+    Ollama异步客户端
+
+    用法:
+        async with AsyncOllamaService(base_url) as client:
+            async for chunk in client.stream_text(model, prompt):
+                ...
+    """
+
+    def __init__(self, base_url: str = DEFAULT_OLLAMA_URL, max_connections: int = OLLAMA_POOL_MAXSIZE):
+        if not AIOHTTP_AVAILABLE:
+            raise Exception("未安装 aiohttp，无法使用异步客户端")
+        self.base_url = base_url.rstrip('/')
+        self.max_connections = max_connections
+        self._session = None
+
+    async def __aenter__(self) -> 'AsyncOllamaService':
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.close()
+
+    def _get_session(self) -> 'aiohttp.ClientSession':
+        """延迟创建会话，会话绑定到当前事件循环"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.max_connections, keepalive_timeout=60)
+            self._session = aiohttp.ClientSession(
+                connector=connector,
+                timeout=aiohttp.ClientTimeout(total=None, connect=10, sock_read=60)
+            )
+        return self._session
+
+    async def close(self):
+        """关闭会话和连接池"""
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _get_model_config(self, model_name: str) -> Dict[str, Any]:
+        """获取模型配置（复用同步客户端的配置缓存，在线程池中执行以免阻塞事件循环）"""
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(None, get_ollama_service(self.base_url).get_model_config, model_name)
+
+    def _build_payload(self, model: str, key: str, value: Any, config: Dict[str, Any],
+                       temperature: float, max_tokens: int, stream: bool) -> Dict[str, Any]:
+        """构建请求数据"""
+        payload = {
+            'model': model,
+            key: value,
+            'stream': stream,
+            'options': {
+                'temperature': temperature,
+                'num_predict': max_tokens,
+                'top_p': config.get('top_p', 1.0),
+                'frequency_penalty': config.get('frequency_penalty', 0.0),
+                'presence_penalty': config.get('presence_penalty', 0.0)
+            }
+        }
+        if OLLAMA_KEEP_ALIVE:
+            payload['keep_alive'] = OLLAMA_KEEP_ALIVE
+        return payload
+
+    async def _post(self, endpoint: str, payload: Dict[str, Any], config: Dict[str, Any],
+                    route_key: Optional[str], priority: str, user_id: Optional[str]):
+        """
+        经生成调度器准入后从后端池选择服务器发送请求，连接失败时换一台后端重试
+
+        Returns:
+            (响应, 后端租约)，调用方读取完毕后需要关闭响应并释放租约
+        """
+        # 有空闲名额时直接获取，需要排队时才在线程池中等待
+        slot = generation_scheduler.try_acquire(payload['model'], user_id, config.get('max_concurrency'))
+        if slot is None:
+            loop = asyncio.get_running_loop()
+            acquiring = loop.run_in_executor(
+                None, generation_scheduler.acquire, payload['model'], user_id, priority, config.get('max_concurrency')
+            )
+            try:
+                slot = await asyncio.shield(acquiring)
+            except asyncio.CancelledError:
+                # 等待方被取消（客户端断开、wait_for超时）时线程仍会拿到名额，拿到后立即归还，避免永久占用并发数
+                acquiring.add_done_callback(_release_acquired_slot)
+                raise
+        api_bases = config.get('api_bases') or [config['api_base']]
+        tried = []
+        try:
+            while True:
+                lease = backend_pool.acquire(api_bases, route_key, exclude=tried)
+                try:
+                    response = await self._get_session().post(f"{lease.url}{endpoint}", json=payload)
+                    break
+                except aiohttp.ClientConnectionError:
+                    lease.release(ok=False)
+                    tried.append(lease.url)
+                    if len(tried) >= len(api_bases):
+                        raise
+                    print(f"⚠️ Ollama后端连接失败，切换后端重试: {lease.url}")
+                except BaseException:
+                    lease.release(ok=False)
+                    raise
+        except BaseException:
+            slot.release()
+            raise
+        lease.on_release(slot.release)
+        lease.record_latency()
+
+        if response.status != 200:
+            text = await response.text()
+            response.release()
+            lease.release(ok=response.status < 500)
+            raise Exception(f"Ollama API请求失败: {response.status} - {text}")
+        return response, lease
+
+    async def _request(self, endpoint: str, key: str, model: str, value: Any,
+                       temperature: float, max_tokens: int, use_cache: bool,
+                       route_key: Optional[str], priority: str, user_id: Optional[str]) -> Dict[str, Any]:
+        """非流式请求，temperature 为 0 或开启 use_cache 时使用响应缓存"""
+        config = await self._get_model_config(model)
+        payload = self._build_payload(model, key, value, config, temperature, max_tokens, False)
+
+        cache_key = None
+        if use_cache or temperature == 0:
+            cache_key = response_cache.make_key(model, value, temperature, payload['options']['top_p'], max_tokens)
+            cached = response_cache.get(cache_key)
+            if cached:
+                cached['cached'] = True
+                return cached
+
+        response, lease = await self._post(endpoint, payload, config, route_key, priority, user_id)
+        try:
+            result = await response.json(content_type=None)
+        except BaseException:
+            lease.release(ok=False)
+            raise
+        finally:
+            response.release()
+        lease.release()
+
+        if endpoint == '/api/chat':
+            content = result.get('message', {}).get('content', '')
+        else:
+            content = result.get('response', '')
+        output = {
+            'content': content,
+            'model': result.get('model', model),
+            'usage': result.get('usage', {}),
+            'done': result.get('done', True)
+        }
+        if cache_key:
+            response_cache.set(cache_key, model, output)
+        output['cached'] = False
+        return output
+
+    async def _stream(self, endpoint: str, key: str, model: str, value: Any,
+                      temperature: float, max_tokens: int, stats: Optional[Dict[str, Any]],
+                      route_key: Optional[str], priority: str, user_id: Optional[str]) -> AsyncGenerator[str, None]:
+        """读取流式响应，调用方提前停止迭代时关闭上游连接"""
+        config = await self._get_model_config(model)
+        payload = self._build_payload(model, key, value, config, temperature, max_tokens, True)
+        response, lease = await self._post(endpoint, payload, config, route_key, priority, user_id)
+
+        failed = False
+        finished = False
+        try:
+            async for line in response.content:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    data = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if endpoint == '/api/chat':
+                    content = data.get('message', {}).get('content')
+                else:
+                    content = data.get('response')
+                if content:
+                    yield content
+                if data.get('done', False):
+                    finished = True
+                    if stats is not None:
+                        stats.update({
+                            'done': True,
+                            'prompt_eval_count': data.get('prompt_eval_count', 0),
+                            'eval_count': data.get('eval_count', 0),
+                            'total_duration': data.get('total_duration', 0)
+                        })
+                    break
+        except aiohttp.ClientError:
+            failed = True
+            raise
+        finally:
+            # 提前停止读取时直接断开连接，让Ollama停止生成；正常结束时连接放回连接池
+            if finished:
+                response.release()
+            else:
+                response.close()
+            lease.release(ok=not failed)
+
+    async def generate(self, model: str, prompt: str, temperature: float = 0.7, max_tokens: int = 2000,
+                       use_cache: bool = False, route_key: Optional[str] = None,
+                       priority: str = PRIORITY_INTERACTIVE, user_id: Optional[str] = None) -> Dict[str, Any]:
+        """使用Ollama模型生成文本，返回值与 OllamaService.generate 一致"""
+        return await self._request('/api/generate', 'prompt', model, prompt, temperature, max_tokens,
+                                   use_cache, route_key, priority, user_id)
+
+    async def chat(self, model: str, messages: List[Dict[str, str]], temperature: float = 0.7,
+                   max_tokens: int = 2000, use_cache: bool = False, route_key: Optional[str] = None,
+                   priority: str = PRIORITY_INTERACTIVE, user_id: Optional[str] = None) -> Dict[str, Any]:
+        """与Ollama模型进行对话，返回值与 OllamaService.chat 一致"""
+        return await self._request('/api/chat', 'messages', model, messages, temperature, max_tokens,
+                                   use_cache, route_key, priority, user_id)
+
+    async def stream_text(self, model_name: str, prompt: str, temperature: float = 0.7,
+                          max_tokens: int = 1000, route_key: Optional[str] = None,
+                          priority: str = PRIORITY_INTERACTIVE,
+                          user_id: Optional[str] = None) -> AsyncGenerator[str, None]:
+        """流式生成文本"""
+        try:
+            async for chunk in self._stream('/api/generate', 'prompt', model_name, prompt, temperature,
+                                            max_tokens, None, route_key, priority, user_id):
+                yield chunk
+        except GenerationRejected as e:
+            yield f"抱歉，当前请求较多，请约 {e.retry_after} 秒后重试。"
+        except aiohttp.ClientConnectionError as e:
+            print(f"❌ Ollama连接失败: {str(e)}")
+            yield "抱歉，无法连接到AI模型服务器。请检查网络连接或联系管理员。"
+        except asyncio.TimeoutError as e:
+            print(f"❌ Ollama请求超时: {str(e)}")
+            yield "抱歉，AI模型响应超时。请稍后重试。"
+        except Exception as e:
+            print(f"❌ 流式文本生成失败: {str(e)}")
+            yield f"抱歉，生成回复时遇到错误：{str(e)}"
+
+    async def stream_chat(self, model_name: str, messages: List[Dict[str, str]], temperature: float = 0.7,
+                          max_tokens: int = 1000, stats: Optional[Dict[str, Any]] = None,
+                          route_key: Optional[str] = None, priority: str = PRIORITY_INTERACTIVE,
+                          user_id: Optional[str] = None) -> AsyncGenerator[str, None]:
+        """流式对话生成，传入 stats 字典时正常结束后写入token统计"""
+        try:
+            async for chunk in self._stream('/api/chat', 'messages', model_name, messages, temperature,
+                                            max_tokens, stats, route_key, priority, user_id):
+                yield chunk
+        except GenerationRejected as e:
+            yield f"抱歉，当前请求较多，请约 {e.retry_after} 秒后重试。"
+        except aiohttp.ClientConnectionError as e:
+            print(f"❌ Ollama连接失败: {str(e)}")
+            yield "抱歉，无法连接到AI模型服务器。请检查网络连接或联系管理员。"
+        except asyncio.TimeoutError as e:
+            print(f"❌ Ollama请求超时: {str(e)}")
+            yield "抱歉，AI模型响应超时。请稍后重试。"
+        except Exception as e:
+            print(f"❌ 流式对话生成失败: {str(e)}")
+            yield f"抱歉，生成回复时遇到错误：{str(e)}"
@@ -0,0 +1,175 @@
+"""
+Ollama后端池模块
+一个模型可以由多台Ollama服务器提供，按未完成请求数或延迟EWMA选择后端，
+连续失败的后端会被暂时摘除，同一对话尽量固定在同一后端以保持KV缓存热度
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, List, Optional
+
+# 后端池配置
+OLLAMA_ROUTING = os.environ.get('OLLAMA_ROUTING', 'least_outstanding')  # least_outstanding 或 ewma
+OLLAMA_EWMA_ALPHA = float(os.environ.get('OLLAMA_EWMA_ALPHA', 0.3))  # 延迟EWMA平滑系数
+OLLAMA_EJECT_FAILURES = int(os.environ.get('OLLAMA_EJECT_FAILURES', 3))  # 连续失败多少次后摘除
+OLLAMA_EJECT_SECONDS = int(os.environ.get('OLLAMA_EJECT_SECONDS', 30))  # 摘除时长（秒）
+OLLAMA_STICKY_TTL = int(os.environ.get('OLLAMA_STICKY_TTL', 1800))  # 对话粘性路由有效期（秒）
+OLLAMA_STICKY_MAX_KEYS = int(os.environ.get('OLLAMA_STICKY_MAX_KEYS', 10000))  # 最多记录的粘性路由数
+
+class _BackendState:
+    """单个后端的运行状态"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.outstanding = 0
+        self.ewma_latency = None
+        self.consecutive_failures = 0
+        self.ejected_until = 0.0
+        self.total_requests = 0
+        self.total_errors = 0
+
+    def is_healthy(self, now: float) -> bool:
+        return self.ejected_until <= now
+
+    def to_dict(self, now: float) -> Dict[str, Any]:
+        return {
+            'url': self.url,
+            'healthy': self.is_healthy(now),
+            'outstanding': self.outstanding,
+            'ewma_latency': round(self.ewma_latency, 4) if self.ewma_latency is not None else None,
+            'consecutive_failures': self.consecutive_failures,
+            'total_requests': self.total_requests,
+            'total_errors': self.total_errors
+        }
+
+class BackendLease:
+    """
+    一次请求占用的后端
+    请求发出后调用 record_latency，结束时调用 release（可重复调用）
+    """
+
+    def __init__(self, pool: 'BackendPool', url: str):
+        self.pool = pool
+        self.url = url
+        self.started_at = time.time()
+        self.latency = None
+        self._released = False
+        self._callbacks = []
+
+    def on_release(self, callback):
+        """注册释放后端时需要一并执行的回调（如归还生成名额）"""
+        self._callbacks.append(callback)
+
+    def record_latency(self):
+        """记录从发出请求到收到响应头的耗时"""
+        if self.latency is None:
+            self.latency = time.time() - self.started_at
+
+    def release(self, ok: bool = True):
+        if self._released:
+            return
+        self._released = True
+        self.pool._release(self, ok)
+        for callback in self._callbacks:
+            callback()
+
+class BackendPool:
+    """Ollama后端池"""
+
+    def __init__(self, routing: str = OLLAMA_ROUTING):
+        self.routing = routing
+        self._backends: Dict[str, _BackendState] = {}
+        self._sticky: OrderedDict = OrderedDict()  # route_key -> (url, 过期时间)
+        self._lock = threading.Lock()
+
+    def acquire(self, urls: List[str], route_key: Optional[str] = None,
+                exclude: Optional[List[str]] = None) -> BackendLease:
+        """
+        从候选地址中选择一个后端
+
+        Args:
+            urls: 候选服务器地址
+            route_key: 粘性路由键（通常为对话ID），同一个键优先路由到同一后端
+            exclude: 本次请求已经失败过的地址
+        """
+        urls = [u.rstrip('/') for u in urls if u]
+        if exclude and len(urls) > len(exclude):
+            urls = [u for u in urls if u not in exclude]
+        if not urls:
+            raise Exception("没有可用的Ollama服务器地址")
+        now = time.time()
+
+        with self._lock:
+            states = [self._get_state(u) for u in urls]
+            healthy = [s for s in states if s.is_healthy(now)]
+            # 全部被摘除时仍然需要尝试，选择最早恢复的后端
+            candidates = healthy or sorted(states, key=lambda s: s.ejected_until)[:1]
+
+            chosen = None
+            if route_key and len(urls) > 1:
+                sticky = self._sticky.get(route_key)
+                if sticky and sticky[1] > now:
+                    chosen = next((s for s in candidates if s.url == sticky[0]), None)
+
+            if chosen is None:
+                chosen = min(candidates, key=self._score)
+
+            if route_key and len(urls) > 1:
+                self._sticky[route_key] = (chosen.url, now + OLLAMA_STICKY_TTL)
+                self._sticky.move_to_end(route_key)
+                while len(self._sticky) > OLLAMA_STICKY_MAX_KEYS:
+                    self._sticky.popitem(last=False)
+
+            chosen.outstanding += 1
+            chosen.total_requests += 1
+            return BackendLease(self, chosen.url)
+
+    def _score(self, state: _BackendState):
+        """路由评分，越小越优先"""
+        latency = state.ewma_latency if state.ewma_latency is not None else 0.0
+        if self.routing == 'ewma':
+            # 按排队请求数放大延迟，避免所有请求涌向同一台最快的后端
+            return (latency * (state.outstanding + 1), state.outstanding)
+        return (state.outstanding, latency)
+
+    def _release(self, lease: BackendLease, ok: bool):
+        now = time.time()
+        with self._lock:
+            state = self._get_state(lease.url)
+            state.outstanding = max(state.outstanding - 1, 0)
+            if ok:
+                state.consecutive_failures = 0
+                if lease.latency is not None:
+                    if state.ewma_latency is None:
+                        state.ewma_latency = lease.latency
+                    else:
+                        state.ewma_latency = OLLAMA_EWMA_ALPHA * lease.latency + (1 - OLLAMA_EWMA_ALPHA) * state.ewma_latency
+            else:
+                state.total_errors += 1
+                state.consecutive_failures += 1
+                if state.consecutive_failures >= OLLAMA_EJECT_FAILURES:
+                    state.ejected_until = now + OLLAMA_EJECT_SECONDS
+                    print(f"⚠️ Ollama后端连续失败 {state.consecutive_failures} 次，暂时摘除: {state.url}")
+
+    def _get_state(self, url: str) -> _BackendState:
+        """获取后端状态（调用方需持有锁）"""
+        state = self._backends.get(url)
+        if state is None:
+            state = _BackendState(url)
+            self._backends[url] = state
+        return state
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取后端池状态"""
+        now = time.time()
+        with self._lock:
+            return {
+                'routing': self.routing,
+                'sticky_keys': len(self._sticky),
+                'backends': [s.to_dict(now) for s in self._backends.values()]
+            }
+
+# 创建全局实例
+backend_pool = BackendPool()
@@ -0,0 +1,103 @@
+"""
+响应缓存服务模块
+对确定性的非流式生成结果做精确匹配缓存，命中时不再调用Ollama
+"""
+
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+
+# 缓存配置
+RESPONSE_CACHE_MAX_ENTRIES = int(os.environ.get('RESPONSE_CACHE_MAX_ENTRIES', 1000))  # 最大条目数
+RESPONSE_CACHE_MAX_BYTES = int(os.environ.get('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))  # 最大占用字节数
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 3600))  # 缓存有效期（秒）
+
+class ResponseCache:
+    """
+    LRU + TTL 响应缓存
+    键由 (模型, 完整提示词, temperature, top_p, max_tokens) 计算得出
+    """
+
+    def __init__(self, max_entries: int = RESPONSE_CACHE_MAX_ENTRIES,
+                 max_bytes: int = RESPONSE_CACHE_MAX_BYTES, ttl: int = RESPONSE_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        # key -> (模型名称, 结果, 过期时间, 字节数)
+        self._entries: OrderedDict = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'expirations': 0}
+
+    @staticmethod
+    def make_key(model: str, prompt: Any, temperature: float, top_p: float, max_tokens: int) -> str:
+        """计算缓存键，prompt 可以是字符串或结构化消息列表"""
+        raw = json.dumps([model, prompt, temperature, top_p, max_tokens], ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """读取缓存，过期条目会被删除"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats['misses'] += 1
+                return None
+            if entry[2] <= time.time():
+                self._remove(key)
+                self._stats['expirations'] += 1
+                self._stats['misses'] += 1
+                return None
+            self._entries.move_to_end(key)
+            self._stats['hits'] += 1
+            return dict(entry[1])
+
+    def set(self, key: str, model: str, result: Dict[str, Any]):
+        """写入缓存，超出条目数或字节数上限时淘汰最久未使用的条目"""
+        size = len(json.dumps(result, ensure_ascii=False).encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (model, dict(result), time.time() + self.ttl, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                oldest = next(iter(self._entries))
+                self._remove(oldest)
+                self._stats['evictions'] += 1
+
+    def invalidate_model(self, model: Optional[str] = None):
+        """清除指定模型的缓存，不传模型时清空全部缓存"""
+        with self._lock:
+            if model is None:
+                self._entries.clear()
+                self._bytes = 0
+                return
+            for key in [k for k, v in self._entries.items() if v[0] == model]:
+                self._remove(key)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存统计"""
+        with self._lock:
+            total = self._stats['hits'] + self._stats['misses']
+            return {
+                'size': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'ttl': self.ttl,
+                **self._stats,
+                'hit_rate': round(self._stats['hits'] / total, 4) if total else 0.0
+            }
+
+    def _remove(self, key: str):
+        """删除条目（调用方需持有锁）"""
+        entry = self._entries.pop(key)
+        self._bytes -= entry[3]
+
+# 创建全局实例
+response_cache = ResponseCache()
@@ -0,0 +1,178 @@
+"""
+知识检索流水线模块
+关键词（BM25）与向量检索并行执行，用倒数排名融合（RRF）合并，可选用 sentence-transformers 交叉编码器对前N个结果重排。
+每个阶段有独立的耗时预算，超出预算的阶段结果被丢弃（尚未开始的取消，已开始的在后台执行完毕），
+每个阶段同时执行的数量有上限，慢阶段不会占满线程池拖慢其他阶段；返回各阶段耗时供调优；
+智能体可以在 config.retrieval 中覆盖默认参数，在召回质量和延迟之间取舍。
+"""
+
+import os
+import time
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, Future, TimeoutError as FutureTimeoutError
+from typing import Dict, Any, List, Optional, Tuple, Callable
+from app.services.database import get_db
+from app.services.embedding_service import embedding_service
+
+try:
+    from sentence_transformers import CrossEncoder
+    RERANKER_AVAILABLE = True
+except ImportError:
+    CrossEncoder = None
+    RERANKER_AVAILABLE = False
+
+# 检索配置
+RETRIEVAL_STAGE_CONCURRENCY = int(os.environ.get('RETRIEVAL_STAGE_CONCURRENCY', 4))  # 每个阶段同时执行的最大数量
+RETRIEVAL_MAX_WORKERS = int(os.environ.get('RETRIEVAL_MAX_WORKERS', 3 * RETRIEVAL_STAGE_CONCURRENCY))  # 并行检索的线程数（所有请求共享）
+RETRIEVAL_WARMUP = os.environ.get('RETRIEVAL_WARMUP', 'true').lower() == 'true'  # 启动时预加载嵌入模型，启用了重排时同时预加载重排模型
+RETRIEVAL_RRF_K = int(os.environ.get('RETRIEVAL_RRF_K', 60))  # RRF平滑常数，越大排名靠后的结果权重越高
+RERANK_MODEL = os.environ.get('RERANK_MODEL', 'cross-encoder/mmarco-mMiniLMv2-L12-H384-v1')  # 支持中文的多语言交叉编码器
+
+# 默认检索参数，智能体 config.retrieval 中的同名字段覆盖默认值
+DEFAULT_RETRIEVAL_OPTIONS = {
+    'mode': 'hybrid',  # hybrid 混合检索，vector 仅向量，keyword 仅关键词
+    'top_k': 5,  # 返回的分块数
+    'candidates': 20,  # 每路检索召回的候选数
+    'rerank': False,  # 是否用交叉编码器重排
+    'rerank_top_n': 20,  # 参与重排的融合结果数
+    'budgets_ms': {
+        'keyword': 50,  # 关键词检索
+        'vector': 300,  # 查询向量化和向量检索
+        'rerank': 500  # 交叉编码器重排
+    }
+}
+
+logger = logging.getLogger(__name__)
+
+_executor = ThreadPoolExecutor(max_workers=RETRIEVAL_MAX_WORKERS, thread_name_prefix='retrieval')
+_stage_slots: Dict[str, threading.BoundedSemaphore] = {}
+_stage_slots_lock = threading.Lock()
+
+
+def resolve_retrieval_options(overrides: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """合并默认参数和覆盖参数（budgets_ms 按阶段合并）"""
+    options = dict(DEFAULT_RETRIEVAL_OPTIONS)
+    options['budgets_ms'] = dict(DEFAULT_RETRIEVAL_OPTIONS['budgets_ms'])
+    for key, value in (overrides or {}).items():
+        if key == 'budgets_ms' and isinstance(value, dict):
+            options['budgets_ms'].update(value)
+        elif key in options and value is not None:
+            options[key] = value
+    if options['mode'] not in ('hybrid', 'vector', 'keyword'):
+        raise Exception(f"无效的检索模式: {options['mode']}")
+    return options
+
+
+def submit_stage(stage: str, fn: Callable, *args) -> Optional[Future]:
+    """
+    在检索线程池中执行一个阶段，该阶段同时执行的数量已达上限时返回 None（调用方按超出预算处理）
+    """
+    with _stage_slots_lock:
+        slots = _stage_slots.setdefault(stage, threading.BoundedSemaphore(RETRIEVAL_STAGE_CONCURRENCY))
+    if not slots.acquire(blocking=False):
+        return None
+    try:
+        future = _executor.submit(fn, *args)
+    except BaseException:
+        slots.release()
+        raise
+    # 执行完毕或被取消时归还名额
+    future.add_done_callback(lambda _: slots.release())
+    return future
+
+
+def wait_with_budget(future: Optional[Future], budget_ms: float, started: float) -> Tuple[Any, bool]:
+    """
+    等待阶段结果，预算从 started（perf_counter）开始计算；超出预算时取消尚未开始执行的阶段
+
+    Returns:
+        tuple: (结果，超出预算时为 None, 是否超出预算)
+    """
+    if future is None:
+        return None, True
+    remaining = budget_ms / 1000 - (time.perf_counter() - started)
+    try:
+        return future.result(timeout=max(remaining, 0)), False
+    except FutureTimeoutError:
+        future.cancel()
+        return None, True
+
+
+def _rerank_enabled() -> bool:
+    """默认参数或任一智能体的 config.retrieval 启用了重排"""
+    if DEFAULT_RETRIEVAL_OPTIONS['rerank']:
+        return True
+    return get_db().agents.find_one({'config.retrieval.rerank': True}, {'_id': 1}) is not None
+
+
+def warm_up():
+    """
+    后台预加载嵌入模型，启用了重排时同时预加载重排模型，避免第一次检索时加载模型超出预算、返回空上下文；
+    未启用重排时不下载和加载交叉编码器
+    """
+    def run():
+        try:
+            if embedding_service.is_available():
+                embedding_service.embed_one('预热')
+            if reranker.is_available() and _rerank_enabled():
+                reranker.score('预热', ['预热'])
+            logger.info("检索模型预加载完成")
+        except Exception as e:
+            logger.warning(f"检索模型预加载失败: {str(e)}")
+
+    if RETRIEVAL_WARMUP:
+        threading.Thread(target=run, name='retrieval-warmup', daemon=True).start()
+
+
+def reciprocal_rank_fusion(ranked_lists: List[Tuple[str, List[Tuple[Any, float]]]],
+                           k: int = RETRIEVAL_RRF_K) -> List[Tuple[Any, float, Dict[str, float]]]:
+    """
+    倒数排名融合：每个结果的分数为其在各路检索中 1/(k + 排名) 之和，各路的原始分数不需要可比
+
+    Args:
+        ranked_lists: [(检索名, [(结果键, 原始分数)])]，每路按原始分数降序，同名的多路（如多个知识库）分别排名
+
+    Returns:
+        list: (结果键, 融合分数, 各路原始分数)，按融合分数降序
+    """
+    fused: Dict[Any, float] = {}
+    sources: Dict[Any, Dict[str, float]] = {}
+    for name, hits in ranked_lists:
+        for rank, (key, score) in enumerate(hits, start=1):
+            fused[key] = fused.get(key, 0.0) + 1.0 / (k + rank)
+            sources.setdefault(key, {})[name] = score
+    return sorted(((key, score, sources[key]) for key, score in fused.items()), key=lambda x: x[1], reverse=True)
+
+
+class Reranker:
+    """交叉编码器重排，模型在首次使用时加载"""
+
+    def __init__(self, model_name: str = RERANK_MODEL):
+        self.model_name = model_name
+        self._model = None
+        self._lock = threading.Lock()
+
+    def is_available(self) -> bool:
+        """依赖是否已安装"""
+        return RERANKER_AVAILABLE
+
+    def _get_model(self):
+        if self._model is None:
+            with self._lock:
+                if self._model is None:
+                    if not RERANKER_AVAILABLE:
+                        raise Exception("未安装 sentence-transformers，无法重排")
+                    print(f"🔧 加载重排模型: {self.model_name}")
+                    self._model = CrossEncoder(self.model_name, max_length=512)
+        return self._model
+
+    def score(self, query: str, texts: List[str]) -> List[float]:
+        """计算查询与每段文本的相关性分数"""
+        if not texts:
+            return []
+        scores = self._get_model().predict([(query, text) for text in texts], show_progress_bar=False)
+        return [float(s) for s in scores]
+
+# 创建全局实例
+reranker = Reranker()
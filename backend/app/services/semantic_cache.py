@@ -0,0 +1,160 @@
+"""
+语义缓存服务模块
+为开启语义缓存的智能体保存已回答的问题向量，相似问题直接返回已有回答。
+每个条目带上下文指纹（系统提示词、检索到的知识、对话历史），只有上下文相同的问题才会命中，
+不会把基于某个用户对话历史生成的回答返回给其他用户或其他对话。
+"""
+
+import os
+import time
+import threading
+from collections import OrderedDict
+from typing import Dict, Any, Optional
+from app.services.embedding_service import embedding_service
+
+try:
+    import numpy as np
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    np = None
+    faiss = None
+    FAISS_AVAILABLE = False
+
+# 语义缓存配置
+SEMANTIC_CACHE_THRESHOLD = float(os.environ.get('SEMANTIC_CACHE_THRESHOLD', 0.92))  # 默认相似度阈值
+SEMANTIC_CACHE_MAX_ENTRIES = int(os.environ.get('SEMANTIC_CACHE_MAX_ENTRIES', 500))  # 每个智能体的最大条目数
+SEMANTIC_CACHE_MAX_AGENTS = int(os.environ.get('SEMANTIC_CACHE_MAX_AGENTS', 100))  # 最多缓存的智能体数
+SEMANTIC_CACHE_TTL = int(os.environ.get('SEMANTIC_CACHE_TTL', 24 * 3600))  # 条目有效期（秒）
+SEMANTIC_CACHE_SEARCH_K = int(os.environ.get('SEMANTIC_CACHE_SEARCH_K', 8))  # 查找时检查的最相似条目数
+
+class _AgentCache:
+    """单个智能体的向量索引和问答条目"""
+
+    def __init__(self, dimension: int):
+        self.index = faiss.IndexIDMap(faiss.IndexFlatIP(dimension))
+        # 条目ID -> (问题, 回答, 写入时间, 上下文指纹)，按写入顺序淘汰
+        self.entries: OrderedDict = OrderedDict()
+        self.next_id = 0
+        self.hits = 0
+        self.misses = 0
+
+    def remove(self, entry_id: int):
+        self.index.remove_ids(np.array([entry_id], dtype='int64'))
+        self.entries.pop(entry_id, None)
+
+class SemanticCache:
+    """按智能体隔离的语义缓存"""
+
+    def __init__(self, max_entries: int = SEMANTIC_CACHE_MAX_ENTRIES,
+                 max_agents: int = SEMANTIC_CACHE_MAX_AGENTS, ttl: int = SEMANTIC_CACHE_TTL):
+        self.max_entries = max_entries
+        self.max_agents = max_agents
+        self.ttl = ttl
+        self._agents: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_available(self) -> bool:
+        """依赖是否已安装"""
+        return FAISS_AVAILABLE and embedding_service.is_available()
+
+    def embed(self, question: str):
+        """生成问题向量，查找和写入可共用同一个向量"""
+        return embedding_service.embed_one(question).reshape(1, -1)
+
+    def lookup(self, agent_id: str, question: str, threshold: float = SEMANTIC_CACHE_THRESHOLD,
+               vector=None, context: str = '') -> Optional[Dict[str, Any]]:
+        """
+        查找相似问题的已有回答
+        检查最相似的若干条目，返回第一个未过期、上下文指纹相同且达到阈值的条目，
+        最相似的条目过期或上下文不同时不会挡住其他有效条目
+
+        Returns:
+            命中时返回 {'content', 'score', 'question'}，否则返回 None
+        """
+        if not self.is_available():
+            return None
+        if vector is None:
+            vector = self.embed(question)
+
+        with self._lock:
+            cache = self._agents.get(agent_id)
+            if cache is None:
+                return None
+            self._agents.move_to_end(agent_id)
+            vector = vector.reshape(1, -1)
+
+            if cache.index.ntotal > 0:
+                scores, ids = cache.index.search(vector, min(SEMANTIC_CACHE_SEARCH_K, cache.index.ntotal))
+                now = time.time()
+                for entry_id, score in zip(ids[0], scores[0]):
+                    entry_id, score = int(entry_id), float(score)
+                    # 结果按相似度降序，低于阈值后不必再看
+                    if entry_id == -1 or score < threshold:
+                        break
+                    entry = cache.entries.get(entry_id)
+                    if entry is None:
+                        continue
+                    if now - entry[2] > self.ttl:
+                        cache.remove(entry_id)
+                        continue
+                    if entry[3] == context:
+                        cache.hits += 1
+                        return {'content': entry[1], 'score': score, 'question': entry[0]}
+            cache.misses += 1
+            return None
+
+    def store(self, agent_id: str, question: str, answer: str, vector=None, context: str = ''):
+        """保存问答及生成时的上下文指纹，超出上限时淘汰最早的条目"""
+        if not self.is_available() or not answer:
+            return
+        if vector is None:
+            vector = self.embed(question)
+        vector = vector.reshape(1, -1)
+
+        with self._lock:
+            cache = self._agents.get(agent_id)
+            if cache is None:
+                cache = _AgentCache(vector.shape[1])
+                self._agents[agent_id] = cache
+                while len(self._agents) > self.max_agents:
+                    self._agents.popitem(last=False)
+            self._agents.move_to_end(agent_id)
+
+            entry_id = cache.next_id
+            cache.next_id += 1
+            cache.index.add_with_ids(vector, np.array([entry_id], dtype='int64'))
+            cache.entries[entry_id] = (question, answer, time.time(), context)
+            while len(cache.entries) > self.max_entries:
+                cache.remove(next(iter(cache.entries)))
+
+    def invalidate_agent(self, agent_id: str):
+        """清除智能体的缓存（智能体配置变更时调用）"""
+        with self._lock:
+            self._agents.pop(agent_id, None)
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取缓存统计"""
+        with self._lock:
+            hits = sum(c.hits for c in self._agents.values())
+            misses = sum(c.misses for c in self._agents.values())
+            return {
+                'available': self.is_available(),
+                'agents': len(self._agents),
+                'entries': sum(len(c.entries) for c in self._agents.values()),
+                'hits': hits,
+                'misses': misses,
+                'hit_rate': round(hits / (hits + misses), 4) if hits + misses else 0.0,
+                'per_agent': {
+                    agent_id: {
+                        'entries': len(c.entries),
+                        'hits': c.hits,
+                        'misses': c.misses,
+                        'hit_rate': round(c.hits / (c.hits + c.misses), 4) if c.hits + c.misses else 0.0
+                    }
+                    for agent_id, c in self._agents.items()
+                }
+            }
+
+# 创建全局实例
+semantic_cache = SemanticCache()
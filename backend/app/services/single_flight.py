@@ -0,0 +1,183 @@
+"""
+请求合并模块
+并发的相同确定性生成请求只向Ollama发起一次调用，
+非流式请求共享同一个结果，流式请求从同一个token流分发给所有订阅者
+"""
+
+import json
+import hashlib
+import threading
+from typing import Dict, Any, Callable, Iterable, Optional, Tuple, Generator
+
+class _Call:
+    """一次进行中的非流式调用"""
+
+    def __init__(self):
+        self.event = threading.Event()
+        self.result = None
+        self.error = None
+        self.waiters = 0
+
+class _StreamFlight:
+    """一次进行中的流式调用，已产生的分片会保留，迟到的订阅者从头重放"""
+
+    def __init__(self):
+        self.chunks = []
+        self.stats: Dict[str, Any] = {}
+        self.done = False
+        self.cancelled = False
+        self.subscribers = 0
+        self.condition = threading.Condition()
+
+class SingleFlight:
+    """按请求键合并进行中的调用"""
+
+    def __init__(self):
+        self._calls: Dict[str, _Call] = {}
+        self._streams: Dict[str, _StreamFlight] = {}
+        self._lock = threading.Lock()
+        self._stats = {'calls': 0, 'shared_calls': 0, 'streams': 0, 'shared_streams': 0}
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """计算合并键"""
+        raw = json.dumps(parts, ensure_ascii=False, sort_keys=True)
+        return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+    def do(self, key: str, fn: Callable[[], Any]) -> Tuple[Any, bool]:
+        """
+        执行调用，同一个键已有调用进行中时等待其结果
+
+        Returns:
+            (结果, 是否复用了其他请求的调用)
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = _Call()
+                self._calls[key] = call
+                self._stats['calls'] += 1
+            else:
+                call.waiters += 1
+                self._stats['shared_calls'] += 1
+
+        if not leader:
+            call.event.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = fn()
+            return call.result, False
+        except Exception as e:
+            call.error = e
+            raise
+        except BaseException as e:
+            # 发起方被中断（GreenletExit、KeyboardInterrupt 等）时等待方收到普通异常，不会拿到空结果
+            call.error = Exception(f"合并的调用被中断: {type(e).__name__}")
+            raise
+        finally:
+            with self._lock:
+                self._calls.pop(key, None)
+            call.event.set()
+
+    def stream(self, key: str, factory: Callable[[Dict[str, Any]], Iterable[str]],
+               stats: Optional[Dict[str, Any]] = None) -> Generator[str, None, None]:
+        """
+        订阅流式调用，同一个键的上游流只打开一次
+
+        Args:
+            key: 合并键
+            factory: 接收统计字典并返回上游分片迭代器的函数，由后台线程读取；
+                     上游可在统计字典中登记 abort 中断函数，最后一个订阅者离开时调用
+            stats: 上游正常结束后写入的统计信息；同时登记本订阅者的 abort，调用后订阅立即结束
+        """
+        left = threading.Event()
+        with self._lock:
+            flight = self._streams.get(key)
+            # 已取消的调用只剩上游收尾，新的订阅者重新发起，不会拿到被截断的流
+            if flight is not None and flight.cancelled:
+                flight = None
+            if flight is None:
+                flight = _StreamFlight()
+                self._streams[key] = flight
+                self._stats['streams'] += 1
+                threading.Thread(target=self._pump, args=(key, flight, factory), daemon=True).start()
+            else:
+                self._stats['shared_streams'] += 1
+            with flight.condition:
+                flight.subscribers += 1
+
+        def leave():
+            with flight.condition:
+                left.set()
+                flight.condition.notify_all()
+
+        if stats is not None:
+            stats['abort'] = leave
+
+        index = 0
+        try:
+            while True:
+                with flight.condition:
+                    while index >= len(flight.chunks) and not flight.done and not left.is_set():
+                        flight.condition.wait()
+                    if left.is_set():
+                        return
+                    pending = flight.chunks[index:]
+                    finished = flight.done
+                for chunk in pending:
+                    yield chunk
+                index += len(pending)
+                if finished and index >= len(flight.chunks):
+                    break
+            if stats is not None:
+                stats.update({k: v for k, v in flight.stats.items() if k != 'abort'})
+        finally:
+            abort = None
+            with flight.condition:
+                flight.subscribers -= 1
+                # 所有订阅者都离开后停止读取上游，并中断正在阻塞的上游读取
+                if flight.subscribers <= 0 and not flight.done:
+                    flight.cancelled = True
+                    abort = flight.stats.get('abort')
+            if abort is not None:
+                abort()
+
+    def _pump(self, key: str, flight: _StreamFlight, factory: Callable[[Dict[str, Any]], Iterable[str]]):
+        """后台读取上游流并分发给订阅者"""
+        iterator = None
+        try:
+            iterator = iter(factory(flight.stats))
+            for chunk in iterator:
+                with flight.condition:
+                    if flight.cancelled:
+                        break
+                    flight.chunks.append(chunk)
+                    flight.condition.notify_all()
+        except Exception as e:
+            print(f"❌ 合并流读取失败: {str(e)}")
+        finally:
+            # 生成器提前关闭时会释放上游连接
+            if iterator is not None and hasattr(iterator, 'close'):
+                iterator.close()
+            with self._lock:
+                if self._streams.get(key) is flight:
+                    del self._streams[key]
+            with flight.condition:
+                flight.done = True
+                flight.condition.notify_all()
+
+    def get_stats(self) -> Dict[str, Any]:
+        """获取合并统计"""
+        with self._lock:
+            return {
+                'in_flight_calls': len(self._calls),
+                'in_flight_streams': len(self._streams),
+                **self._stats
+            }
+
+# 创建全局实例
+single_flight = SingleFlight()
@@ -0,0 +1,294 @@
+"""
+可续传的流式生成模块
+每次流式生成由后台线程执行并写入环形缓冲区，SSE连接只是订阅者：
+连接中断后可以凭 Last-Event-ID 重新接入仍在进行的生成，或重放已结束的生成，而不必重新调用Ollama。
+每帧只编码一次，另外可以注册监听器（如Socket.IO房间推送）按帧接收原始数据
+"""
+
+import os
+import json
+import time
+import uuid
+import threading
+from collections import deque
+from typing import Dict, Any, Iterator, Optional, Tuple, Generator, Callable, List
+from app.utils.sse import sse_frame
+
+# 续传配置
+SSE_REPLAY_MAX_EVENTS = int(os.environ.get('SSE_REPLAY_MAX_EVENTS', 4096))  # 每个生成在内存中保留的最大帧数
+SSE_REPLAY_TTL = int(os.environ.get('SSE_REPLAY_TTL', 300))  # 生成结束后保留可重放帧的时间（秒）
+SSE_REPLAY_MAX_STREAMS = int(os.environ.get('SSE_REPLAY_MAX_STREAMS', 1000))  # 内存中最多保留的生成数
+SSE_RESUME_GRACE = float(os.environ.get('SSE_RESUME_GRACE', 1.0))  # 所有连接断开后等待重连的时间（秒），超时停止生成
+SSE_REPLAY_DIR = os.environ.get('SSE_REPLAY_DIR', '')  # 可选，保存完整帧的磁盘目录，内存缓冲区淘汰早期帧或进程重启后仍可在保留期内重放
+
+
+def parse_event_id(value: str) -> Tuple[Optional[str], int]:
+    """解析 Last-Event-ID，格式为 <生成ID>:<帧序号>"""
+    stream_id, _, seq = (value or '').strip().partition(':')
+    try:
+        return stream_id or None, int(seq or 0)
+    except ValueError:
+        return stream_id or None, 0
+
+
+class ResumableStream:
+    """一次流式生成的帧缓冲区"""
+
+    def __init__(self, user_id: str, conversation_id: str, stream_id: Optional[str] = None,
+                 max_events: Optional[int] = SSE_REPLAY_MAX_EVENTS):
+        self.id = stream_id or uuid.uuid4().hex
+        self.user_id = user_id
+        self.conversation_id = conversation_id
+        self.events = deque(maxlen=max_events)  # (序号, 完整帧)
+        self.last_seq = 0
+        self.done = False
+        self.finished_at = None
+        self.subscribers = 0
+        self.detached_at = None
+        self.condition = threading.Condition()
+        self.listeners: List[Callable[[int, Dict[str, Any]], None]] = []
+        self.finish_callbacks: List[Callable[[], None]] = []
+        self._file = None
+
+    @property
+    def path(self) -> Optional[str]:
+        return os.path.join(SSE_REPLAY_DIR, f"{self.id}.sse") if SSE_REPLAY_DIR else None
+
+    def open_file(self):
+        """开启磁盘保存，首行写入归属信息"""
+        if not self.path:
+            return
+        try:
+            os.makedirs(SSE_REPLAY_DIR, exist_ok=True)
+            self._file = open(self.path, 'wb')
+            header = {'user_id': self.user_id, 'conversation_id': self.conversation_id}
+            self._file.write(json.dumps(header).encode('utf-8') + b'\n')
+        except OSError as e:
+            print(f"⚠️ 无法写入续传文件: {str(e)}")
+            self._file = None
+
+    def add_listener(self, callback: Callable[[int, Dict[str, Any]], None]):
+        """注册监听器，每发布一帧以 (序号, 数据) 调用一次，需在开始生成前注册"""
+        self.listeners.append(callback)
+
+    def publish(self, data: Dict[str, Any]) -> int:
+        """编码为SSE帧（帧前加上 id 行）追加到缓冲区，并通知订阅者和监听器"""
+        with self.condition:
+            self.last_seq += 1
+            seq = self.last_seq
+            full = f"id: {self.id}:{seq}\n".encode('utf-8') + sse_frame(data)
+            self.events.append((seq, full))
+            if self._file is not None:
+                self._file.write(full)
+                self._file.flush()
+            self.condition.notify_all()
+        for callback in self.listeners:
+            try:
+                callback(seq, data)
+            except Exception as e:
+                print(f"⚠️ 流式生成监听器执行失败: {str(e)}")
+        return seq
+
+    def add_finish_callback(self, callback: Callable[[], None]):
+        """注册生成结束回调，无论正常结束、提前停止还是异常都会调用一次"""
+        self.finish_callbacks.append(callback)
+
+    def finish(self):
+        with self.condition:
+            self.done = True
+            self.finished_at = time.time()
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self.condition.notify_all()
+        for callback in self.finish_callbacks:
+            try:
+                callback()
+            except Exception as e:
+                print(f"⚠️ 流式生成结束回调执行失败: {str(e)}")
+
+    def should_stop(self) -> bool:
+        """所有订阅者断开且超过等待重连时间"""
+        with self.condition:
+            return (self.subscribers == 0 and self.detached_at is not None
+                    and time.time() - self.detached_at >= SSE_RESUME_GRACE)
+
+    def subscribe(self, after_seq: int = 0) -> Generator[bytes, None, None]:
+        """
+        订阅帧，从 after_seq 之后开始输出
+        内存中已淘汰的帧从磁盘读取，都不可用时输出 replay_unavailable 并结束
+        """
+        with self.condition:
+            self.subscribers += 1
+        cursor = after_seq
+        try:
+            while True:
+                with self.condition:
+                    while not self.done and self.last_seq <= cursor:
+                        self.condition.wait()
+                    first_seq = self.events[0][0] if self.events else self.last_seq + 1
+                    gap = cursor + 1 < first_seq and cursor < self.last_seq
+                    pending = [] if gap else [e for e in self.events if e[0] > cursor]
+                    finished = self.done
+                    last_seq = self.last_seq
+
+                if gap:
+                    pending = [e for e in (self._read_file() or []) if e[0] > cursor]
+                    if not pending or pending[0][0] != cursor + 1:
+                        yield sse_frame({'error': 'replay_unavailable', 'done': True})
+                        return
+
+                for seq, frame in pending:
+                    yield frame
+                    cursor = seq
+
+                if finished and cursor >= last_seq:
+                    return
+        finally:
+            with self.condition:
+                self.subscribers -= 1
+                self.detached_at = time.time()
+
+    def _read_file(self) -> Optional[list]:
+        """从磁盘读取全部帧"""
+        if not self.path or not os.path.exists(self.path):
+            return None
+        with open(self.path, 'rb') as f:
+            f.readline()
+            return _parse_frames(f.read())
+
+    @classmethod
+    def load(cls, stream_id: str) -> Optional['ResumableStream']:
+        """从磁盘恢复已结束的生成"""
+        if not SSE_REPLAY_DIR or not stream_id.isalnum():
+            return None
+        path = os.path.join(SSE_REPLAY_DIR, f"{stream_id}.sse")
+        if not os.path.exists(path):
+            return None
+        with open(path, 'rb') as f:
+            header = json.loads(f.readline() or b'{}')
+            events = _parse_frames(f.read())
+        stream = cls(header.get('user_id'), header.get('conversation_id'), stream_id, max_events=None)
+        stream.events.extend(events)
+        stream.last_seq = events[-1][0] if events else 0
+        stream.done = True
+        stream.finished_at = os.path.getmtime(path)
+        return stream
+
+
+def _parse_frames(raw: bytes) -> list:
+    """把磁盘中的帧解析为 (序号, 完整帧) 列表"""
+    events = []
+    for block in raw.split(b'\n\n'):
+        if not block.startswith(b'id: '):
+            continue
+        id_line = block.split(b'\n', 1)[0].decode('utf-8')
+        _, seq = parse_event_id(id_line[4:])
+        events.append((seq, block + b'\n\n'))
+    return events
+
+
+class StreamRegistry:
+    """进行中和最近结束的流式生成"""
+
+    def __init__(self):
+        self._streams: Dict[str, ResumableStream] = {}
+        self._lock = threading.Lock()
+        self._purge_replay_dir()
+
+    def _purge_replay_dir(self):
+        """启动时删除上次进程留下的过期续传文件"""
+        if not SSE_REPLAY_DIR or not os.path.isdir(SSE_REPLAY_DIR):
+            return
+        now = time.time()
+        for name in os.listdir(SSE_REPLAY_DIR):
+            path = os.path.join(SSE_REPLAY_DIR, name)
+            try:
+                if name.endswith('.sse') and now - os.path.getmtime(path) > SSE_REPLAY_TTL:
+                    os.remove(path)
+            except OSError as e:
+                print(f"⚠️ 清理续传文件失败: {str(e)}")
+
+    def create(self, user_id: str, conversation_id: str) -> ResumableStream:
+        stream = ResumableStream(user_id, conversation_id)
+        stream.open_file()
+        with self._lock:
+            self._sweep()
+            self._streams[stream.id] = stream
+        return stream
+
+    def get(self, stream_id: str) -> Optional[ResumableStream]:
+        """获取生成，内存中没有时尝试从磁盘恢复"""
+        if not stream_id:
+            return None
+        with self._lock:
+            stream = self._streams.get(stream_id)
+        if stream is None:
+            stream = ResumableStream.load(stream_id)
+        if stream and stream.done and time.time() - stream.finished_at > SSE_REPLAY_TTL:
+            return None
+        return stream
+
+    def start(self, stream: ResumableStream, frames: Iterator[Dict[str, Any]]):
+        """在后台线程中执行生成，并把帧数据写入缓冲区"""
+        threading.Thread(target=self._run, args=(stream, frames), daemon=True).start()
+
+    def _run(self, stream: ResumableStream, frames: Iterator[Dict[str, Any]]):
+        stopped = False
+        error = None
+        done_sent = False
+        try:
+            for frame in frames:
+                stream.publish(frame)
+                done_sent = done_sent or bool(frame.get('done'))
+                if stream.should_stop():
+                    print(f"⚠️ 客户端未在 {SSE_RESUME_GRACE} 秒内重连，停止生成: {stream.id}")
+                    stopped = True
+                    break
+        except Exception as e:
+            print(f"❌ 流式生成执行失败: {str(e)}")
+            error = str(e)
+        finally:
+            # 提前停止时关闭生成器，由其关闭上游连接并保存已生成的部分
+            if hasattr(frames, 'close'):
+                frames.close()
+            # 保证每个生成都以结束帧收尾，SSE和房间客户端不会一直等待
+            if stopped:
+                stream.publish({'done': True, 'message_id': None, 'truncated': True})
+            elif not done_sent:
+                stream.publish({'done': True, 'message_id': None, 'error': error or '生成意外结束'})
+            stream.finish()
+
+    def _sweep(self):
+        """清理过期的生成（调用方需持有锁）"""
+        now = time.time()
+        expired = [sid for sid, s in self._streams.items()
+                   if s.done and now - s.finished_at > SSE_REPLAY_TTL]
+        finished = sorted((s for s in self._streams.values() if s.done), key=lambda s: s.finished_at)
+        overflow = len(self._streams) - len(expired) - SSE_REPLAY_MAX_STREAMS + 1
+        if overflow > 0:
+            expired += [s.id for s in finished if s.id not in expired][:overflow]
+        # 移出内存的生成之后不再有引用，续传文件一并删除
+        for sid in expired:
+            stream = self._streams.pop(sid)
+            if stream.path and os.path.exists(stream.path):
+                try:
+                    os.remove(stream.path)
+                except OSError as e:
+                    print(f"⚠️ 删除续传文件失败: {str(e)}")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            streams = list(self._streams.values())
+        return {
+            'streams': len(streams),
+            'running': sum(1 for s in streams if not s.done),
+            'subscribers': sum(s.subscribers for s in streams),
+            'buffered_frames': sum(len(s.events) for s in streams),
+            'resume_grace': SSE_RESUME_GRACE,
+            'replay_ttl': SSE_REPLAY_TTL,
+            'replay_dir': SSE_REPLAY_DIR or None
+        }
+
+# 创建全局实例
+stream_registry = StreamRegistry()
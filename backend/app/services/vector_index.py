@@ -0,0 +1,257 @@
+"""
+知识库向量索引模块
+每个知识库一个 faiss 内积索引（向量已归一化，内积即余弦相似度），索引ID为分块的 vector_id。
+分块较少时使用精确的 Flat 索引，超过阈值后转换为 IVF 倒排索引，分块数增长到训练时的数倍后重新训练聚类，
+十万级分块的查询仍在毫秒级。
+索引文件保存在 VECTOR_INDEX_DIR 下，进程重启后按需加载；写入只标记修改，由后台线程定期保存（进程退出时也会保存），
+上传和删除文档不必每次重写整个索引文件。
+"""
+
+import os
+import math
+import time
+import atexit
+import threading
+from collections import OrderedDict
+from typing import Dict, List, Tuple, Optional
+
+try:
+    import numpy as np
+    import faiss
+    FAISS_AVAILABLE = True
+except ImportError:
+    np = None
+    faiss = None
+    FAISS_AVAILABLE = False
+
+# 向量索引配置
+VECTOR_INDEX_DIR = os.environ.get('VECTOR_INDEX_DIR', 'data/vector_index')  # 索引文件目录
+VECTOR_INDEX_IVF_THRESHOLD = int(os.environ.get('VECTOR_INDEX_IVF_THRESHOLD', 20000))  # 分块数超过该值时转换为IVF索引
+VECTOR_INDEX_NPROBE = int(os.environ.get('VECTOR_INDEX_NPROBE', 16))  # IVF查询时探测的聚类数，越大召回越高、越慢
+VECTOR_INDEX_RETRAIN_FACTOR = float(os.environ.get('VECTOR_INDEX_RETRAIN_FACTOR', 4))  # 分块数达到上次训练时的倍数后重新训练
+VECTOR_INDEX_MAX_LOADED = int(os.environ.get('VECTOR_INDEX_MAX_LOADED', 50))  # 内存中最多保留的知识库索引数
+VECTOR_INDEX_SAVE_INTERVAL = float(os.environ.get('VECTOR_INDEX_SAVE_INTERVAL', 30))  # 有修改的索引写入文件的间隔（秒）
+
+
+class KnowledgeVectorIndex:
+    """单个知识库的向量索引"""
+
+    def __init__(self, knowledge_base_id: str, dimension: int, path: Optional[str] = None):
+        self.knowledge_base_id = knowledge_base_id
+        self.dimension = dimension
+        self.path = path
+        self.dirty = False
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            self.index = faiss.read_index(path)
+            if self.index.d != dimension:
+                raise Exception(f"知识库索引维度 {self.index.d} 与配置的向量维度 {dimension} 不一致，请重建索引")
+            if hasattr(self.index, 'nprobe'):
+                self.index.nprobe = VECTOR_INDEX_NPROBE
+        else:
+            self.index = faiss.IndexIDMap2(faiss.IndexFlatIP(dimension))
+        # 上次训练聚类时的分块数，加载的索引按当前大小计
+        self.trained_size = self.index.ntotal
+
+    @property
+    def size(self) -> int:
+        return self.index.ntotal
+
+    @property
+    def kind(self) -> str:
+        return 'ivf' if isinstance(self.index, faiss.IndexIVF) else 'flat'
+
+    def add(self, ids: List[int], vectors: 'np.ndarray'):
+        """写入向量，ids 为分块的 vector_id"""
+        if not ids:
+            return
+        vectors = np.ascontiguousarray(vectors, dtype='float32').reshape(len(ids), self.dimension)
+        with self._lock:
+            self.index.add_with_ids(vectors, np.asarray(ids, dtype='int64'))
+            self.dirty = True
+            if self.kind == 'flat':
+                if self.index.ntotal > VECTOR_INDEX_IVF_THRESHOLD:
+                    self._train_ivf()
+            elif self.index.ntotal > self.trained_size * VECTOR_INDEX_RETRAIN_FACTOR:
+                self._train_ivf()
+
+    def remove(self, ids: List[int]) -> int:
+        """删除向量，返回实际删除的数量"""
+        if not ids:
+            return 0
+        with self._lock:
+            removed = self.index.remove_ids(np.asarray(ids, dtype='int64'))
+            self.dirty = self.dirty or removed > 0
+            return removed
+
+    def search(self, vector: 'np.ndarray', k: int) -> List[Tuple[int, float]]:
+        """
+        查询最相似的 k 个分块
+
+        Returns:
+            list: (vector_id, 相似度) 列表，按相似度降序
+        """
+        if self.index.ntotal == 0 or k <= 0:
+            return []
+        vector = np.ascontiguousarray(vector, dtype='float32').reshape(1, self.dimension)
+        with self._lock:
+            scores, ids = self.index.search(vector, min(k, self.index.ntotal))
+        return [(int(i), float(s)) for i, s in zip(ids[0], scores[0]) if i != -1]
+
+    def _export(self) -> Tuple['np.ndarray', 'np.ndarray']:
+        """导出索引中的全部ID和向量"""
+        if self.kind == 'flat':
+            count = self.index.ntotal
+            return faiss.vector_to_array(self.index.id_map).astype('int64'), self.index.index.reconstruct_n(0, count)
+        # IVFFlat 的倒排表直接保存原始向量
+        invlists = self.index.invlists
+        all_ids, all_vectors = [], []
+        for list_no in range(self.index.nlist):
+            size = invlists.list_size(list_no)
+            if size == 0:
+                continue
+            ids = faiss.rev_swig_ptr(invlists.get_ids(list_no), size)
+            codes = faiss.rev_swig_ptr(invlists.get_codes(list_no), size * invlists.code_size)
+            all_ids.append(np.array(ids, dtype='int64'))
+            all_vectors.append(np.frombuffer(bytes(codes), dtype='float32').reshape(size, self.dimension))
+        return np.concatenate(all_ids), np.concatenate(all_vectors)
+
+    def _train_ivf(self):
+        """按当前全部向量训练 IVF 索引，聚类数取分块数平方根的4倍（每个聚类至少39个训练样本）"""
+        ids, vectors = self._export()
+        count = len(ids)
+        nlist = max(1, min(int(4 * math.sqrt(count)), count // 39))
+        quantizer = faiss.IndexFlatIP(self.dimension)
+        ivf = faiss.IndexIVFFlat(quantizer, self.dimension, nlist, faiss.METRIC_INNER_PRODUCT)
+        ivf.train(vectors)
+        ivf.add_with_ids(vectors, ids)
+        ivf.nprobe = VECTOR_INDEX_NPROBE
+        self.index = ivf
+        self.trained_size = count
+        print(f"🔧 知识库 {self.knowledge_base_id} 向量索引训练为IVF: {count} 个分块, {nlist} 个聚类")
+
+    def save(self):
+        """有修改时写入索引文件（先写临时文件再替换）"""
+        with self._lock:
+            if not self.path or not self.dirty:
+                return
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            faiss.write_index(self.index, tmp_path)
+            os.replace(tmp_path, self.path)
+            self.dirty = False
+
+    def retire(self):
+        """索引被替换或删除后不再写文件，仍持有旧对象的写入方不会覆盖新索引文件"""
+        with self._lock:
+            self.path = None
+            self.dirty = False
+
+
+class VectorIndexManager:
+    """按知识库加载和缓存向量索引"""
+
+    def __init__(self, directory: str = VECTOR_INDEX_DIR, max_loaded: int = VECTOR_INDEX_MAX_LOADED):
+        self.directory = directory
+        self.max_loaded = max_loaded
+        self._indexes: OrderedDict = OrderedDict()
+        self._lock = threading.Lock()
+        self._write_locks: Dict[str, threading.RLock] = {}
+        self._saver = None
+        atexit.register(self.save_all)
+
+    def _ensure_saver(self):
+        """启动定期保存线程（调用方需持有锁）"""
+        if self._saver is None or not self._saver.is_alive():
+            self._saver = threading.Thread(target=self._save_periodically, name='vector-index-saver', daemon=True)
+            self._saver.start()
+
+    def _save_periodically(self):
+        while True:
+            time.sleep(VECTOR_INDEX_SAVE_INTERVAL)
+            self.save_all()
+
+    def is_available(self) -> bool:
+        """依赖是否已安装"""
+        return FAISS_AVAILABLE
+
+    def _path(self, knowledge_base_id: str) -> str:
+        return os.path.join(self.directory, f"{knowledge_base_id}.faiss")
+
+    def get(self, knowledge_base_id: str, dimension: int) -> KnowledgeVectorIndex:
+        """获取知识库索引，不存在时从文件加载或新建"""
+        if not FAISS_AVAILABLE:
+            raise Exception("未安装 faiss，无法使用向量索引")
+        knowledge_base_id = str(knowledge_base_id)
+        with self._lock:
+            self._ensure_saver()
+            index = self._indexes.get(knowledge_base_id)
+            if index is None:
+                index = KnowledgeVectorIndex(knowledge_base_id, dimension, self._path(knowledge_base_id))
+                self._indexes[knowledge_base_id] = index
+                while len(self._indexes) > self.max_loaded:
+                    _, evicted = self._indexes.popitem(last=False)
+                    evicted.save()
+            self._indexes.move_to_end(knowledge_base_id)
+            return index
+
+    def write_lock(self, knowledge_base_id: str) -> threading.RLock:
+        """知识库索引的写入锁，写入分块、删除分块和重建索引互斥"""
+        with self._lock:
+            return self._write_locks.setdefault(str(knowledge_base_id), threading.RLock())
+
+    def build(self, knowledge_base_id: str, dimension: int) -> KnowledgeVectorIndex:
+        """新建不关联文件的空索引，写入完成后用 replace 替换当前索引"""
+        if not FAISS_AVAILABLE:
+            raise Exception("未安装 faiss，无法使用向量索引")
+        return KnowledgeVectorIndex(str(knowledge_base_id), dimension)
+
+    def replace(self, knowledge_base_id: str, index: KnowledgeVectorIndex):
+        """
+        原子地替换知识库索引：新索引写入文件后替换内存中的索引，旧索引不再写文件，
+        替换前的检索继续使用旧索引，不会看到空索引
+        """
+        knowledge_base_id = str(knowledge_base_id)
+        index.path = self._path(knowledge_base_id)
+        index.dirty = True
+        index.save()
+        with self._lock:
+            old = self._indexes.get(knowledge_base_id)
+            self._indexes[knowledge_base_id] = index
+            self._indexes.move_to_end(knowledge_base_id)
+            while len(self._indexes) > self.max_loaded:
+                _, evicted = self._indexes.popitem(last=False)
+                evicted.save()
+        if old is not None and old is not index:
+            old.retire()
+
+    def drop(self, knowledge_base_id: str):
+        """删除知识库索引（内存和文件）"""
+        knowledge_base_id = str(knowledge_base_id)
+        with self._lock:
+            index = self._indexes.pop(knowledge_base_id, None)
+        if index is not None:
+            index.retire()
+        path = self._path(knowledge_base_id)
+        if os.path.exists(path):
+            os.remove(path)
+
+    def save_all(self):
+        """保存所有有修改的索引"""
+        with self._lock:
+            indexes = list(self._indexes.values())
+        for index in indexes:
+            try:
+                index.save()
+            except Exception as e:
+                print(f"❌ 保存向量索引失败 {index.knowledge_base_id}: {str(e)}")
+
+    def get_stats(self) -> Dict[str, Dict]:
+        with self._lock:
+            return {
+                kb_id: {'size': index.size, 'kind': index.kind, 'dimension': index.dimension}
+                for kb_id, index in self._indexes.items()
+            }
+
+# 创建全局实例
+vector_indexes = VectorIndexManager()
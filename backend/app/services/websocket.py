@@ -1,14 +1,20 @@
 """
 WebSocket服务模块
-提供实时通信功能，用于工作流执行状态、聊天消息等
+提供实时通信功能，用于工作流执行状态、聊天消息等。
+聊天的流式生成可以推送到对话房间，同一对话的多个标签页/设备共享一次生成
 """
 
 from flask_socketio import SocketIO, emit, join_room, leave_room
-from typing import Dict, Any
+from typing import Dict, Any, Optional
+import os
 import json
 import logging
+import threading
 from datetime import datetime
+from bson import ObjectId
 from flask import request
+from app.services.database import get_db
+from app.utils.auth import verify_token
 
 # 配置日志
 logging.basicConfig(level=logging.INFO)
@@ -20,6 +26,9 @@ class WebSocketService:
     def __init__(self, socketio: SocketIO):
         self.socketio = socketio
         self.active_connections: Dict[str, Any] = {}
+        # 进行中的房间流式生成：对话ID -> {generation_id, seq, parts}
+        self.chat_streams: Dict[str, Dict[str, Any]] = {}
+        self._streams_lock = threading.Lock()
         self.setup_events()
     
     def setup_events(self):
@@ -49,12 +58,11 @@ class WebSocketService:
         
         @self.socketio.on('authenticate')
         def handle_authenticate(data):
-            """用户认证事件"""
+            """用户认证事件：校验JWT，连接的用户以token中的用户为准，忽略客户端传入的 user_id"""
             client_id = request.sid
-            user_id = data.get('user_id')
-            token = data.get('token')
+            user_id = self._verify_user(data.get('token'))
             
-            if user_id and token:
+            if user_id and client_id in self.active_connections:
                 self.active_connections[client_id]['user_id'] = user_id
                 # 加入用户房间
                 join_room(f"user_{user_id}")
@@ -66,17 +74,27 @@ class WebSocketService:
         
         @self.socketio.on('join_chat')
         def handle_join_chat(data):
-            """加入聊天房间"""
+            """加入聊天房间，只能加入已认证用户自己的对话"""
             client_id = request.sid
             chat_id = data.get('chat_id')
-            user_id = data.get('user_id')
+            user_id = self._connection_user(client_id)
             
-            if chat_id and user_id:
-                room_name = f"chat_{chat_id}"
-                join_room(room_name)
-                self.active_connections[client_id]['rooms'].add(room_name)
-                emit('joined_chat', {'chat_id': chat_id, 'status': 'joined'})
-                logger.info(f"用户 {user_id} 加入聊天 {chat_id}")
+            if not user_id:
+                emit('joined_chat', {'chat_id': chat_id, 'status': 'error', 'message': '未认证'})
+                return
+            if not self._owns_conversation(user_id, chat_id):
+                emit('joined_chat', {'chat_id': chat_id, 'status': 'error', 'message': '对话不存在'})
+                return
+            
+            room_name = f"chat_{chat_id}"
+            join_room(room_name)
+            self.active_connections[client_id]['rooms'].add(room_name)
+            emit('joined_chat', {'chat_id': chat_id, 'status': 'joined'})
+            logger.info(f"用户 {user_id} 加入聊天 {chat_id}")
+            # 生成进行中时补发已生成的内容，之后的分片随房间推送
+            snapshot = self.get_chat_stream_snapshot(chat_id)
+            if snapshot:
+                emit('chat_stream_snapshot', snapshot)
         
         @self.socketio.on('leave_chat')
         def handle_leave_chat(data):
@@ -128,9 +146,9 @@ class WebSocketService:
             """聊天消息事件"""
             chat_id = data.get('chat_id')
             message = data.get('message')
-            user_id = data.get('user_id')
+            user_id = self._connection_user(request.sid)
             
-            if chat_id and message:
+            if chat_id and message and self._in_room(request.sid, f"chat_{chat_id}"):
                 room_name = f"chat_{chat_id}"
                 emit('new_message', {
                     'chat_id': chat_id,
@@ -143,10 +161,10 @@ class WebSocketService:
         def handle_typing(data):
             """用户正在输入事件"""
             chat_id = data.get('chat_id')
-            user_id = data.get('user_id')
+            user_id = self._connection_user(request.sid)
             is_typing = data.get('is_typing')
             
-            if chat_id:
+            if chat_id and self._in_room(request.sid, f"chat_{chat_id}"):
                 room_name = f"chat_{chat_id}"
                 emit('user_typing', {
                     'chat_id': chat_id,
@@ -154,6 +172,38 @@ class WebSocketService:
                     'is_typing': is_typing
                 }, room=room_name)
     
+    def _verify_user(self, token: Optional[str]) -> Optional[str]:
+        """
+        校验JWT并返回用户ID，无效时返回 None
+        开发环境与 token_required 一致，使用模拟用户
+        """
+        if os.environ.get('FLASK_ENV') == 'development' or os.environ.get('FLASK_DEBUG') == '1':
+            return 'dev-user-12345'
+        payload = verify_token(token) if token else None
+        if not payload or not ObjectId.is_valid(payload.get('user_id', '')):
+            return None
+        user = get_db().users.find_one({'_id': ObjectId(payload['user_id'])}, {'status': 1})
+        if not user or user.get('status') != 'active':
+            return None
+        return str(user['_id'])
+    
+    def _connection_user(self, client_id: str) -> Optional[str]:
+        """连接已认证的用户ID"""
+        connection = self.active_connections.get(client_id)
+        return connection['user_id'] if connection else None
+    
+    def _in_room(self, client_id: str, room_name: str) -> bool:
+        connection = self.active_connections.get(client_id)
+        return bool(connection) and room_name in connection['rooms']
+    
+    def _owns_conversation(self, user_id: str, chat_id: Optional[str]) -> bool:
+        """对话是否属于该用户"""
+        if not chat_id or not ObjectId.is_valid(chat_id):
+            return False
+        return get_db().conversations.find_one(
+            {'_id': ObjectId(chat_id), 'user_id': user_id}, {'_id': 1}
+        ) is not None
+    
     def broadcast_workflow_status(self, workflow_id: str, status: str, message: str = ""):
         """广播工作流状态"""
         room_name = f"workflow_{workflow_id}"
@@ -169,6 +219,64 @@ class WebSocketService:
         room_name = f"chat_{chat_id}"
         self.socketio.emit('new_message', message, room=room_name)
     
+    def start_chat_stream(self, chat_id: str, generation_id: str) -> bool:
+        """
+        登记对话的房间流式生成，对话已有进行中的生成时返回 False
+        """
+        with self._streams_lock:
+            if chat_id in self.chat_streams:
+                return False
+            self.chat_streams[chat_id] = {'generation_id': generation_id, 'seq': 0, 'parts': []}
+        self.socketio.emit('chat_stream_start', {
+            'chat_id': chat_id,
+            'generation_id': generation_id,
+            'timestamp': datetime.now().isoformat()
+        }, room=f"chat_{chat_id}")
+        return True
+
+    def get_chat_stream(self, chat_id: str) -> Optional[str]:
+        """获取对话进行中的房间生成ID"""
+        with self._streams_lock:
+            state = self.chat_streams.get(chat_id)
+            return state['generation_id'] if state else None
+
+    def get_chat_stream_snapshot(self, chat_id: str) -> Optional[Dict[str, Any]]:
+        """获取对话进行中的生成已输出的内容，供中途加入房间的客户端补齐"""
+        with self._streams_lock:
+            state = self.chat_streams.get(chat_id)
+            if not state:
+                return None
+            return {
+                'chat_id': chat_id,
+                'generation_id': state['generation_id'],
+                'seq': state['seq'],
+                'content': ''.join(state['parts'])
+            }
+
+    def emit_chat_stream(self, chat_id: str, generation_id: str, seq: int, data: Dict[str, Any]):
+        """
+        把一帧生成数据推送到对话房间
+        data 为已合并的分片（chunk）或结束帧（done），与SSE帧内容一致
+        """
+        room_name = f"chat_{chat_id}"
+        with self._streams_lock:
+            state = self.chat_streams.get(chat_id)
+            if state and state['generation_id'] == generation_id:
+                state['seq'] = seq
+                if data.get('chunk'):
+                    state['parts'].append(data['chunk'])
+                if data.get('done'):
+                    del self.chat_streams[chat_id]
+        payload = dict(data, chat_id=chat_id, generation_id=generation_id, seq=seq)
+        self.socketio.emit('chat_stream_done' if data.get('done') else 'chat_stream_chunk', payload, room=room_name)
+
+    def end_chat_stream(self, chat_id: str, generation_id: str):
+        """生成结束时注销对话的房间生成，未发出结束帧（如生成线程异常）时也不会一直占用对话"""
+        with self._streams_lock:
+            state = self.chat_streams.get(chat_id)
+            if state and state['generation_id'] == generation_id:
+                del self.chat_streams[chat_id]
+
     def broadcast_notification(self, user_id: str, notification: Dict[str, Any]):
         """广播通知"""
         room_name = f"user_{user_id}"
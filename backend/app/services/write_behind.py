@@ -0,0 +1,259 @@
+"""
+写后（write-behind）持久化模块
+请求路径上的消息、活动等写入先放入有界队列并立即返回，由后台线程合并为 bulk_write 批量写入MongoDB。
+文档 _id 在入队时生成，调用方可以立即拿到ID；进程退出时自动刷新队列。
+写入可以带一个键（如对话ID），读取方通过 pending 读到同一键下尚未落库的插入，或用 flush_key 等待其落库。
+"""
+
+import os
+import time
+import queue
+import atexit
+import threading
+from typing import Dict, Any, List, Optional, Tuple, Union
+from bson import ObjectId, json_util
+from pymongo import InsertOne, UpdateOne, WriteConcern
+from pymongo.errors import BulkWriteError, PyMongoError
+from app.services.database import get_db
+
+# 写后队列配置
+WRITE_BEHIND_ENABLED = os.environ.get('WRITE_BEHIND_ENABLED', 'true').lower() == 'true'  # 关闭后在请求线程中同步写入
+WRITE_BEHIND_MAX_PENDING = int(os.environ.get('WRITE_BEHIND_MAX_PENDING', 10000))  # 队列最多缓存的写操作数
+WRITE_BEHIND_MAX_BATCH = int(os.environ.get('WRITE_BEHIND_MAX_BATCH', 500))  # 单次批量写入的最大操作数
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.environ.get('WRITE_BEHIND_FLUSH_INTERVAL', 0.05))  # 凑批的最长等待时间（秒）
+WRITE_BEHIND_PUT_TIMEOUT = float(os.environ.get('WRITE_BEHIND_PUT_TIMEOUT', 1.0))  # 队列满时等待超过该时间记录一次背压告警，之后继续阻塞等待
+WRITE_BEHIND_RETRIES = int(os.environ.get('WRITE_BEHIND_RETRIES', 3))  # 数据库不可用时的重试次数
+WRITE_BEHIND_JOURNAL = os.environ.get('WRITE_BEHIND_JOURNAL', 'false').lower() == 'true'  # 批量写入等待日志落盘（j=True）
+WRITE_BEHIND_SHUTDOWN_TIMEOUT = float(os.environ.get('WRITE_BEHIND_SHUTDOWN_TIMEOUT', 10))  # 退出时等待队列刷新的时间（秒）
+WRITE_BEHIND_DEAD_LETTER = os.environ.get('WRITE_BEHIND_DEAD_LETTER', '')  # 可选，重试后仍失败的写操作追加到该文件
+
+# 重复键错误：重试时前一次已经写入成功
+DUPLICATE_KEY_ERROR = 11000
+
+
+class WriteBehindQueue:
+    """写后队列，单个后台线程按入队顺序批量写入"""
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=WRITE_BEHIND_MAX_PENDING)
+        self._lock = threading.Lock()
+        self._condition = threading.Condition(self._lock)
+        # 入队顺序锁：序号分配和入队一起完成，保证已完成数达到某个序号时它之前的写操作都已执行
+        self._put_lock = threading.Lock()
+        self._worker = None
+        self._enqueued = 0
+        self._completed = 0
+        # 键 -> [(序号, 写操作记录)]，尚未执行完的带键写操作
+        self._pending: Dict[str, List[Tuple[int, Dict[str, Any]]]] = {}
+        self.stats = {
+            'written': 0,
+            'batches': 0,
+            'failed': 0,
+            'retries': 0,
+            'backpressure_waits': 0,
+            'max_batch': 0
+        }
+
+    def insert(self, collection: str, document: Dict[str, Any], key: Optional[str] = None) -> ObjectId:
+        """插入文档，返回入队时生成的 _id；key 用于 pending/flush_key 按键读取未落库的写入"""
+        document.setdefault('_id', ObjectId())
+        self._submit({'collection': collection, 'op': 'insert', 'document': document}, key)
+        return document['_id']
+
+    def update(self, collection: str, filter: Dict[str, Any], update: Union[Dict[str, Any], List[Dict[str, Any]]],
+               upsert: bool = False, key: Optional[str] = None):
+        """更新单个文档，update 可以是更新操作符或聚合管道"""
+        self._submit({'collection': collection, 'op': 'update', 'filter': filter, 'update': update, 'upsert': upsert}, key)
+
+    def _submit(self, record: Dict[str, Any], key: Optional[str] = None):
+        if not WRITE_BEHIND_ENABLED:
+            self._write([record])
+            return
+        self._ensure_worker()
+        with self._put_lock:
+            with self._lock:
+                self._enqueued += 1
+                seq = self._enqueued
+                if key is not None:
+                    self._pending.setdefault(key, []).append((seq, record))
+            try:
+                self._queue.put(record, timeout=WRITE_BEHIND_PUT_TIMEOUT)
+            except queue.Full:
+                # 队列持续积压说明数据库跟不上：阻塞等待形成背压，不越过已入队的写操作同步写入，保持写入顺序
+                self._count('backpressure_waits', 1)
+                print(f"⚠️ 写后队列已满（{WRITE_BEHIND_MAX_PENDING}），等待写入: {record['collection']}")
+                self._queue.put(record)
+
+    def _ensure_worker(self):
+        if self._worker is not None and self._worker.is_alive():
+            return
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = threading.Thread(target=self._run, daemon=True)
+                self._worker.start()
+
+    def _run(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + WRITE_BEHIND_FLUSH_INTERVAL
+            while len(batch) < WRITE_BEHIND_MAX_BATCH:
+                remaining = deadline - time.monotonic()
+                try:
+                    batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                print(f"❌ 写后批量写入异常: {str(e)}")
+            with self._condition:
+                self._completed += len(batch)
+                for key in list(self._pending):
+                    remaining = [item for item in self._pending[key] if item[0] > self._completed]
+                    if remaining:
+                        self._pending[key] = remaining
+                    else:
+                        del self._pending[key]
+                self._condition.notify_all()
+
+    def _write(self, batch: List[Dict[str, Any]]):
+        """按集合分组批量写入，同一集合内保持入队顺序"""
+        groups: Dict[str, list] = {}
+        for record in batch:
+            groups.setdefault(record['collection'], []).append(record)
+
+        db = get_db()
+        for collection, records in groups.items():
+            coll = db[collection]
+            if WRITE_BEHIND_JOURNAL:
+                coll = coll.with_options(write_concern=WriteConcern(j=True))
+            self._bulk_write(coll, collection, records)
+
+        with self._lock:
+            self.stats['batches'] += 1
+            self.stats['max_batch'] = max(self.stats['max_batch'], len(batch))
+
+    def _bulk_write(self, coll, collection: str, records: list):
+        attempt = 0
+        while records:
+            try:
+                coll.bulk_write([_to_operation(record) for record in records], ordered=True)
+                self._count('written', len(records))
+                return
+            except BulkWriteError as e:
+                # 有序写入在第一个错误处停止：之前的已成功，跳过出错的操作后继续
+                error = e.details['writeErrors'][0]
+                index = error['index']
+                self._count('written', index)
+                if error.get('code') == DUPLICATE_KEY_ERROR:
+                    self._count('written', 1)
+                else:
+                    print(f"❌ 写入失败，已丢弃: {collection} - {error.get('errmsg')}")
+                    self._dead_letter(records[index:index + 1])
+                records = records[index + 1:]
+            except PyMongoError as e:
+                attempt += 1
+                if attempt > WRITE_BEHIND_RETRIES:
+                    print(f"❌ 批量写入重试 {WRITE_BEHIND_RETRIES} 次后仍失败: {collection} - {str(e)}")
+                    self._dead_letter(records)
+                    return
+                self._count('retries', 1)
+                time.sleep(min(0.2 * 2 ** attempt, 5))
+
+    def _count(self, key: str, value: int):
+        with self._lock:
+            self.stats[key] += value
+
+    def _dead_letter(self, records: list):
+        """记录最终失败的写操作，配置了文件时追加保存以便人工恢复"""
+        self._count('failed', len(records))
+        if not WRITE_BEHIND_DEAD_LETTER:
+            return
+        try:
+            with open(WRITE_BEHIND_DEAD_LETTER, 'a', encoding='utf-8') as f:
+                for record in records:
+                    f.write(json_util.dumps(record, ensure_ascii=False) + '\n')
+        except OSError as e:
+            print(f"⚠️ 无法写入失败记录文件: {str(e)}")
+
+    def flush(self, timeout: Optional[float] = None) -> bool:
+        """等待当前已入队的写操作全部完成，超时返回 False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            target = self._enqueued
+            while self._completed < target:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def pending(self, key: str, collection: Optional[str] = None) -> List[Dict[str, Any]]:
+        """同一键下已入队但尚未执行的插入文档（按入队顺序），供读取方合并到查询结果"""
+        with self._lock:
+            records = [record for _, record in self._pending.get(key, [])]
+        return [record['document'] for record in records
+                if record['op'] == 'insert' and (collection is None or record['collection'] == collection)]
+
+    def flush_key(self, key: str, timeout: Optional[float] = None) -> bool:
+        """等待同一键下已入队的写操作全部执行完，超时返回 False"""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            items = self._pending.get(key)
+            if not items:
+                return True
+            target = items[-1][0]
+            while self._completed < target:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self):
+        """进程退出时刷新队列"""
+        if self.get_stats()['pending'] and not self.flush(WRITE_BEHIND_SHUTDOWN_TIMEOUT):
+            print(f"⚠️ 退出时写后队列未能在 {WRITE_BEHIND_SHUTDOWN_TIMEOUT} 秒内刷新，剩余 {self.get_stats()['pending']} 条")
+
+    def get_stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self.stats)
+            stats['pending'] = self._enqueued - self._completed
+        stats.update({
+            'enabled': WRITE_BEHIND_ENABLED,
+            'max_pending': WRITE_BEHIND_MAX_PENDING,
+            'max_batch_size': WRITE_BEHIND_MAX_BATCH,
+            'flush_interval': WRITE_BEHIND_FLUSH_INTERVAL,
+            'journal': WRITE_BEHIND_JOURNAL
+        })
+        return stats
+
+
+def _to_operation(record: Dict[str, Any]):
+    """把写操作记录转换为 pymongo 批量操作"""
+    if record['op'] == 'insert':
+        return InsertOne(record['document'])
+    return UpdateOne(record['filter'], record['update'], upsert=record['upsert'])
+
+
+def replay_dead_letters(path: str = WRITE_BEHIND_DEAD_LETTER) -> int:
+    """重新执行失败记录文件中的写操作，返回成功条数"""
+    if not path or not os.path.exists(path):
+        return 0
+    db = get_db()
+    replayed = 0
+    with open(path, 'r', encoding='utf-8') as f:
+        for line in f:
+            if not line.strip():
+                continue
+            record = json_util.loads(line)
+            try:
+                db[record['collection']].bulk_write([_to_operation(record)])
+                replayed += 1
+            except PyMongoError as e:
+                print(f"❌ 重放写操作失败: {str(e)}")
+    return replayed
+
+# 创建全局实例
+write_behind = WriteBehindQueue()
+atexit.register(write_behind.close)
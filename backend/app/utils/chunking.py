@@ -0,0 +1,79 @@
+"""
+文本分块工具模块
+按句子切分后贪心合并为不超过token上限的分块，相邻分块之间保留若干token的重叠，
+避免答案恰好落在分块边界时被截断
+"""
+
+import os
+import re
+from typing import List
+from app.utils.tokens import estimate_tokens, _is_cjk
+
+# 分块配置
+# 分块上限与嵌入模型的输入长度绑定：默认模型 paraphrase-multilingual-MiniLM-L12-v2 只编码前128个词片，
+# 超出部分不会进入向量；入库时实际上限还会按已加载模型的 max_seq_length 收紧
+CHUNK_MAX_TOKENS = int(os.environ.get('CHUNK_MAX_TOKENS', 120))  # 单个分块的最大token数
+CHUNK_OVERLAP_TOKENS = int(os.environ.get('CHUNK_OVERLAP_TOKENS', 20))  # 相邻分块重叠的token数
+
+# 句子边界：中英文句末标点或换行之后，切分不丢弃字符，句子直接拼接即还原原文
+_SENTENCE_BOUNDARY = re.compile(r'(?<=[。！？；!?;.\n])')
+
+
+def _split_long(sentence: str, max_tokens: int) -> List[str]:
+    """超过上限的句子按字符切开，每段的估算token数不超过上限"""
+    pieces, start, tokens = [], 0, 0.0
+    for i, ch in enumerate(sentence):
+        cost = 1.0 if _is_cjk(ch) else 0.25
+        if tokens + cost > max_tokens and i > start:
+            pieces.append(sentence[start:i])
+            start, tokens = i, 0.0
+        tokens += cost
+    if start < len(sentence):
+        pieces.append(sentence[start:])
+    return pieces
+
+
+def split_into_chunks(text: str, max_tokens: int = CHUNK_MAX_TOKENS,
+                      overlap_tokens: int = CHUNK_OVERLAP_TOKENS) -> List[str]:
+    """
+    把文本切分为有重叠的分块
+
+    Args:
+        text: 原始文本
+        max_tokens: 单个分块的最大token数
+        overlap_tokens: 新分块开头重复上一分块末尾的token数（按整句计）
+
+    Returns:
+        list: 分块文本列表
+    """
+    sentences = []
+    for sentence in _SENTENCE_BOUNDARY.split(text or ''):
+        if not sentence.strip():
+            # 空行并入上一句，保留段落分隔
+            if sentences:
+                sentences[-1] = (sentences[-1][0] + sentence, sentences[-1][1])
+            continue
+        tokens = estimate_tokens(sentence)
+        if tokens > max_tokens:
+            sentences.extend((piece, estimate_tokens(piece)) for piece in _split_long(sentence, max_tokens))
+        else:
+            sentences.append((sentence, tokens))
+
+    chunks = []
+    current, current_tokens = [], 0
+    for sentence, tokens in sentences:
+        if current and current_tokens + tokens > max_tokens:
+            chunks.append(''.join(s for s, _ in current).strip())
+            # 从上一分块末尾取整句作为重叠，重叠加新句子不超过上限
+            overlap, overlap_size = [], 0
+            for prev in reversed(current):
+                if overlap_size + prev[1] > overlap_tokens or overlap_size + prev[1] + tokens > max_tokens:
+                    break
+                overlap.insert(0, prev)
+                overlap_size += prev[1]
+            current, current_tokens = overlap, overlap_size
+        current.append((sentence, tokens))
+        current_tokens += tokens
+    if current:
+        chunks.append(''.join(s for s, _ in current).strip())
+    return chunks
@@ -0,0 +1,78 @@
+"""
+单轮对话耗时统计工具模块
+记录一轮对话各阶段的耗时，保存到AI消息的 metadata.latency，仪表板据此统计响应时间分布
+"""
+
+import time
+from typing import Dict, Any, Optional
+from app.utils.tokens import estimate_tokens
+
+# 仪表板响应时间分布的区间（毫秒），最后一个区间没有上限
+LATENCY_BUCKETS = [0, 1000, 2000, 3000, 5000]
+LATENCY_BUCKET_LABELS = ['0-1s', '1-2s', '2-3s', '3-5s', '5s+']
+
+
+class TurnTimer:
+    """
+    一轮对话的计时器
+
+    用法:
+        timer = TurnTimer()
+        timer.add('db_lookup', seconds)
+        timer.first_token()
+        metadata['latency'] = timer.summary(stats, content)
+    """
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.durations: Dict[str, float] = {}
+        self.first_token_at: Optional[float] = None
+
+    def add(self, name: str, seconds: float):
+        self.durations[name] = self.durations.get(name, 0.0) + seconds
+
+    def first_token(self):
+        """记录第一个分片到达的时间，只有第一次调用生效"""
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+
+    def summary(self, stats: Optional[Dict[str, Any]] = None, content: str = '',
+                prompt_tokens: int = 0, cached: bool = False) -> Dict[str, Any]:
+        """
+        汇总各阶段耗时（毫秒）和token速度
+
+        Args:
+            stats: 生成统计，可包含 history_seconds、retrieval_seconds、prompt_build_seconds、queue_wait、
+                   prompt_eval_count、eval_count、eval_duration，命中缓存时 cached 为 True
+            content: 回复内容，Ollama未返回token数时用于估算
+            prompt_tokens: Ollama未返回输入token数时的估算值
+            cached: 回复是否来自缓存，缓存命中没有实际生成，不计算token速度
+        """
+        stats = stats or {}
+        cached = cached or bool(stats.get('cached'))
+        finished = time.perf_counter()
+        first = self.first_token_at or finished
+        tokens_out = stats.get('eval_count') or estimate_tokens(content)
+        generation = finished - first
+        # 优先使用Ollama返回的解码耗时（纳秒），非流式请求没有首token时间也能算出速度
+        decode_seconds = (stats.get('eval_duration') or 0) / 1e9 or generation
+
+        def ms(seconds: float) -> float:
+            return round(seconds * 1000, 1)
+
+        summary = {
+            'db_lookup_ms': ms(self.durations.get('db_lookup', 0.0) + stats.get('history_seconds', 0.0)),
+            'retrieval_ms': ms(stats.get('retrieval_seconds', 0.0)),
+            'prompt_build_ms': ms(stats.get('prompt_build_seconds', 0.0)),
+            'queue_wait_ms': ms(stats.get('queue_wait', 0.0)),
+            'ttft_ms': ms(first - self.started),
+            'generation_ms': ms(generation),
+            'total_ms': ms(finished - self.started),
+            'tokens_in': stats.get('prompt_eval_count') or prompt_tokens,
+            'tokens_out': tokens_out,
+            'tokens_per_sec': round(tokens_out / decode_seconds, 2) if decode_seconds > 0 and not cached else None
+        }
+        # 知识检索各阶段耗时和超出预算的阶段
+        if stats.get('retrieval'):
+            summary['retrieval'] = stats['retrieval']
+        return summary
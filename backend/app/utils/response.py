@@ -66,12 +66,44 @@ class ApiResponse:
             }
         }
 
+    @staticmethod
+    def cursor_paginated(data: list, limit: int, before: Optional[str], after: Optional[str],
+                         has_more: bool, message: str = "获取数据成功") -> Dict:
+        """游标分页响应，data 保持为列表，游标放在 pagination 中"""
+        return {
+            "success": True,
+            "code": 200,
+            "message": message,
+            "data": data,
+            "pagination": {
+                "limit": limit,
+                "before": before,
+                "after": after,
+                "has_more": has_more
+            }
+        }
+
+class GenerationRejected(Exception):
+    """生成请求被准入控制拒绝，retry_after 为建议的重试等待秒数"""
+
+    def __init__(self, message: str, retry_after: int):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+def too_many_requests(error: GenerationRejected):
+    """生成请求被准入控制拒绝时返回429，并通过Retry-After告知重试时间"""
+    response = jsonify(ApiResponse.error(str(error), 429, {'retry_after': error.retry_after}))
+    response.headers['Retry-After'] = str(error.retry_after)
+    return response, 429
+
 def handle_exception(f):
     """异常处理装饰器"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
         try:
             return f(*args, **kwargs)
+        except GenerationRejected as e:
+            return too_many_requests(e)
         except Exception as e:
             return jsonify(ApiResponse.error(str(e))), 500
     return decorated_function
@@ -0,0 +1,67 @@
+"""
+SSE输出工具模块
+把模型逐token输出的分片按时间窗口和字节数合并后再发送，减少SSE帧数和系统调用
+"""
+
+import os
+import json
+import time
+from typing import Any, Dict, Optional
+
+# 合并策略配置，两个条件满足任意一个即发送
+SSE_FLUSH_INTERVAL = float(os.environ.get('SSE_FLUSH_INTERVAL', 0.05))  # 缓冲的最长时间（秒），0表示每个分片立即发送
+SSE_FLUSH_BYTES = int(os.environ.get('SSE_FLUSH_BYTES', 256))  # 缓冲的最大字节数
+
+_DATA_PREFIX = b'data: '
+_FRAME_END = b'\n\n'
+
+
+def sse_frame(data: Dict[str, Any]) -> bytes:
+    """编码为一个完整的SSE帧（UTF-8字节），WSGI服务器直接写出不再转码"""
+    return _DATA_PREFIX + json.dumps(data, ensure_ascii=False).encode('utf-8') + _FRAME_END
+
+
+class ChunkCoalescer:
+    """
+    分片合并器
+    add 返回需要立即发送的合并文本，flush 返回剩余的缓冲文本。
+    第一个分片立即发送以保证首字延迟；时间窗口在下一个分片到达时检查，
+    上游停顿时由调用方按 timeout() 等待下一个分片，超时后调用 flush，缓冲文本不会无限期滞留。
+    """
+
+    def __init__(self, interval: float = SSE_FLUSH_INTERVAL, max_bytes: int = SSE_FLUSH_BYTES):
+        self.interval = interval
+        self.max_bytes = max_bytes
+        self._parts = []
+        self._bytes = 0
+        self._started_at = 0.0
+        self._first_sent = False
+
+    def add(self, chunk: str) -> Optional[str]:
+        if not chunk:
+            return None
+        if not self._first_sent:
+            self._first_sent = True
+            return chunk
+        if not self._parts:
+            self._started_at = time.monotonic()
+        self._parts.append(chunk)
+        # 中文字符按UTF-8约3字节估算，避免每个分片都编码一次
+        self._bytes += len(chunk) * 3 if not chunk.isascii() else len(chunk)
+        if self._bytes >= self.max_bytes or time.monotonic() - self._started_at >= self.interval:
+            return self.flush()
+        return None
+
+    def flush(self) -> Optional[str]:
+        if not self._parts:
+            return None
+        text = ''.join(self._parts)
+        self._parts = []
+        self._bytes = 0
+        return text
+
+    def timeout(self) -> Optional[float]:
+        """距缓冲文本到期还有多少秒，没有缓冲时返回 None"""
+        if not self._parts:
+            return None
+        return max(self._started_at + self.interval - time.monotonic(), 0.0)
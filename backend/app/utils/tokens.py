@@ -0,0 +1,23 @@
+"""
+Token估算工具模块
+在没有模型分词器的情况下粗略估算文本token数
+"""
+
+
+def _is_cjk(ch: str) -> bool:
+    """判断是否为中日韩字符"""
+    return ('⺀' <= ch <= '鿿' or
+            '가' <= ch <= '힯' or
+            '豈' <= ch <= '﫿' or
+            '＀' <= ch <= '￯')
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    估算文本token数
+    中日韩字符每个约1个token，其余字符约4个字符1个token
+    """
+    if not text:
+        return 0
+    cjk_count = sum(1 for ch in text if _is_cjk(ch))
+    return cjk_count + (len(text) - cjk_count + 3) // 4
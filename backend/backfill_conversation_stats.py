@@ -0,0 +1,28 @@
+#!/usr/bin/env python3
+"""
+对话统计回填/修复脚本
+按消息集合重新计算对话上的 message_count、token_count、last_message_at 和最后一条消息预览。
+上线冗余统计字段后运行一次；之后统计与消息不一致时可以针对个别对话重新运行。
+
+用法:
+    python backfill_conversation_stats.py
+    python backfill_conversation_stats.py --conversation 6650f0c2a1b2c3d4e5f60718
+"""
+
+import os
+import sys
+import time
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.services.conversation_stats import backfill_conversation_stats
+
+parser = argparse.ArgumentParser(description='对话统计回填/修复')
+parser.add_argument('--conversation', action='append', help='只修复指定对话，可以重复传入')
+args = parser.parse_args()
+
+if __name__ == '__main__':
+    started = time.time()
+    totals = backfill_conversation_stats(args.conversation)
+    print(f"🔧 耗时 {time.time() - started:.2f}s, 对话 {totals['conversations']} 个, 消息 {totals['messages']} 条")
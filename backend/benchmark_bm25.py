@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+BM25关键词索引基准测试
+用常用汉字和英文术语随机组合生成分块，输出构建耗时、倒排表占用内存、
+查询延迟（p50/p99）以及删除部分分块并压缩后的查询延迟。
+
+用法:
+    python benchmark_bm25.py --chunks 100000 --queries 500
+"""
+
+import os
+import sys
+import time
+import random
+import argparse
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import numpy as np
+from app.services.bm25_index import KnowledgeBM25Index
+
+parser = argparse.ArgumentParser(description='BM25关键词索引基准测试')
+parser.add_argument('--chunks', type=int, default=100000, help='分块数')
+parser.add_argument('--chunk-chars', type=int, default=300, help='每个分块的字符数')
+parser.add_argument('--queries', type=int, default=500, help='查询次数')
+parser.add_argument('--k', type=int, default=10, help='每次查询返回的结果数')
+parser.add_argument('--delete-ratio', type=float, default=0.1, help='删除的分块比例')
+args = parser.parse_args()
+
+CHARS = ('的一是在不了有和人这中大为上个国我以要他时来用们生到作地于出就分对成会可主发年动同工也能下过子说产种面而方后多定行学法所民得经'
+         '十三之进着等部度家电力里如水化高自二理起小物现实加量都两体制机当使点从业本去把性好应开它合还因由其些然前外天政四日那社义事平形相全表间样与关各重新线内数正心反你明看原又么利比或但质气第向道命此变条只没结解问意建月公无系军很情者最立代想已通并提直题党程展五果料象员革位入常文总次品式活设及管特件长求老头基资边流路级少图山统接知较将组见计别她手角期根论运农指几九区强放决西被干做必战先回则任取据处理府研质')
+TERMS = ['API', 'Python', 'MongoDB', 'Ollama', 'GPU', 'token', 'faiss', 'docker']
+
+
+def random_chunk(rng: random.Random) -> str:
+    text = ''.join(rng.choices(CHARS, k=args.chunk_chars))
+    return text + ' ' + ' '.join(rng.sample(TERMS, 2))
+
+
+def run_queries(index: KnowledgeBM25Index, queries):
+    timings = []
+    for query in queries:
+        started = time.perf_counter()
+        index.search(query, args.k)
+        timings.append((time.perf_counter() - started) * 1000)
+    return np.array(timings)
+
+
+def report(name: str, timings: np.ndarray):
+    print(f"{name:<8} p50 {np.percentile(timings, 50):6.3f}ms  p99 {np.percentile(timings, 99):6.3f}ms  "
+          f"平均 {timings.mean():6.3f}ms")
+
+
+if __name__ == '__main__':
+    rng = random.Random(0)
+    chunks = [random_chunk(rng) for _ in range(args.chunks)]
+    # 查询取分块中的一段文字，模拟2~6个字的关键词
+    queries = []
+    for _ in range(args.queries):
+        chunk = rng.choice(chunks)
+        start = rng.randrange(0, args.chunk_chars - 6)
+        queries.append(chunk[start:start + rng.randint(2, 6)])
+
+    index = KnowledgeBM25Index('benchmark')
+    started = time.perf_counter()
+    for doc_id, chunk in enumerate(chunks):
+        index.add(doc_id, chunk)
+    build_seconds = time.perf_counter() - started
+    stats = index.get_stats()
+    postings_bytes = sum(p.deltas.itemsize * len(p.deltas) + p.tfs.itemsize * len(p.tfs)
+                         for p in index.postings.values())
+    print(f"🔧 分块 {args.chunks}, 构建 {build_seconds:.2f}s ({args.chunks / build_seconds:.0f} 分块/秒), "
+          f"词 {stats['terms']}, 倒排条目 {stats['postings']}, 倒排表 {postings_bytes / 1024 / 1024:.1f}MB")
+    report('查询', run_queries(index, queries))
+
+    deleted = rng.sample(range(args.chunks), int(args.chunks * args.delete_ratio))
+    started = time.perf_counter()
+    index.remove(deleted)
+    print(f"🔧 删除 {len(deleted)} 个分块 {(time.perf_counter() - started) * 1000:.1f}ms, 待压缩 {index.deleted}")
+    report('删除后', run_queries(index, queries))
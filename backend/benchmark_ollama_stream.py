@@ -0,0 +1,175 @@
+#!/usr/bin/env python3
+"""
+Ollama流式客户端并发基准测试
+对比同步客户端（requests + 线程）和异步客户端（aiohttp + asyncio）
+在单个进程内能同时维持的token流数量、吞吐和首token延迟
+
+用法:
+    # 使用内置的模拟Ollama服务器（不需要GPU和数据库）
+    python benchmark_ollama_stream.py --mock --concurrency 1,16,64,256
+
+    # 连接真实的Ollama服务器
+    python benchmark_ollama_stream.py --url http://localhost:11434 --model qwen2:7b --concurrency 1,4,16
+"""
+
+import os
+import sys
+import time
+import json
+import asyncio
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+parser = argparse.ArgumentParser(description='Ollama流式客户端并发基准测试')
+parser.add_argument('--url', default=os.environ.get('OLLAMA_URL', 'http://localhost:11434'), help='Ollama服务器地址')
+parser.add_argument('--model', default='llama2', help='模型名称')
+parser.add_argument('--prompt', default='请用一段话介绍一下你自己。', help='提示词')
+parser.add_argument('--max-tokens', type=int, default=128, help='每个流的最大token数')
+parser.add_argument('--concurrency', default='1,8,32,64', help='并发流数量，逗号分隔')
+parser.add_argument('--mode', choices=['sync', 'async', 'both'], default='both', help='测试的客户端')
+parser.add_argument('--mock', action='store_true', help='启动内置的模拟Ollama服务器')
+parser.add_argument('--token-delay', type=float, default=0.02, help='模拟服务器每个token的间隔（秒）')
+args = parser.parse_args()
+
+levels = [int(c) for c in args.concurrency.split(',') if c.strip()]
+
+# 连接池和调度上限放开到最大并发，只测量客户端本身
+os.environ.setdefault('OLLAMA_POOL_MAXSIZE', str(max(levels)))
+os.environ.setdefault('GENERATION_MAX_CONCURRENCY', str(max(levels)))
+os.environ.setdefault('GENERATION_MAX_QUEUE', str(max(levels)))
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import app.services.ollama as ollama_module
+from app.services.ollama import get_ollama_service
+from app.services.ollama_async import AsyncOllamaService
+
+# 基准测试不依赖数据库，模型配置使用默认值
+ollama_module._load_model_document = lambda model_name: None
+
+
+def start_mock_server(token_delay: float, max_tokens: int) -> str:
+    """在后台线程启动模拟的Ollama流式接口，返回服务器地址"""
+    from aiohttp import web
+
+    async def handle(request):
+        body = await request.json()
+        num = min(body.get('options', {}).get('num_predict', max_tokens), max_tokens)
+        response = web.StreamResponse(headers={'Content-Type': 'application/x-ndjson'})
+        await response.prepare(request)
+        for i in range(num):
+            key = 'message' if request.path == '/api/chat' else 'response'
+            value = {'role': 'assistant', 'content': f'词{i} '} if key == 'message' else f'词{i} '
+            await response.write((json.dumps({key: value, 'done': False}, ensure_ascii=False) + '\n').encode('utf-8'))
+            await asyncio.sleep(token_delay)
+        await response.write((json.dumps({'done': True, 'eval_count': num}) + '\n').encode('utf-8'))
+        await response.write_eof()
+        return response
+
+    ready = threading.Event()
+    holder = {}
+
+    def run():
+        loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(loop)
+        app = web.Application()
+        app.router.add_post('/api/generate', handle)
+        app.router.add_post('/api/chat', handle)
+        runner = web.AppRunner(app)
+        loop.run_until_complete(runner.setup())
+        site = web.TCPSite(runner, '127.0.0.1', 0, backlog=1024)
+        loop.run_until_complete(site.start())
+        holder['port'] = site._server.sockets[0].getsockname()[1]
+        ready.set()
+        loop.run_forever()
+
+    threading.Thread(target=run, daemon=True).start()
+    ready.wait()
+    return f"http://127.0.0.1:{holder['port']}"
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))]
+
+
+def run_sync(url: str, concurrency: int):
+    """同步客户端：每个流占用一个线程"""
+    service = get_ollama_service(url)
+    ttfts, tokens, errors = [], [0], [0]
+    lock = threading.Lock()
+
+    def one():
+        started = time.time()
+        first = None
+        count = 0
+        try:
+            for chunk in service.stream_text(args.model, args.prompt, 0.7, args.max_tokens):
+                if first is None:
+                    first = time.time() - started
+                count += 1
+        except Exception:
+            with lock:
+                errors[0] += 1
+            return
+        with lock:
+            tokens[0] += count
+            if first is not None:
+                ttfts.append(first)
+
+    started = time.time()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        for future in [pool.submit(one) for _ in range(concurrency)]:
+            future.result()
+    return time.time() - started, tokens[0], ttfts, errors[0]
+
+
+async def run_async(url: str, concurrency: int):
+    """异步客户端：所有流共用一个事件循环"""
+    ttfts, tokens, errors = [], [0], [0]
+
+    async with AsyncOllamaService(url, max_connections=concurrency) as client:
+        async def one():
+            started = time.time()
+            first = None
+            count = 0
+            try:
+                async for chunk in client.stream_text(args.model, args.prompt, 0.7, args.max_tokens):
+                    if first is None:
+                        first = time.time() - started
+                    count += 1
+            except Exception:
+                errors[0] += 1
+                return
+            tokens[0] += count
+            if first is not None:
+                ttfts.append(first)
+
+        started = time.time()
+        await asyncio.gather(*[one() for _ in range(concurrency)])
+        return time.time() - started, tokens[0], ttfts, errors[0]
+
+
+def report(mode: str, concurrency: int, result):
+    elapsed, tokens, ttfts, errors = result
+    print(f"{mode:<6} {concurrency:>6} {tokens / elapsed:>12.1f} {percentile(ttfts, 0.5) * 1000:>10.1f} "
+          f"{percentile(ttfts, 0.95) * 1000:>10.1f} {elapsed:>9.2f} {errors:>6}")
+
+
+def main():
+    url = start_mock_server(args.token_delay, args.max_tokens) if args.mock else args.url
+    print(f"🔧 服务器: {url}, 模型: {args.model}, 每流最大token: {args.max_tokens}")
+    print(f"{'客户端':<6} {'并发流':>6} {'token/秒':>12} {'TTFT p50ms':>10} {'TTFT p95ms':>10} {'耗时s':>9} {'失败':>6}")
+
+    for concurrency in levels:
+        if args.mode in ('sync', 'both'):
+            report('sync', concurrency, run_sync(url, concurrency))
+        if args.mode in ('async', 'both'):
+            report('async', concurrency, asyncio.run(run_async(url, concurrency)))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+SSE帧合并基准测试
+对比逐token发送JSON帧（原实现）与按时间窗口/字节数合并并预编码的帧写出方式，
+输出帧数、帧/秒和每个token消耗的CPU时间。帧通过本地socket写出，包含系统调用开销。
+
+用法:
+    python benchmark_sse_framing.py --tokens 5000 --token-interval 0.0005
+    SSE_FLUSH_INTERVAL=0.1 SSE_FLUSH_BYTES=512 python benchmark_sse_framing.py
+"""
+
+import os
+import sys
+import json
+import time
+import socket
+import argparse
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from app.utils.sse import sse_frame, ChunkCoalescer, SSE_FLUSH_INTERVAL, SSE_FLUSH_BYTES
+
+parser = argparse.ArgumentParser(description='SSE帧合并基准测试')
+parser.add_argument('--tokens', type=int, default=5000, help='模拟的token数')
+parser.add_argument('--token-interval', type=float, default=0.0005, help='模拟的token间隔（秒）')
+args = parser.parse_args()
+
+TOKENS = ['你', '好', '，', '我是', '一个', 'AI', '助手', '。', ' the', ' model', '\n']
+
+
+def token_stream():
+    """模拟模型逐token输出"""
+    for i in range(args.tokens):
+        if args.token_interval:
+            time.sleep(args.token_interval)
+        yield TOKENS[i % len(TOKENS)]
+
+
+def legacy_frames():
+    """原实现：每个token一个JSON帧，字符串拼接累积"""
+    full_response = ""
+    for chunk in token_stream():
+        full_response += chunk
+        yield f"data: {json.dumps({'chunk': chunk})}\n\n".encode('utf-8')
+    yield f"data: {json.dumps({'done': True, 'length': len(full_response)})}\n\n".encode('utf-8')
+
+
+def coalesced_frames():
+    """新实现：合并分片、列表累积、预编码帧"""
+    parts = []
+    coalescer = ChunkCoalescer()
+    for chunk in token_stream():
+        parts.append(chunk)
+        text = coalescer.add(chunk)
+        if text:
+            yield sse_frame({'chunk': text})
+    text = coalescer.flush()
+    if text:
+        yield sse_frame({'chunk': text})
+    yield sse_frame({'done': True, 'length': len(''.join(parts))})
+
+
+def run(name, frames):
+    writer, reader = socket.socketpair()
+
+    def drain():
+        while reader.recv(65536):
+            pass
+
+    thread = threading.Thread(target=drain, daemon=True)
+    thread.start()
+
+    count = 0
+    written = 0
+    wall = time.perf_counter()
+    cpu = time.thread_time()
+    for frame in frames():
+        writer.sendall(frame)
+        count += 1
+        written += len(frame)
+    cpu = time.thread_time() - cpu
+    wall = time.perf_counter() - wall
+    writer.close()
+    thread.join()
+    reader.close()
+
+    print(f"{name:<10} {count:>8} {count / wall:>10.1f} {written:>10} {cpu / args.tokens * 1e6:>12.2f}")
+
+
+if __name__ == '__main__':
+    print(f"🔧 token数: {args.tokens}, token间隔: {args.token_interval}s, "
+          f"合并窗口: {SSE_FLUSH_INTERVAL}s, 合并字节: {SSE_FLUSH_BYTES}")
+    print(f"{'实现':<10} {'帧数':>8} {'帧/秒':>10} {'字节数':>10} {'CPU微秒/token':>12}")
+    run('legacy', legacy_frames)
+    run('coalesced', coalesced_frames)
@@ -0,0 +1,25 @@
+"""
+单元测试公共配置
+测试不依赖运行中的服务：需要数据库的用例使用 mongomock 替换 MongoDB 客户端
+"""
+
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+@pytest.fixture
+def mongo_db():
+    """内存中的 MongoDB，get_db() 返回同一个数据库；导入会在模块级连接数据库的路由前使用"""
+    mongomock = pytest.importorskip('mongomock')
+    from app.services import database
+
+    previous = database.client
+    database.client = mongomock.MongoClient()
+    try:
+        yield database.get_db()
+    finally:
+        database.client = previous
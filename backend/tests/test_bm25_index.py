@@ -0,0 +1,81 @@
+"""
+BM25 索引测试：中日韩二元组切分、差分编码倒排表、删除后压缩、idf 不为负
+"""
+
+import pytest
+
+pytest.importorskip('numpy')
+
+from app.services import bm25_index
+from app.services.bm25_index import KnowledgeBM25Index, tokenize, _Postings
+
+
+def test_tokenize():
+    """中文取相邻两字，标点处断开，英文数字按单词小写"""
+    assert tokenize('知识库，检索') == ['知识', '识库', '检索']
+    assert tokenize('BM25 Index') == ['bm25', 'index']
+    assert tokenize('字') == ['字']
+    assert tokenize('') == []
+
+
+def test_postings_delta_encoding():
+    """倒排表存差分，乱序写入时重新编码，重复ID忽略"""
+    postings = _Postings()
+    postings.append(5, 1)
+    postings.append(9, 2)
+    postings.append(2, 3)
+    postings.append(5, 4)
+    assert postings.doc_ids().tolist() == [2, 5, 9]
+    assert postings.deltas.tolist() == [2, 3, 4]
+    assert postings.tfs.tolist() == [3, 1, 2]
+    assert postings.last_id == 9
+
+
+def test_add_and_search():
+    """命中词多的分块排在前面，重复写入的分块不重复计数"""
+    index = KnowledgeBM25Index('kb')
+    index.add(0, '向量检索与关键词检索')
+    index.add(1, '关键词检索')
+    index.add(2, '天气预报')
+    index.add(1, '关键词检索')
+    assert index.doc_count == 3
+
+    results = index.search('关键词检索', 10)
+    assert [doc_id for doc_id, _ in results][:2] == [1, 0]
+    assert all(score > 0 for _, score in results)
+    assert 2 not in [doc_id for doc_id, _ in results]
+    assert index.search('', 10) == []
+
+
+def test_remove_and_compact(monkeypatch):
+    """删除的分块不再命中，超过比例后压缩清除倒排表中的条目"""
+    monkeypatch.setattr(bm25_index, 'BM25_COMPACT_RATIO', 0.5)
+    index = KnowledgeBM25Index('kb')
+    for doc_id in range(6):
+        index.add(doc_id, f'通用 文档{doc_id}')
+
+    assert index.remove([0]) == 1
+    assert index.deleted == 1
+    assert 0 in index.postings['通用'].doc_ids().tolist()
+    assert 0 not in [doc_id for doc_id, _ in index.search('通用', 10)]
+
+    index.remove([1, 2, 2, 99])
+    assert index.deleted == 0
+    assert index.postings['通用'].doc_ids().tolist() == [3, 4, 5]
+    assert '档0' not in index.postings
+    assert index.get_stats()['documents'] == 3
+
+
+def test_idf_positive_after_deletes(monkeypatch):
+    """删除大部分分块后，出现在所有剩余分块中的词 idf 仍为正"""
+    monkeypatch.setattr(bm25_index, 'BM25_COMPACT_RATIO', 100)
+    index = KnowledgeBM25Index('kb')
+    for doc_id in range(10):
+        index.add(doc_id, '常见 词语' if doc_id < 8 else '常见')
+    index.remove(range(8))
+    assert index.deleted == 8
+
+    results = index.search('常见', 10)
+    assert sorted(doc_id for doc_id, _ in results) == [8, 9]
+    assert all(score > 0 for _, score in results)
+    assert index.search('词语', 10) == []
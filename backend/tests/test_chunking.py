@@ -0,0 +1,56 @@
+"""
+文本分块测试：分块不超过token上限、相邻分块有重叠、上限按嵌入模型输入长度收紧
+"""
+
+from app.utils.chunking import split_into_chunks
+from app.utils.tokens import estimate_tokens
+
+TEXT = ('知识库检索需要把长文档切分为较短的分块。' * 6 +
+        'Each chunk is embedded separately, so it must fit the model input. ' * 4 +
+        '没有标点的超长句子' * 30 + '。\n\n' +
+        '最后一段。')
+
+
+def test_chunks_within_limit():
+    """每个分块的估算token数不超过上限，包括没有标点需要按字符切开的长句"""
+    for max_tokens in (20, 50, 120):
+        chunks = split_into_chunks(TEXT, max_tokens=max_tokens, overlap_tokens=10)
+        assert len(chunks) > 1
+        assert all(chunk and estimate_tokens(chunk) <= max_tokens for chunk in chunks)
+
+
+def test_chunks_cover_text():
+    """不重叠时分块拼接还原原文（忽略分块首尾空白）"""
+    chunks = split_into_chunks(TEXT, max_tokens=40, overlap_tokens=0)
+    assert ''.join(chunks).replace(' ', '').replace('\n', '') == TEXT.replace(' ', '').replace('\n', '')
+
+
+def test_adjacent_chunks_overlap():
+    """新分块以上一分块末尾的整句开头"""
+    text = ''.join(f'第{i}句内容比较短。' for i in range(20))
+    chunks = split_into_chunks(text, max_tokens=30, overlap_tokens=10)
+    assert len(chunks) > 2
+    for previous, current in zip(chunks, chunks[1:]):
+        first_sentence = current.split('。')[0] + '。'
+        assert previous.endswith(first_sentence)
+
+
+def test_empty_text():
+    assert split_into_chunks('') == []
+    assert split_into_chunks('   \n') == []
+
+
+class _FakeEmbedder:
+    """只提供输入长度的嵌入服务"""
+    max_input_tokens = 16
+
+
+def test_split_document_capped_by_embedder(mongo_db, monkeypatch):
+    """知识库分块上限不超过嵌入模型的输入长度"""
+    from app.services import knowledge_service
+
+    monkeypatch.setattr(knowledge_service, 'embedding_service', _FakeEmbedder())
+    service = knowledge_service.KnowledgeService()
+    monkeypatch.setattr(service, 'is_vector_search_available', lambda: True)
+    chunks = service.split_document(TEXT)
+    assert all(estimate_tokens(chunk) <= _FakeEmbedder.max_input_tokens for chunk in chunks)
@@ -0,0 +1,74 @@
+"""
+对话统计测试：聚合管道更新的计数累加，乱序到达的消息不覆盖更新的预览
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+from app.services.conversation_stats import build_message_update, make_preview, EMPTY_STATS, CONVERSATION_PREVIEW_LENGTH
+
+
+@pytest.fixture
+def conversation_id(mongo_db):
+    conversation_id = ObjectId()
+    mongo_db.conversations.insert_one({'_id': conversation_id, 'updated_at': datetime(2024, 1, 1), **EMPTY_STATS})
+    return conversation_id
+
+
+def _apply(db, conversation_id, message):
+    db.conversations.update_one({'_id': conversation_id}, build_message_update(message))
+    return db.conversations.find_one({'_id': conversation_id})
+
+
+def test_counters_accumulate(mongo_db, conversation_id):
+    """消息数、分类计数和token数累加"""
+    now = datetime(2024, 1, 2)
+    _apply(mongo_db, conversation_id, {'type': 'user', 'content': '你好', 'created_at': now})
+    doc = _apply(mongo_db, conversation_id, {'type': 'assistant', 'content': 'hello world',
+                                             'created_at': now + timedelta(seconds=1)})
+    assert doc['message_count'] == 2
+    assert doc['user_message_count'] == 1
+    assert doc['assistant_message_count'] == 1
+    assert doc['token_count'] == 2 + 3
+    assert doc['last_message_type'] == 'assistant'
+    assert doc['last_message_at'] == now + timedelta(seconds=1)
+
+
+def test_older_message_keeps_latest_preview(mongo_db, conversation_id):
+    """较早的消息晚到时只累加计数，预览、类型和时间保持最新一条"""
+    now = datetime(2024, 1, 2)
+    _apply(mongo_db, conversation_id, {'type': 'assistant', 'content': '最新回复', 'created_at': now})
+    doc = _apply(mongo_db, conversation_id, {'type': 'user', 'content': '更早的问题',
+                                             'created_at': now - timedelta(seconds=5)})
+    assert doc['message_count'] == 2
+    assert doc['last_message_preview'] == '最新回复'
+    assert doc['last_message_type'] == 'assistant'
+    assert doc['last_message_at'] == now
+    assert doc['updated_at'] == now
+
+
+def test_missing_fields_initialized(mongo_db):
+    """统计字段缺失的旧对话按 0 和空值起算"""
+    conversation_id = ObjectId()
+    mongo_db.conversations.insert_one({'_id': conversation_id})
+    doc = _apply(mongo_db, conversation_id, {'type': 'user', 'content': 'hi', 'created_at': datetime(2024, 1, 2)})
+    assert doc['message_count'] == 1
+    assert doc['user_message_count'] == 1
+    assert doc['last_message_preview'] == 'hi'
+
+
+def test_preview_is_literal(mongo_db, conversation_id):
+    """以 $ 开头的内容按原文写入预览，不被当作字段路径"""
+    doc = _apply(mongo_db, conversation_id, {'type': 'user', 'content': '$message_count',
+                                             'created_at': datetime(2024, 1, 2)})
+    assert doc['last_message_preview'] == '$message_count'
+
+
+def test_make_preview_truncates():
+    """预览合并空白并截断"""
+    assert make_preview('a\n\n b') == 'a b'
+    preview = make_preview('字' * (CONVERSATION_PREVIEW_LENGTH + 10))
+    assert len(preview) == CONVERSATION_PREVIEW_LENGTH + 1
+    assert preview.endswith('…')
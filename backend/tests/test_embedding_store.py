@@ -0,0 +1,89 @@
+"""
+分块向量存储测试：按内容哈希复用向量、进程中途退出留下的半条哈希记录可恢复
+"""
+
+import os
+
+import pytest
+
+np = pytest.importorskip('numpy')
+
+from app.services import embedding_store as store_module
+from app.services.embedding_store import EmbeddingStore, content_hash
+
+DIMENSION = 8
+
+
+class _FakeEmbedder:
+    """按文本生成确定向量，记录每次调用的文本"""
+    model_name = 'fake/model'
+
+    def __init__(self):
+        self.calls = []
+
+    def embed(self, texts):
+        self.calls.append(list(texts))
+        vectors = np.zeros((len(texts), DIMENSION), dtype=np.float32)
+        for i, text in enumerate(texts):
+            vectors[i, len(text) % DIMENSION] = 1.0
+            vectors[i, -1] = len(text) / 100
+        return vectors
+
+
+@pytest.fixture
+def embedder(monkeypatch):
+    fake = _FakeEmbedder()
+    monkeypatch.setattr(store_module, 'embedding_service', fake)
+    return fake
+
+
+def _hashes_path(directory):
+    return os.path.join(directory, 'fake_model', 'hashes.bin')
+
+
+def test_content_hash_normalizes_whitespace():
+    assert content_hash('a  b\n') == content_hash('a b')
+    assert content_hash('ａ') == content_hash('a')
+    assert content_hash('a') != content_hash('b')
+
+
+def test_reuses_vectors(tmp_path, embedder):
+    """已保存的分块不再调用嵌入模型，同一批中的重复分块只向量化一次"""
+    store = EmbeddingStore(str(tmp_path), dtype='float32')
+    vectors, cached = store.embed(['一', '二', '一'])
+    assert cached == 0
+    assert embedder.calls == [['一', '二']]
+    assert np.array_equal(vectors[0], vectors[2])
+
+    again, cached = store.embed(['二', '三'])
+    assert cached == 1
+    assert embedder.calls[-1] == ['三']
+    assert np.array_equal(again[0], vectors[1])
+
+
+def test_reopen_after_restart(tmp_path, embedder):
+    """新进程打开已有存储时读入全部哈希"""
+    first, _ = EmbeddingStore(str(tmp_path), dtype='float16').embed(['alpha', 'beta'])
+    vectors, cached = EmbeddingStore(str(tmp_path), dtype='float16').embed(['alpha', 'beta'])
+    assert cached == 2
+    assert len(embedder.calls) == 1
+    assert np.allclose(vectors, first, atol=1e-3)
+
+
+def test_torn_tail_recovery(tmp_path, embedder):
+    """哈希文件末尾的半条记录被忽略，下次追加时截掉，之后的记录不会错位"""
+    directory = str(tmp_path)
+    original, _ = EmbeddingStore(directory, dtype='float32').embed(['a', 'bb'])
+    with open(_hashes_path(directory), 'ab') as f:
+        f.write(b'\x01' * 7)
+
+    store = EmbeddingStore(directory, dtype='float32')
+    vectors, cached = store.embed(['a', 'bb', 'ccc'])
+    assert cached == 2
+    assert embedder.calls[-1] == ['ccc']
+    assert np.array_equal(vectors[:2], original)
+    assert os.path.getsize(_hashes_path(directory)) == 3 * 16
+
+    reopened, cached = EmbeddingStore(directory, dtype='float32').embed(['ccc', 'bb', 'a'])
+    assert cached == 3
+    assert np.array_equal(reopened, vectors[::-1])
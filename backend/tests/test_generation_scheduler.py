@@ -0,0 +1,179 @@
+"""
+生成调度器测试：准入、优先级与用户公平、排队超时、等待中被中断
+"""
+
+import time
+import threading
+
+import pytest
+
+from app.services import generation_scheduler as gs
+from app.services.generation_scheduler import (
+    GenerationScheduler, GenerationRejected, PRIORITY_INTERACTIVE, PRIORITY_BATCH
+)
+
+MODEL = 'test-model'
+
+
+def _wait_queued(scheduler, count, timeout=2.0):
+    """等待排队数达到 count"""
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        if scheduler.get_stats()['models'][MODEL]['queued'] == count:
+            return
+        time.sleep(0.005)
+    raise AssertionError(f"排队数未达到 {count}")
+
+
+def _wait_results(results, count, timeout=2.0):
+    """等待后台线程获得名额"""
+    deadline = time.time() + timeout
+    while len(results) < count and time.time() < deadline:
+        time.sleep(0.005)
+    assert len(results) >= count
+
+
+def _acquire_in_thread(scheduler, results, name, user_id=None, priority=PRIORITY_INTERACTIVE):
+    """在后台线程排队获取名额，结果按获得顺序写入 results"""
+    def run():
+        try:
+            slot = scheduler.acquire(MODEL, user_id, priority)
+            results.append((name, slot))
+        except GenerationRejected as e:
+            results.append((name, e))
+    thread = threading.Thread(target=run, daemon=True)
+    thread.start()
+    return thread
+
+
+def test_admission_and_queue_limit():
+    """有空闲名额时立即获得，队列满时直接拒绝并给出 Retry-After"""
+    scheduler = GenerationScheduler(max_concurrency=1, max_queue=1, queue_timeout=5)
+    slot = scheduler.acquire(MODEL, 'u1')
+    assert slot.wait_time == 0.0
+
+    results = []
+    thread = _acquire_in_thread(scheduler, results, 'queued', 'u2')
+    _wait_queued(scheduler, 1)
+
+    with pytest.raises(GenerationRejected) as excinfo:
+        scheduler.acquire(MODEL, 'u3')
+    assert excinfo.value.retry_after >= 1
+    with pytest.raises(GenerationRejected):
+        scheduler.check_admission(MODEL)
+
+    slot.release()
+    thread.join(2)
+    name, queued_slot = results[0]
+    assert name == 'queued' and queued_slot.wait_time > 0
+    queued_slot.release()
+    # 重复释放不会多归还名额
+    queued_slot.release()
+
+    stats = scheduler.get_stats()['models'][MODEL]
+    assert stats['active'] == 0
+    assert stats['admitted'] == 2
+    assert stats['rejected'] == 2
+
+
+def test_interactive_before_batch():
+    """交互式请求即使后到也先于批量请求获得名额"""
+    scheduler = GenerationScheduler(max_concurrency=1, max_queue=4, queue_timeout=5)
+    holder = scheduler.acquire(MODEL, 'u1')
+    results = []
+    threads = [_acquire_in_thread(scheduler, results, 'batch', 'u2', PRIORITY_BATCH)]
+    _wait_queued(scheduler, 1)
+    threads.append(_acquire_in_thread(scheduler, results, 'interactive', 'u3', PRIORITY_INTERACTIVE))
+    _wait_queued(scheduler, 2)
+
+    holder.release()
+    _wait_results(results, 1)
+    assert [name for name, _ in results] == ['interactive']
+
+    results[0][1].release()
+    for thread in threads:
+        thread.join(2)
+    assert [name for name, _ in results] == ['interactive', 'batch']
+    results[1][1].release()
+
+
+def test_fewest_active_user_first():
+    """同优先级下当前占用名额最少的用户优先，而不是先到先得"""
+    scheduler = GenerationScheduler(max_concurrency=2, max_queue=4, queue_timeout=5)
+    slot_a = scheduler.acquire(MODEL, 'a')
+    slot_b = scheduler.acquire(MODEL, 'b')
+    results = []
+    threads = [_acquire_in_thread(scheduler, results, 'a', 'a')]
+    _wait_queued(scheduler, 1)
+    threads.append(_acquire_in_thread(scheduler, results, 'c', 'c'))
+    _wait_queued(scheduler, 2)
+
+    # 用户 a 仍占用一个名额，新用户 c 先获得
+    slot_b.release()
+    _wait_results(results, 1)
+    assert [name for name, _ in results] == ['c']
+
+    slot_a.release()
+    for thread in threads:
+        thread.join(2)
+    assert [name for name, _ in results] == ['c', 'a']
+    for _, slot in results:
+        slot.release()
+    assert scheduler.get_stats()['models'][MODEL]['active'] == 0
+
+
+def test_queue_timeout():
+    """排队超时后拒绝并移出队列"""
+    scheduler = GenerationScheduler(max_concurrency=1, max_queue=4, queue_timeout=0.05)
+    holder = scheduler.acquire(MODEL, 'u1')
+    with pytest.raises(GenerationRejected):
+        scheduler.acquire(MODEL, 'u2')
+    stats = scheduler.get_stats()['models'][MODEL]
+    assert stats['timeouts'] == 1
+    assert stats['queued'] == 0
+    holder.release()
+    assert scheduler.get_stats()['models'][MODEL]['active'] == 0
+
+
+def _interrupt_waits(monkeypatch, before_raise=None):
+    """让排队等待抛出 KeyboardInterrupt，模拟等待中的线程被中断"""
+    original_init = gs._Waiter.__init__
+
+    class InterruptedEvent(threading.Event):
+        def wait(self, timeout=None):
+            if before_raise is not None:
+                before_raise()
+            raise KeyboardInterrupt()
+
+    def init(self, *args, **kwargs):
+        original_init(self, *args, **kwargs)
+        self.event = InterruptedEvent()
+
+    monkeypatch.setattr(gs._Waiter, '__init__', init)
+
+
+def test_interrupted_waiter_leaves_queue(monkeypatch):
+    """等待中被中断的请求移出队列，不占用名额"""
+    scheduler = GenerationScheduler(max_concurrency=1, max_queue=4, queue_timeout=5)
+    holder = scheduler.acquire(MODEL, 'u1')
+    _interrupt_waits(monkeypatch)
+    with pytest.raises(KeyboardInterrupt):
+        scheduler.acquire(MODEL, 'u2')
+    holder.release()
+    stats = scheduler.get_stats()['models'][MODEL]
+    assert stats['queued'] == 0
+    assert stats['active'] == 0
+
+
+def test_interrupted_after_grant_returns_slot(monkeypatch):
+    """名额刚分到就被中断时立即归还，不会永久占用并发数"""
+    scheduler = GenerationScheduler(max_concurrency=1, max_queue=4, queue_timeout=5)
+    holder = scheduler.acquire(MODEL, 'u1')
+    _interrupt_waits(monkeypatch, before_raise=holder.release)
+    with pytest.raises(KeyboardInterrupt):
+        scheduler.acquire(MODEL, 'u2')
+    stats = scheduler.get_stats()['models'][MODEL]
+    assert stats['queued'] == 0
+    assert stats['active'] == 0
+    # 归还后名额可以正常使用
+    scheduler.acquire(MODEL, 'u3').release()
@@ -0,0 +1,83 @@
+"""
+消息分页测试：游标编解码、同一时间戳的消息跨页时不重复不遗漏
+"""
+
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+
+
+@pytest.fixture
+def chat_routes(mongo_db):
+    """聊天路由模块在导入时创建 ChatService，需要先替换数据库"""
+    from app.routes import chat
+    return chat
+
+
+@pytest.fixture
+def conversation(mongo_db):
+    """7 条消息，其中 3 条时间戳相同，分页边界会落在相同时间戳之间"""
+    base = datetime(2024, 1, 1, 12, 0, 0)
+    times = [base, base + timedelta(seconds=1), base + timedelta(seconds=2), base + timedelta(seconds=2),
+             base + timedelta(seconds=2), base + timedelta(seconds=3), base + timedelta(seconds=4)]
+    messages = [{'_id': ObjectId(), 'conversation_id': 'c1', 'type': 'user', 'content': f'm{i}', 'created_at': t}
+                for i, t in enumerate(times)]
+    mongo_db.messages.insert_many(messages)
+    mongo_db.messages.insert_one({'_id': ObjectId(), 'conversation_id': 'other', 'content': 'x', 'created_at': base})
+    return messages
+
+
+def test_cursor_round_trip(chat_routes):
+    """游标还原毫秒精度的时间和消息ID"""
+    message = {'_id': ObjectId(), 'created_at': datetime(2024, 5, 6, 7, 8, 9, 123000)}
+    cursor = chat_routes.encode_message_cursor(message)
+    assert '=' not in cursor
+    assert chat_routes.decode_message_cursor(cursor) == (message['created_at'], message['_id'])
+
+
+@pytest.mark.parametrize('cursor', ['', 'not-a-cursor', 'MTIzNDU', 'MTIzOmFiYw'])
+def test_invalid_cursor(chat_routes, cursor):
+    """格式错误的游标抛出 ValueError，接口据此返回400"""
+    with pytest.raises(ValueError):
+        chat_routes.decode_message_cursor(cursor)
+
+
+def _cursor_key(chat_routes, message):
+    return chat_routes.decode_message_cursor(chat_routes.encode_message_cursor(message))
+
+
+def test_pages_backwards(chat_routes, mongo_db, conversation):
+    """从最新一页向前翻页，每页按时间正序，拼起来与全部消息一致"""
+    pages = []
+    messages, has_more = chat_routes._find_message_page(mongo_db, 'c1', None, False, 2)
+    pages.append(messages)
+    while has_more:
+        messages, has_more = chat_routes._find_message_page(mongo_db, 'c1', _cursor_key(chat_routes, messages[0]),
+                                                            False, 2)
+        pages.append(messages)
+
+    assert [len(page) for page in pages] == [2, 2, 2, 1]
+    ids = [m['_id'] for page in reversed(pages) for m in page]
+    assert ids == [m['_id'] for m in conversation]
+
+
+def test_pages_forwards(chat_routes, mongo_db, conversation):
+    """after 游标向后翻页，最后一页 has_more 为 False"""
+    cursor_key = _cursor_key(chat_routes, conversation[0])
+    ids = []
+    has_more = True
+    while has_more:
+        messages, has_more = chat_routes._find_message_page(mongo_db, 'c1', cursor_key, True, 3)
+        ids.extend(m['_id'] for m in messages)
+        if messages:
+            cursor_key = _cursor_key(chat_routes, messages[-1])
+    assert ids == [m['_id'] for m in conversation[1:]]
+
+
+def test_page_exactly_full(chat_routes, mongo_db, conversation):
+    """剩余消息数恰好等于 limit 时 has_more 为 False"""
+    messages, has_more = chat_routes._find_message_page(mongo_db, 'c1', _cursor_key(chat_routes, conversation[3]),
+                                                        False, 3)
+    assert [m['_id'] for m in messages] == [m['_id'] for m in conversation[:3]]
+    assert has_more is False
@@ -0,0 +1,138 @@
+"""
+请求合并测试：非流式共享结果、流式分发给多个订阅者、订阅者全部离开时中断上游
+"""
+
+import time
+import threading
+
+import pytest
+
+from app.services.single_flight import SingleFlight
+
+
+def _upstream(gate, calls, aborted=None):
+    """返回上游工厂：先输出 a，等待 gate 后输出 b 并写入统计；登记 abort 时可被中断"""
+    def factory(stats):
+        calls.append(stats)
+        if aborted is not None:
+            stats['abort'] = aborted.set
+
+        def generate():
+            yield 'a'
+            gate.wait(5)
+            if aborted is not None and aborted.is_set():
+                return
+            yield 'b'
+            stats['done'] = True
+        return generate()
+    return factory
+
+
+def test_do_shares_result():
+    """相同键的并发调用只执行一次，等待方拿到同一个结果"""
+    flights = SingleFlight()
+    started, release = threading.Event(), threading.Event()
+    calls = []
+
+    def fn():
+        calls.append(1)
+        started.set()
+        release.wait(5)
+        return {'content': 'ok'}
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flights.do('k', fn)))
+    leader.start()
+    started.wait(2)
+    follower = threading.Thread(target=lambda: results.append(flights.do('k', fn)))
+    follower.start()
+    while flights._calls['k'].waiters == 0:
+        time.sleep(0.005)
+    release.set()
+    leader.join(2)
+    follower.join(2)
+
+    assert len(calls) == 1
+    assert sorted(shared for _, shared in results) == [False, True]
+    assert all(result == {'content': 'ok'} for result, _ in results)
+
+
+def test_do_propagates_error():
+    """调用失败时抛出原异常，之后相同键的调用重新执行"""
+    flights = SingleFlight()
+
+    def fail():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        flights.do('k', fail)
+    assert flights.do('k', lambda: 1) == (1, False)
+
+
+def test_stream_fans_out_to_subscribers():
+    """后加入的订阅者从头重放，上游只打开一次，统计写入每个订阅者"""
+    flights = SingleFlight()
+    gate, calls = threading.Event(), []
+    factory = _upstream(gate, calls)
+    stats1, stats2 = {}, {}
+
+    first = flights.stream('k', factory, stats1)
+    assert next(first) == 'a'
+    # 生成器在第一次迭代时才订阅
+    second = flights.stream('k', factory, stats2)
+    assert next(second) == 'a'
+    gate.set()
+
+    assert list(first) == ['b']
+    assert list(second) == ['b']
+    assert len(calls) == 1
+    assert stats1['done'] and stats2['done']
+    assert flights.get_stats()['shared_streams'] == 1
+
+
+def test_stream_aborts_upstream_when_last_subscriber_leaves():
+    """最后一个订阅者离开时调用上游登记的 abort，只剩一个订阅者离开时不中断"""
+    flights = SingleFlight()
+    gate, calls, aborted = threading.Event(), [], threading.Event()
+    factory = _upstream(gate, calls, aborted)
+
+    first = flights.stream('k', factory)
+    assert next(first) == 'a'
+    second = flights.stream('k', factory)
+    assert next(second) == 'a'
+
+    first.close()
+    assert not aborted.is_set()
+    second.close()
+    assert aborted.is_set()
+
+
+def test_subscriber_abort_ends_iteration():
+    """订阅者调用 stats 中的 abort 后立即结束，不必等上游下一个分片"""
+    flights = SingleFlight()
+    gate, calls, aborted = threading.Event(), [], threading.Event()
+    stats = {}
+    subscriber = flights.stream('k', _upstream(gate, calls, aborted), stats)
+    assert next(subscriber) == 'a'
+
+    threading.Timer(0.05, stats['abort']).start()
+    assert list(subscriber) == []
+    assert aborted.is_set()
+
+
+def test_cancelled_flight_is_not_joined():
+    """上游被取消但尚未结束时，新的订阅者重新发起调用，不会拿到被截断的流"""
+    flights = SingleFlight()
+    gate, calls = threading.Event(), []
+    # 不登记 abort：取消后上游仍阻塞在 gate 上
+    factory = _upstream(gate, calls)
+
+    first = flights.stream('k', factory)
+    assert next(first) == 'a'
+    first.close()
+
+    second = flights.stream('k', factory)
+    assert next(second) == 'a'
+    gate.set()
+    assert list(second) == ['b']
+    assert len(calls) == 2
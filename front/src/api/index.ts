@@ -92,7 +92,8 @@ export const api = {
       create: (data: any) => instance.post('/chat/conversations', data),
       update: (id: string, data: any) => instance.put(`/chat/conversations/${id}`, data),
       delete: (id: string) => instance.delete(`/chat/conversations/${id}`),
-      messages: (id: string) => instance.get(`/chat/conversations/${id}/messages`)
+      messages: (id: string, params?: { limit?: number; before?: string; after?: string }) =>
+        instance.get(`/chat/conversations/${id}/messages`, { params })
     }
   },
 
@@ -47,6 +47,9 @@ export const useChatStore = defineStore('chat', () => {
   const conversations = ref<Conversation[]>([])
   const currentConversation = ref<Conversation | null>(null)
   const messages = ref<Message[]>([])
+  // 消息游标分页：更早一页的游标及是否还有更早的消息
+  const olderMessagesCursor = ref<string | null>(null)
+  const hasOlderMessages = ref(false)
   const loading = ref(false)
   const streaming = ref(false)
   const pagination = ref({
@@ -560,16 +563,20 @@ export const useChatStore = defineStore('chat', () => {
       loading.value = true
       console.log('🔍 获取消息列表:', conversationId, params)
       
-      const response = await api.chat.conversations.messages(conversationId)
+      const response = await api.chat.conversations.messages(conversationId, { limit: params.limit })
       
       console.log('🔍 消息列表响应:', response.data)
       
       if (response.data.success) {
         console.log('✅ 获取消息列表成功，消息数量:', response.data.data.length)
         messages.value = response.data.data
+        olderMessagesCursor.value = response.data.pagination?.before || null
+        hasOlderMessages.value = !!response.data.pagination?.has_more
       } else {
         console.error('❌ 获取消息列表失败:', response.data.message)
         messages.value = []
+        olderMessagesCursor.value = null
+        hasOlderMessages.value = false
       }
     } catch (error: any) {
       console.error('❌ 获取消息列表异常:', error)
@@ -597,10 +604,37 @@ export const useChatStore = defineStore('chat', () => {
     }
   }
 
+  // 加载更早的消息，插入到列表开头
+  const loadOlderMessages = async (conversationId: string, limit?: number) => {
+    if (!hasOlderMessages.value || !olderMessagesCursor.value) {
+      return 0
+    }
+    try {
+      const response = await api.chat.conversations.messages(conversationId, {
+        limit,
+        before: olderMessagesCursor.value
+      })
+      if (response.data.success) {
+        const older = response.data.data || []
+        messages.value = [...older, ...messages.value]
+        olderMessagesCursor.value = response.data.pagination?.before || null
+        hasOlderMessages.value = !!response.data.pagination?.has_more
+        console.log('✅ 加载更早的消息成功，数量:', older.length)
+        return older.length
+      }
+      console.error('❌ 加载更早的消息失败:', response.data.message)
+    } catch (error: any) {
+      console.error('❌ 加载更早的消息异常:', error)
+    }
+    return 0
+  }
+
   // 清空当前对话
   const clearCurrentConversation = () => {
     currentConversation.value = null
     messages.value = []
+    olderMessagesCursor.value = null
+    hasOlderMessages.value = false
   }
 
   // 重置状态
@@ -608,6 +642,8 @@ export const useChatStore = defineStore('chat', () => {
     conversations.value = []
     currentConversation.value = null
     messages.value = []
+    olderMessagesCursor.value = null
+    hasOlderMessages.value = false
     loading.value = false
     streaming.value = false
     pagination.value = {
@@ -657,6 +693,7 @@ export const useChatStore = defineStore('chat', () => {
     conversations,
     currentConversation,
     messages,
+    hasOlderMessages,
     loading,
     streaming,
     pagination,
@@ -674,6 +711,7 @@ export const useChatStore = defineStore('chat', () => {
     sendMessage,
     streamMessage,
     getMessages,
+    loadOlderMessages,
     clearCurrentConversation,
     clearAllConversations,
     reset